@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+"""
+Microbenchmarks for the primitives that the refactoring scripts spend
+their time in (mostly the methods of refactor.Source), run over
+synthetic C files of various sizes and densities of matches.
+
+  python bench_refactor.py [--json FILE] [--compare OLD.json]
+
+For each benchmark, size and density, this reports the operations per
+second (an operation being one call, e.g. one scope lookup, or one pass
+over the whole file, e.g. one finditer), and, for each benchmark and
+density, the scaling exponent: k, where the time per operation grows
+as size**k, fitted over the sizes.  The results can be saved as JSON,
+and compared against those from another commit.
+
+Some of the primitives are quadratic in the size of the file; once a
+single operation takes longer than --max-time, the larger sizes are
+skipped for that benchmark.
+"""
+import argparse
+from collections import OrderedDict
+from datetime import date
+from itertools import cycle
+import json
+import math
+import platform
+import random
+import re
+from subprocess import CalledProcessError
+import sys
+
+from refactor import Source, get_revision, monotonic, tabify, wrap
+
+# The identifier that the synthetic files contain at the chosen density,
+# and what the replace benchmark replaces it with:
+MATCH = 'n_basic_blocks'
+REPLACEMENT = 'n_basic_blocks_for_fn (cfun)'
+
+DEFAULT_SIZES = [10 * 1024, 100 * 1024, 1024 * 1024, 5 * 1024 * 1024]
+DEFAULT_DENSITIES = [1.0, 10.0]
+
+def make_c_file(size, density, seed=0):
+    """
+    Make the text of a C file of (just over) the given size in bytes,
+    made up of functions with comments and string literals, containing
+    MATCH at the given density (in matches per KB), on lines that are
+    too long once it is replaced by REPLACEMENT, so that they need
+    wrapping
+    """
+    rng = random.Random(seed)
+    parts = []
+    num_bytes = 0
+    num_matches = 0
+    fn = 0
+    while num_bytes < size:
+        lines = ['/* Compute the %s thing for fn_%i; "quoted"'
+                 ' and // not a comment.  */' % (rng.choice(['first',
+                                                             'second',
+                                                             'last']), fn),
+                 '',
+                 'static int',
+                 'fn_%i (int x, const char *name)' % fn,
+                 '{',
+                 '  int n = %i;' % rng.randint(0, 100),
+                 '  const char *s = "a /* string */ for fn_%i";' % fn]
+        for i in range(rng.randint(4, 12)):
+            # Add a match whenever we've fallen behind the density:
+            if num_matches < density * (num_bytes + 80 * i) / 1024.0:
+                lines.append('  n += compute_the_value_for_this_function'
+                             ' (x, %s, name, %i);' % (MATCH, i))
+                num_matches += 1
+            else:
+                lines.append('  n += x * %i; /* Step %i.  */'
+                             % (rng.randint(1, 9), i))
+        lines += ['  return n;', '}', '', '']
+        part = '\n'.join(lines)
+        parts.append(part)
+        num_bytes += len(part)
+        fn += 1
+    return ''.join(parts)
+
+class Fixture:
+    """
+    A synthetic file, as set up (untimed) for the benchmarks: the
+    Source for it, the indices of the matches, and the Source resulting
+    from replacing all of them (with the replacements marked as changed,
+    as by Source.replace), with the indices of the replacements
+    """
+    def __init__(self, size, density):
+        self.text = make_c_file(size, density)
+        self.src = Source(self.text, 'bench.c')
+        self.indices = [m.start() for m in re.finditer(MATCH, self.text)]
+        self.num_matches = len(self.indices)
+        if not self.indices:
+            # Even at a density of 0, the per-call benchmarks need
+            # somewhere to look:
+            self.indices = [len(self.text) / 2]
+        # At the larger sizes, the slower benchmarks only manage a few
+        # calls, so visit the matches in a (repeatable) random order,
+        # rather than just those at the start of the file:
+        random.Random(size).shuffle(self.indices)
+        changed_text = self.text.replace(MATCH, REPLACEMENT)
+        self.changed_indices = [m.start()
+                                for m in re.finditer(re.escape(REPLACEMENT),
+                                                     changed_text)]
+        random.Random(size).shuffle(self.changed_indices)
+        changes = set()
+        for idx in self.changed_indices:
+            changes.update(range(idx, idx + len(REPLACEMENT)))
+        self.changed = Source(changed_text, 'bench.c', changes)
+
+# Each benchmark takes a Fixture and returns a function that performs
+# one operation.  The per-call ones cycle through the matches, and so
+# are averaged over positions throughout the file.
+def bench_replace(fixture):
+    # (This is within the changed Source, so that the cost of tracking
+    # the earlier changes is included):
+    indices = cycle(fixture.changed_indices)
+    def op():
+        idx = next(indices)
+        fixture.changed.replace(idx, idx + len(REPLACEMENT), MATCH)
+    return op
+
+def bench_finditer(fixture):
+    return lambda: fixture.src.finditer(MATCH)
+
+def _per_call(method_name):
+    def bench(fixture):
+        method = getattr(fixture.src, method_name)
+        indices = cycle(fixture.indices)
+        return lambda: method(next(indices))
+    return bench
+
+def bench_get_changed_lines(fixture):
+    return fixture.changed.get_changed_lines
+
+def bench_source_wrap(fixture):
+    return fixture.changed.wrap
+
+def bench_tabify(fixture):
+    return lambda: tabify(fixture.text)
+
+def bench_wrap(fixture):
+    return lambda: wrap(fixture.text)
+
+BENCHMARKS = OrderedDict([
+    ('Source.replace', bench_replace),
+    ('Source.finditer', bench_finditer),
+    ('Source.within_comment_at', _per_call('within_comment_at')),
+    ('Source.within_string_literal_at', _per_call('within_string_literal_at')),
+    ('Source.get_change_scope_at', _per_call('get_change_scope_at')),
+    ('Source.get_line_at', _per_call('get_line_at')),
+    ('Source.get_changed_lines', bench_get_changed_lines),
+    ('Source.wrap', bench_source_wrap),
+    ('tabify', bench_tabify),
+    ('wrap', bench_wrap),
+])
+
+def measure(op, min_time):
+    """
+    Run op repeatedly, in batches of increasing size, until at least
+    min_time seconds have been spent, returning (ops, seconds)
+    """
+    ops = 0
+    seconds = 0.0
+    batch = 1
+    while seconds < min_time:
+        start = monotonic()
+        for i in xrange(batch):
+            op()
+        seconds += monotonic() - start
+        ops += batch
+        batch *= 2
+    return ops, seconds
+
+def fit_exponent(points):
+    """
+    Given a list of (size, seconds per op) pairs, fit seconds = c *
+    size**k by least squares on a log-log scale, returning k (or None,
+    with fewer than two sizes)
+    """
+    if len(set(size for size, seconds in points)) < 2:
+        return None
+    xs = [math.log(size) for size, seconds in points]
+    ys = [math.log(seconds) for size, seconds in points]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    return (sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+            / sum((x - mean_x) ** 2 for x in xs))
+
+def run_benchmarks(names, sizes, densities, min_time, max_time, out=None):
+    """
+    Run the named benchmarks over each size and density, returning a
+    dict with the results, as saved by --json.  If out is given, a line
+    is written to it as each benchmark finishes.
+    """
+    results = []
+    exponents = []
+    for density in densities:
+        for name in names:
+            points = []
+            for size in sorted(sizes):
+                # (The fixture is made afresh, so that the benchmarks
+                # can't affect each other via the tip of its Sources):
+                fixture = Fixture(size, density)
+                if points and points[-1][1] > max_time:
+                    results.append({'benchmark': name, 'density': density,
+                                    'size': len(fixture.text),
+                                    'skipped': True})
+                    continue
+                ops, seconds = measure(BENCHMARKS[name](fixture), min_time)
+                points.append((len(fixture.text), seconds / ops))
+                results.append({'benchmark': name, 'density': density,
+                                'size': len(fixture.text),
+                                'matches': fixture.num_matches,
+                                'ops': ops, 'seconds': seconds,
+                                'ops_per_sec': ops / seconds})
+                if out:
+                    out.write('%-32s %6.1f %10i %12.1f\n'
+                              % (name, density, len(fixture.text),
+                                 ops / seconds))
+                    out.flush()
+            exponents.append({'benchmark': name, 'density': density,
+                              'exponent': fit_exponent(points)})
+    try:
+        revision = get_revision()
+    except (CalledProcessError, OSError):
+        revision = None
+    return {'revision': revision,
+            'date': date.today().isoformat(),
+            'python': platform.python_version(),
+            'min_time': min_time,
+            'results': results,
+            'exponents': exponents}
+
+def write_results(out, results):
+    """
+    Write tables of the results (as returned by run_benchmarks)
+    """
+    out.write('%-32s %6s %10s %12s %12s\n'
+              % ('benchmark', 'per KB', 'bytes', 'ops/sec', 'usec/op'))
+    for result in results['results']:
+        if result.get('skipped'):
+            out.write('%-32s %6.1f %10i %12s %12s\n'
+                      % (result['benchmark'], result['density'],
+                         result['size'], 'skipped', ''))
+        else:
+            out.write('%-32s %6.1f %10i %12.1f %12.1f\n'
+                      % (result['benchmark'], result['density'],
+                         result['size'], result['ops_per_sec'],
+                         1e6 / result['ops_per_sec']))
+    out.write('scaling exponents (time per op ~ size**k):\n')
+    out.write('%-32s %6s %8s\n' % ('benchmark', 'per KB', 'k'))
+    for exponent in results['exponents']:
+        k = exponent['exponent']
+        out.write('%-32s %6.1f %8s\n'
+                  % (exponent['benchmark'], exponent['density'],
+                     '%.2f' % k if k is not None else '-'))
+
+def write_comparison(out, old, new):
+    """
+    Write a table comparing two sets of results (e.g. from two commits):
+    the speedup of new over old, for each measurement in both, and the
+    change in the scaling exponents
+    """
+    def key(result):
+        # (The sizes can only differ if make_c_file has changed):
+        return result['benchmark'], result['density'], result['size']
+    old_results = dict((key(result), result)
+                       for result in old['results']
+                       if not result.get('skipped'))
+    out.write('%s -> %s\n' % (old.get('revision'), new.get('revision')))
+    out.write('%-32s %6s %10s %12s %12s %8s\n'
+              % ('benchmark', 'per KB', 'bytes', 'old ops/sec',
+                 'new ops/sec', 'speedup'))
+    for result in new['results']:
+        old_result = old_results.get(key(result))
+        if old_result is None or result.get('skipped'):
+            continue
+        out.write('%-32s %6.1f %10i %12.1f %12.1f %7.2fx\n'
+                  % (key(result) + (old_result['ops_per_sec'],
+                                    result['ops_per_sec'],
+                                    result['ops_per_sec']
+                                    / old_result['ops_per_sec'])))
+    old_exponents = dict(((exponent['benchmark'], exponent['density']),
+                          exponent['exponent'])
+                         for exponent in old['exponents'])
+    out.write('%-32s %6s %8s %8s\n' % ('benchmark', 'per KB', 'old k', 'new k'))
+    for exponent in new['exponents']:
+        old_k = old_exponents.get((exponent['benchmark'], exponent['density']))
+        new_k = exponent['exponent']
+        if old_k is None or new_k is None:
+            continue
+        out.write('%-32s %6.1f %8.2f %8.2f\n'
+                  % (exponent['benchmark'], exponent['density'], old_k, new_k))
+
+def parse_size(text):
+    """
+    Parse a size such as "10K" or "5M" into a number of bytes
+    """
+    m = re.match(r'^(\d+)([KM]?)$', text.upper())
+    if not m:
+        raise argparse.ArgumentTypeError('invalid size: %r' % text)
+    return int(m.group(1)) * {'': 1, 'K': 1024, 'M': 1024 * 1024}[m.group(2)]
+
+def main(argv):
+    argp = argparse.ArgumentParser(
+        description='Benchmark the primitives used by the refactoring scripts')
+    argp.add_argument('--benchmark', metavar='NAME', action='append',
+                      dest='benchmarks', choices=BENCHMARKS.keys(),
+                      help='the benchmark to run (default: all of them)')
+    argp.add_argument('--size', metavar='SIZE', action='append',
+                      dest='sizes', type=parse_size,
+                      help=('the size of synthetic file to use, e.g. 10K or'
+                            ' 5M (default: 10K, 100K, 1M and 5M)'))
+    argp.add_argument('--density', metavar='N', action='append',
+                      dest='densities', type=float,
+                      help='the matches per KB to use (default: 1 and 10)')
+    argp.add_argument('--min-time', metavar='SECONDS', type=float,
+                      default=0.2,
+                      help=('the time to spend on each measurement'
+                            ' (default: %(default)s)'))
+    argp.add_argument('--max-time', metavar='SECONDS', type=float,
+                      default=5.0,
+                      help=('skip the larger sizes of a benchmark once an'
+                            ' operation takes longer than this'
+                            ' (default: %(default)s)'))
+    argp.add_argument('--json', metavar='FILE',
+                      help='save the results to FILE, as JSON')
+    argp.add_argument('--compare', metavar='FILE',
+                      help=('compare the results against those saved (via'
+                            ' --json) in FILE, e.g. from another commit'))
+    options = argp.parse_args(argv[1:])
+
+    results = run_benchmarks(options.benchmarks or BENCHMARKS.keys(),
+                             options.sizes or DEFAULT_SIZES,
+                             options.densities or DEFAULT_DENSITIES,
+                             options.min_time, options.max_time,
+                             sys.stderr)
+    write_results(sys.stdout, results)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=1, separators=(',', ': '),
+                      sort_keys=True)
+            f.write('\n')
+    if options.compare:
+        with open(options.compare) as f:
+            write_comparison(sys.stdout, json.load(f), results)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,40 +1,49 @@
-# Parse a patch, extracting the ChangeLog fragment from the header,
-# applying it to actual ChangeLog files
+# Parse patches, extracting the ChangeLog fragment from each header,
+# applying them to actual ChangeLog files
+#
+# Usage: build_changelog_entry.py PATCH... CLOGNAME
+#
+# Given several patches, each ChangeLog is rewritten just once, with the
+# entries from the last patch at the top (as if they'd been applied one
+# at a time).
+from collections import OrderedDict
 from datetime import date
 import os
 import sys
 
 from patch import Patch
-from refactor import AUTHOR
+from refactor import AUTHOR, prepend_to_file, write_file_atomically
 
-def main(argv):
-    print(sys.argv)
-    patchfile = sys.argv[-2]
-    clogname = sys.argv[-1]
-    p = Patch(patchfile)
-    payload = p.parse_payload()
-    for subdir, text in payload.clogs.iteritems():
-        print('subdir: %r' % subdir)
-        print('text:\n%s' % text)
-        clogfile = os.path.join(subdir, clogname)
-        if os.path.exists(clogfile):
-            with open(clogfile) as f:
-                content = f.read()
-        else:
-            content = """Copyright (C) 2014 Free Software Foundation, Inc.
+COPYRIGHT = """Copyright (C) 2014 Free Software Foundation, Inc.
 
 Copying and distribution of this file, with or without modification,
 are permitted in any medium without royalty provided the copyright
 notice and this notice are preserved.
 """
 
-        today = date.today()
-        header = '%s  %s  <%s>\n\n' % (today.isoformat(),
-                                       AUTHOR.name,
-                                       AUTHOR.email)
-        content = (header + ('\t%s\n\n' % p.summary) + text.rstrip() + '\n\n' + content)
-        with open(clogfile, 'w') as f:
-            f.write(content)
+def main(argv):
+    print(argv)
+    patchfiles = argv[1:-1]
+    clogname = argv[-1]
+    today = date.today()
+    header = '%s  %s  <%s>\n\n' % (today.isoformat(),
+                                   AUTHOR.name,
+                                   AUTHOR.email)
+    entries = OrderedDict() # map from ChangeLog path to list of entries
+    for patchfile in patchfiles:
+        p = Patch(patchfile)
+        payload = p.parse_payload()
+        for subdir, text in payload.clogs.iteritems():
+            print('subdir: %r' % subdir)
+            print('text:\n%s' % text)
+            clogfile = os.path.join(subdir, clogname)
+            entries.setdefault(clogfile, []).append(
+                header + ('\t%s\n\n' % p.summary) + text.rstrip() + '\n\n')
+
+    for clogfile, texts in entries.iteritems():
+        if not os.path.exists(clogfile):
+            write_file_atomically(clogfile, COPYRIGHT)
+        prepend_to_file(clogfile, texts)
 
 if __name__ == '__main__':
     main(sys.argv)
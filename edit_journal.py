@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""
+Replay an edit journal, as written by the refactoring scripts'
+"--journal FILE" option, without redoing the analysis.
+
+  python edit_journal.py verify JOURNAL
+      Check that the journal still applies to the tree (or has
+      already been applied)
+  python edit_journal.py diff JOURNAL
+      Write the patch that applying the journal would make
+  python edit_journal.py changelog JOURNAL
+      Show the ChangeLog entries for the journal
+  python edit_journal.py apply JOURNAL
+      Apply the edits to the tree, and add the ChangeLog entries
+  python edit_journal.py merge JOURNAL...
+      Combine journals (e.g. the result bundles written by
+      "--shard I/N" runs), writing the result to stdout
+
+Each command accepts several journals, which are merged first, so that
+e.g. the shards of a run can be applied with a single set of ChangeLog
+entries.
+"""
+import argparse
+import os
+import sys
+
+from refactor import ChangeLogLayout, DiffCollector, Journal, \
+    apply_edits, get_blob_id, make_changelog_additions, \
+    make_diff_from_edits, write_file_atomically
+
+# The state of a file in the tree, relative to a FileResult:
+BASE, APPLIED, MODIFIED = range(3)
+
+class Replay:
+    """
+    A Journal, located within a source tree (by default, the one it was
+    recorded against)
+    """
+    def __init__(self, journal, srcdir=None):
+        self.journal = journal
+        self.srcdir = srcdir if srcdir else journal.srcdir
+
+    def get_path(self, result):
+        """
+        Get the location of the file for the given FileResult within
+        our tree
+        """
+        return os.path.join(self.srcdir,
+                            os.path.relpath(result.path, self.journal.srcdir))
+
+    def get_state(self, result):
+        """
+        Get a (state, text) pair for the file for the given FileResult
+        """
+        with open(self.get_path(result)) as f:
+            text = f.read()
+        blob_id = get_blob_id(text)
+        if blob_id == result.base_id:
+            return BASE, text
+        if blob_id == result.result_id:
+            return APPLIED, text
+        return MODIFIED, text
+
+    def get_pending(self):
+        """
+        Get a list of (FileResult, text) pairs for the files that still
+        need the journal applying, raising a ValueError if any of them
+        have been modified since the journal was recorded
+        """
+        pending = []
+        modified = []
+        for result in self.journal.results:
+            state, text = self.get_state(result)
+            if state == BASE:
+                pending.append((result, text))
+            elif state == MODIFIED:
+                modified.append(self.get_path(result))
+        if modified:
+            raise ValueError('files modified since the journal was recorded: %s'
+                             % ', '.join(modified))
+        return pending
+
+    def get_changelog_additions(self, pending):
+        cll = ChangeLogLayout(self.srcdir)
+        cla = make_changelog_additions(cll, self.journal.script,
+                                       self.journal.revision)
+        for result, text in pending:
+            cla.add_file(self.get_path(result), result.changelog)
+        return cla
+
+    def verify(self, out):
+        """
+        Report on the state of each file, returning True if the journal
+        can be applied (or already has been)
+        """
+        names = {BASE: 'pending', APPLIED: 'applied', MODIFIED: 'MODIFIED'}
+        ok = True
+        for result in self.journal.results:
+            state, text = self.get_state(result)
+            out.write('%s: %s\n' % (self.get_path(result), names[state]))
+            if state == MODIFIED:
+                ok = False
+        return ok
+
+    def diff(self, out, with_changelog=True):
+        pending = self.get_pending()
+        diffs = DiffCollector()
+        for result, text in pending:
+            path = self.get_path(result)
+            diffs.add(path,
+                      make_diff_from_edits(os.path.relpath(path, self.srcdir),
+                                           text, result.edits))
+        if with_changelog:
+            cla = self.get_changelog_additions(pending)
+            cla.apply(diffs, clogname=self.journal.clogname,
+                      applychanges=False)
+        diffs.write(out)
+
+    def changelog(self, out):
+        cla = self.get_changelog_additions(self.get_pending())
+        for dir_ in sorted(cla.text_per_dir):
+            out.write('%s:\n' % os.path.join(os.path.relpath(dir_, self.srcdir),
+                                             self.journal.clogname))
+            out.write(cla.text_per_dir[dir_])
+            out.write('\n')
+
+    def apply(self, with_changelog=True):
+        """
+        Apply the edits to the files (and the ChangeLog entries),
+        returning the number of files changed
+        """
+        pending = self.get_pending()
+        for result, text in pending:
+            write_file_atomically(self.get_path(result),
+                                  apply_edits(text, result.edits))
+        if with_changelog:
+            cla = self.get_changelog_additions(pending)
+            cla.apply(clogname=self.journal.clogname)
+        return len(pending)
+
+def main(argv):
+    argp = argparse.ArgumentParser(description='Replay an edit journal')
+    argp.add_argument('command',
+                      choices=('verify', 'diff', 'changelog', 'apply',
+                               'merge'))
+    argp.add_argument('journals', metavar='JOURNAL', nargs='+')
+    argp.add_argument('--srcdir', default=None,
+                      help=('the source tree to use (default: the one the'
+                            ' journal was recorded against)'))
+    argp.add_argument('--no-changelog', action='store_false', default=True,
+                      dest='with_changelog',
+                      help="don't touch the ChangeLog files")
+    options = argp.parse_args(argv[1:])
+
+    journals = []
+    for filename in options.journals:
+        with open(filename) as f:
+            journals.append(Journal.read(f))
+    journal = Journal.merge(journals)
+    replay = Replay(journal, options.srcdir)
+
+    if options.command == 'merge':
+        journal.write(sys.stdout)
+    elif options.command == 'verify':
+        if not replay.verify(sys.stdout):
+            return 1
+    elif options.command == 'diff':
+        replay.diff(sys.stdout, options.with_changelog)
+    elif options.command == 'changelog':
+        replay.changelog(sys.stdout)
+    elif options.command == 'apply':
+        count = replay.apply(options.with_changelog)
+        sys.stderr.write('applied edits to %i file(s)\n' % count)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,12 +1,39 @@
-from collections import namedtuple, OrderedDict
+import argparse
+from collections import deque, namedtuple, OrderedDict
+from contextlib import contextmanager
+import csv
 from datetime import date
 from difflib import unified_diff
+import ctypes
+import ctypes.util
+import cProfile
+import errno
+import functools
+from hashlib import sha1
+import inspect
+from itertools import islice, izip
+import json
+import marshal
+import math
+import mmap
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
+import pstats
+import random
 import re
-from subprocess import check_output # 2.7
+import resource
+import select
+import shutil
+import signal
+import struct
+from subprocess import check_output, CalledProcessError # 2.7
 import sys
+import tempfile
 import textwrap
+import threading
+import time
+import types
 
 ############################################################################
 # Regex components
@@ -24,29 +51,502 @@ def named_identifier_group(name):
 def named_string_literal(name):
     return '\"(?P<%s>[^"]*)\"' % name
 
+############################################################################
+# Timings
+############################################################################
+def _get_monotonic_clock():
+    """
+    Get a function returning the time in seconds from a monotonic clock
+    (time.monotonic only arrived in Python 3.3, so on Python 2 we call
+    clock_gettime directly)
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    CLOCK_MONOTONIC = 1 # from <linux/time.h>
+    def monotonic():
+        ts = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)):
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = _get_monotonic_clock()
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+def get_rss():
+    """
+    Get the current resident set size of this process, in bytes
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+def get_peak_rss():
+    """
+    Get the peak resident set size of this process so far, in bytes
+    """
+    # (ru_maxrss is in kilobytes on Linux):
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class Timings:
+    """
+    How long was spent in each phase of some work (e.g. the refactoring
+    of one file), and counts of the things done (e.g. matches and edits).
+
+    Phases nest, with the time being charged to the innermost one, so
+    that e.g. the time spent matching within a refactoring isn't also
+    counted as refactoring.
+
+    If regexes is true, the regexes run via run_regex are profiled too,
+    by their pattern (see --profile-regexes).
+
+    If memory is true, the memory used is sampled too (see
+    --profile-memory): the resident set size at the end of each stretch
+    of the outer phases (those at most MEMORY_DEPTH deep, e.g. reading or
+    refactoring a file, as opposed to the checks within the refactoring,
+    which are too frequent to sample), and the peaks (in bytes) set by
+    the caller in "peaks", which are combined by taking the largest.
+    """
+    MEMORY_DEPTH = 2
+
+    def __init__(self, regexes=False, memory=False):
+        self.phases = {} # map from phase name to seconds
+        self.counters = {} # map from counter name to int
+        # map from pattern to [calls, seconds, bytes scanned,
+        # seconds for the slowest call], or None if we're not
+        # profiling regexes:
+        self.regexes = {} if regexes else None
+        # map from phase name to the largest RSS seen at the end of it,
+        # and from name to peak, or None if we're not profiling memory:
+        self.memory = {} if memory else None
+        self.peaks = {} if memory else None
+        # The process that did the work:
+        self.pid = os.getpid()
+        # The phases that we're within, innermost last, as
+        # [name, time since which it has been charged] pairs:
+        self._stack = []
+
+    def start(self, phase):
+        now = monotonic()
+        if self._stack:
+            self._charge(now)
+            if (self.memory is not None
+                and len(self._stack) < self.MEMORY_DEPTH):
+                self._sample_memory()
+        self._stack.append([phase, now])
+
+    def stop(self):
+        now = monotonic()
+        self._charge(now)
+        if self.memory is not None and len(self._stack) <= self.MEMORY_DEPTH:
+            self._sample_memory()
+        self._stack.pop()
+        if self._stack:
+            # Resume the enclosing phase:
+            self._stack[-1][1] = now
+
+    def _charge(self, now):
+        """
+        Charge the time since it was last charged to the innermost phase
+        """
+        top = self._stack[-1]
+        self.phases[top[0]] = self.phases.get(top[0], 0.0) + now - top[1]
+        top[1] = now
+
+    def _sample_memory(self):
+        """
+        Note the RSS at the end of a stretch of the innermost phase
+        """
+        name = self._stack[-1][0]
+        rss = get_rss()
+        if rss > self.memory.get(name, 0):
+            self.memory[name] = rss
+
+    @contextmanager
+    def phase(self, phase):
+        self.start(phase)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def add_regex(self, pattern, calls, seconds, num_bytes, worst):
+        stats = self.regexes.get(pattern)
+        if stats is None:
+            self.regexes[pattern] = [calls, seconds, num_bytes, worst]
+        else:
+            stats[0] += calls
+            stats[1] += seconds
+            stats[2] += num_bytes
+            stats[3] = max(stats[3], worst)
+
+    def get_total(self):
+        return sum(self.phases.itervalues())
+
+    def add(self, other):
+        """
+        Accumulate the phases and counters of another Timings into this one
+        """
+        for phase, seconds in other.phases.iteritems():
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+        for counter, n in other.counters.iteritems():
+            self.count(counter, n)
+        if other.regexes:
+            if self.regexes is None:
+                self.regexes = {}
+            for pattern, stats in other.regexes.iteritems():
+                self.add_regex(pattern, *stats)
+        if other.memory is not None:
+            if self.memory is None:
+                self.memory, self.peaks = {}, {}
+            if other.peaks.get('rss', 0) > self.peaks.get('rss', 0):
+                # (e.g. for the chunks of a file: the process with the
+                # highest peak is the one of interest):
+                self.pid = other.pid
+            for ours, theirs in ((self.memory, other.memory),
+                                 (self.peaks, other.peaks)):
+                for name, size in theirs.iteritems():
+                    ours[name] = max(ours.get(name, 0), size)
+
+    def to_json(self):
+        obj = {'phases': self.phases, 'counters': self.counters}
+        if self.regexes is not None:
+            obj['regexes'] = self.regexes
+        if self.memory is not None:
+            obj['memory'] = self.memory
+            obj['peaks'] = self.peaks
+            obj['pid'] = self.pid
+        return obj
+
+    @staticmethod
+    def from_json(obj):
+        timings = Timings()
+        timings.phases = dict(obj['phases'])
+        timings.counters = dict(obj['counters'])
+        if 'regexes' in obj:
+            timings.regexes = dict((_from_json_str(pattern), list(stats))
+                                   for pattern, stats
+                                   in obj['regexes'].iteritems())
+        if 'memory' in obj:
+            timings.memory = dict(obj['memory'])
+            timings.peaks = dict(obj['peaks'])
+            timings.pid = obj['pid']
+        return timings
+
+# The Timings being recorded into by timed, timing and add_count, if any
+# (this is per-process: each worker records into its own, one file at a
+# time):
+current_timings = None
+
+def activate_timings(timings):
+    """
+    Make timings (a Timings, or None) the current one, returning the
+    previous one
+    """
+    global current_timings
+    previous = current_timings
+    current_timings = timings
+    if (previous is None) != (timings is None):
+        _install_timed(timings is not None)
+    return previous
+
+@contextmanager
+def timing(phase):
+    """
+    Charge the time spent within the with-block to the given phase of the
+    current Timings, if there is one
+    """
+    if current_timings is None:
+        yield
+    else:
+        with current_timings.phase(phase):
+            yield
+
+def add_count(counter, n=1):
+    if current_timings is not None:
+        current_timings.count(counter, n)
+
+def run_regex(pattern, num_bytes, fn, *args):
+    """
+    Call fn(*args), which runs the given regex (a pattern str, or a
+    compiled regex) over num_bytes of text, profiling it if the current
+    Timings is profiling regexes
+    """
+    timings = current_timings
+    if timings is None or timings.regexes is None:
+        return fn(*args)
+    start = monotonic()
+    result = fn(*args)
+    seconds = monotonic() - start
+    timings.add_regex(getattr(pattern, 'pattern', pattern),
+                      1, seconds, num_bytes, seconds)
+    return result
+
+# The functions decorated by timed, as [function, wrapper, owner]
+# lists, where owner is the module or class in which it is defined
+# (found when the wrappers are first installed):
+_timed = []
+
+def timed(phase, counter=None):
+    """
+    Decorator for functions and methods defined at the top level of a
+    module: charge the time spent within the function to the given phase
+    of the current Timings, and count the calls to it as counter (if
+    given).
+
+    Many of these are called very often (e.g. Source.within_comment_at),
+    so the function is only replaced by the timing wrapper whilst there
+    is a current Timings (see activate_timings).
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            timings = current_timings
+            if timings is None:
+                return fn(*args, **kwargs)
+            if counter:
+                timings.count(counter)
+            timings.start(phase)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timings.stop()
+        _timed.append([fn, wrapper, None])
+        if current_timings is not None:
+            return wrapper
+        return fn
+    return decorator
+
+def _install_timed(install):
+    """
+    Replace the functions decorated by timed with their wrappers (or put
+    them back)
+    """
+    for entry in _timed:
+        fn, wrapper, owner = entry
+        if owner is None:
+            module = sys.modules[fn.__module__]
+            for owner in [module] + vars(module).values():
+                if (isinstance(owner, (types.ModuleType, type,
+                                       types.ClassType))
+                    and vars(owner).get(fn.__name__) in (fn, wrapper)):
+                    entry[2] = owner
+                    break
+            else:
+                # (e.g. a nested function, which can't be timed):
+                continue
+        setattr(entry[2], fn.__name__, wrapper if install else fn)
+
+############################################################################
+# Event hooks
+############################################################################
+class Hooks:
+    """
+    Callbacks for the events of a run (e.g. for dashboards or profilers):
+    subclass this, overriding the methods of interest, and pass instances
+    to main, via its hooks argument.
+
+    They are all called in the parent process.  The events within the
+    refactoring of a file (file_started, match, edit and scope) happen in
+    the workers, which record them and send them back with the file's
+    result, so that these are called as a batch, just before its
+    file_finished.  When no hooks are given, the workers record nothing.
+    """
+    def run_started(self, script, paths):
+        pass
+
+    def file_dispatched(self, path):
+        """
+        The refactoring of path (or of a chunk of it) was handed to the
+        workers (with --io-threads, this is called from another thread,
+        once the file has been read)
+        """
+        pass
+
+    def file_started(self, path, pid):
+        """
+        A worker (with the given pid) started refactoring path (or a chunk
+        of it)
+        """
+        pass
+
+    def match(self, path, pattern, start, end):
+        """
+        Source.finditer or finditer_multiline found a match for pattern;
+        start and end are offsets into the text as it was at the time
+        """
+        pass
+
+    def edit(self, path, start, end, replacement):
+        """
+        Source.replace replaced text[start:end] with replacement, for the
+        text as it was at the time
+        """
+        pass
+
+    def scope(self, path, idx, scope):
+        """
+        Source.get_change_scope_at found the scope at offset idx
+        """
+        pass
+
+    def file_finished(self, result):
+        """
+        Called with the FileResult for each file (whose timings are the
+        Timings for it)
+        """
+        pass
+
+    def changelog_written(self, path, text):
+        """
+        The entries in text were added to the ChangeLog at path (or, if
+        we're not applying changes, to the patch)
+        """
+        pass
+
+    def run_finished(self):
+        pass
+
+# The events being recorded for the Hooks, if any, as a list of
+# (method name, args...) tuples, lacking the path (as for current_timings,
+# this is per-process: each worker records the events for one file at a
+# time):
+current_events = None
+
+def activate_events(events):
+    """
+    Make events (a list, or None) the one being recorded into, returning
+    the previous one
+    """
+    global current_events
+    previous = current_events
+    current_events = events
+    return previous
+
+def dispatching(tasks, hooks):
+    """
+    Generate the given tasks, calling the hooks' file_dispatched for each
+    as it is taken
+    """
+    for task in tasks:
+        for hook in hooks:
+            hook.file_dispatched(get_task_path(task))
+        yield task
+
 ############################################################################
 # Generic hooks
 ############################################################################
+def get_changelog_cache(basedir):
+    """
+    Get a (path, key) pair for the cache of the ChangeLog directories
+    within basedir, or (None, None) if basedir isn't within a git checkout.
+
+    The cache lives within the checkout's git directory, and the key is
+    the state of its index, which changes whenever ChangeLog files are
+    added or removed in git.
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            gitdir = check_output(['git', 'rev-parse', '--git-dir'],
+                                  cwd=basedir, stderr=devnull).strip()
+        gitdir = os.path.join(basedir, gitdir)
+        st = os.stat(os.path.join(gitdir, 'index'))
+    except (CalledProcessError, OSError):
+        return None, None
+    abspath = os.path.abspath(basedir)
+    path = os.path.join(gitdir, 'changelog-layout-%s.json'
+                        % sha1(abspath).hexdigest()[:16])
+    return path, [abspath, st.st_ino, st.st_mtime, st.st_size]
+
+def get_changelog_dirs(basedir, use_cache=True):
+    """
+    Get the sorted list of the directories below basedir (as found by
+    os.walk) that contain a ChangeLog file.
+
+    Walking a whole GCC tree is slow, so if use_cache is true, and basedir
+    is within a git checkout, the list is cached (see get_changelog_cache;
+    ChangeLog files that aren't in git are only noticed when the index
+    next changes).
+    """
+    cachepath, key = get_changelog_cache(basedir) if use_cache else (None, None)
+    if key:
+        try:
+            with open(cachepath) as f:
+                obj = json.load(f)
+            if obj['key'] == key:
+                return [os.path.join(basedir, str(rel)) if rel else basedir
+                        for rel in obj['dirs']]
+        except (IOError, ValueError, KeyError):
+            pass
+
+    dirs = sorted(dirpath
+                  for dirpath, dirnames, filenames in os.walk(basedir)
+                  if 'ChangeLog' in filenames)
+    if key:
+        obj = {'key': key,
+               'dirs': [os.path.relpath(dir_, basedir) if dir_ != basedir
+                        else ''
+                        for dir_ in dirs]}
+        try:
+            write_file_atomically(cachepath, json.dumps(obj))
+        except (IOError, OSError):
+            # (e.g. the checkout is read-only):
+            pass
+    return dirs
+
 class ChangeLogLayout:
     """
     A collection of ChangeLog files in a directory hierarchy, thus
     indicating which ChangeLog covers which files
     """
-    def __init__(self, basedir):
-        self.dirs = []
-        for dirpath, dirs, files in os.walk(basedir):
-            if 'ChangeLog' in files:
-                self.dirs.append(dirpath)
-        self.dirs = sorted(self.dirs)
+    def __init__(self, basedir, use_cache=True):
+        self.basedir = basedir
+        self.dirs = get_changelog_dirs(basedir, use_cache)
+        # A trie of the path components of dirs, built on demand:
+        self._trie = None
+        self._trie_dirs = None
+
+    def _get_trie(self):
+        # (dirs can be replaced e.g. by tests, in which case the trie has
+        # to be rebuilt):
+        if self._trie_dirs is not self.dirs:
+            trie = {}
+            for dir_ in self.dirs:
+                node = trie
+                for part in dir_.split('/'):
+                    node = node.setdefault(part, {})
+                # (None is never a path component):
+                node[None] = dir_
+            self._trie = trie
+            self._trie_dirs = self.dirs
+        return self._trie
 
     def locate_dir(self, path):
         """
         Which directory's ChangeLog "owns" this path?
         """
-        # Longest path that matches initial part of input path:
-        return max([dir_ for dir_ in self.dirs
-                    if path.startswith('%s/' % dir_)],
-                   key=len)
+        # The deepest directory that the path is within:
+        result = None
+        node = self._get_trie()
+        for part in path.split('/')[:-1]:
+            node = node.get(part)
+            if node is None:
+                break
+            result = node.get(None, result)
+        if result is None:
+            raise ValueError('no ChangeLog covers %s' % path)
+        return result
 
     def get_path_relative_to_changelog(self, path):
         dir_ = self.locate_dir(path)
@@ -62,10 +562,23 @@ class ChangeLogAdditions:
         self.isodate = isodate
         self.author = author
         self.headertext = headertext
-        # Mapping from directory
-        self.text_per_dir = {}
+        # Mapping from directory to list of strs, and the result of
+        # joining them (built on demand, by text_per_dir):
+        self._parts_per_dir = {}
+        self._text_per_dir = None
         self._lasttext_per_dir = {}
 
+    @property
+    def text_per_dir(self):
+        """
+        Mapping from directory to the text to add to its ChangeLog
+        """
+        if self._text_per_dir is None:
+            self._text_per_dir = dict((dir_, ''.join(parts))
+                                      for dir_, parts
+                                      in self._parts_per_dir.iteritems())
+        return self._text_per_dir
+
     def add_file(self, path, clog):
         """
         Add Changelog instance about a file at a given path to the
@@ -78,31 +591,33 @@ class ChangeLogAdditions:
         if not filetext:
             return
         assert filetext.endswith('\n')
-        if dir_ not in self.text_per_dir:
+        if dir_ not in self._parts_per_dir:
             header = '%s  %s  <%s>' % (self.isodate,
                                        self.author.name,
                                        self.author.email)
-            self.text_per_dir[dir_] = (header + '\n\n'
-                                       + self.headertext + '\n')
-        self.text_per_dir[dir_] += filetext
+            self._parts_per_dir[dir_] = [header + '\n\n'
+                                         + self.headertext + '\n']
+        self._parts_per_dir[dir_].append(filetext)
+        self._text_per_dir = None
 
-    def apply(self, printdiff, clogname='ChangeLog'):
+    def apply(self, diffs=None, clogname='ChangeLog', applychanges=True):
         """
-        Apply the changes to the ChangeLog files on disk
+        Apply the changes to the ChangeLog files on disk, adding the
+        diffs of the ChangeLog files to diffs (a DiffCollector), if given
         """
         for dir_ in self.text_per_dir:
             filename = os.path.join(dir_, clogname)
-            with open(filename, 'r') as f:
-                old_contents = f.read()
-            new_contents = self.text_per_dir[dir_] + '\n' + old_contents
-            if printdiff:
-                for line in unified_diff(old_contents.splitlines(),
-                                         new_contents.splitlines(),
-                                         fromfile=filename,
-                                         tofile=filename):
-                    sys.stdout.write('%s\n' % line)
-            with open(filename, 'w') as f:
-                f.write(new_contents)
+            text = self.text_per_dir[dir_] + '\n'
+            if diffs is not None:
+                # (The diff only needs the start of the old content, as
+                # context for the insertion):
+                diffs.add(filename,
+                          make_diff_from_edits(
+                              os.path.relpath(filename, self.cll.basedir),
+                              read_head(filename, DIFF_CONTEXT + 1),
+                              [Edit(0, 0, text)]))
+            if applychanges:
+                prepend_to_file(filename, [text])
 
 class Changelog:
     """
@@ -117,22 +632,65 @@ class Changelog:
         Generate textual form of log, potentially abbreviating successive
         duplicate entries to "Likewise."
         """
-        result = ''
+        result = []
         for scope, text in self.scope_to_text.iteritems():
             if text == lasttext:
                 text = 'Likewise.'
             else:
                 lasttext = text
-            if result == '':
+            if not result:
                 if scope:
-                    result += wrap('* %s (%s): %s\n' % (self.filename, scope, text))
+                    result.append(wrap('* %s (%s): %s\n'
+                                       % (self.filename, scope, text)))
                 else:
                     # File-level changes
-                    result += wrap('* %s: %s\n' % (self.filename, text))
+                    result.append(wrap('* %s: %s\n' % (self.filename, text)))
             else:
                 assert scope
-                result += wrap('(%s): %s\n' % (scope, text))
-        return result, lasttext
+                result.append(wrap('(%s): %s\n' % (scope, text)))
+        return ''.join(result), lasttext
+
+    def to_json(self):
+        return {'filename': self.filename,
+                'entries': self.scope_to_text.items()}
+
+    @staticmethod
+    def from_json(obj):
+        if 'stages' in obj:
+            return StagedChangelog(_from_json_str(obj['filename']),
+                                   [Changelog.from_json(stage)
+                                    for stage in obj['stages']],
+                                   obj['separate'])
+        clog = Changelog(_from_json_str(obj['filename']))
+        for scope, text in obj['entries']:
+            clog.scope_to_text[_from_json_str(scope)] = _from_json_str(text)
+        return clog
+
+    def make_empty(self):
+        """
+        Make an empty Changelog of the same kind, for the same file
+        """
+        return Changelog(self.filename)
+
+    def for_file(self, filename):
+        """
+        Make a copy of this Changelog for another file (e.g. one with
+        the same content)
+        """
+        clog = Changelog(filename)
+        clog.scope_to_text = OrderedDict(self.scope_to_text)
+        return clog
+
+    def extend(self, other):
+        """
+        Add the entries from another Changelog for the same file,
+        skipping any duplicates
+        """
+        for scope, text in other.scope_to_text.iteritems():
+            if scope not in self.scope_to_text:
+                self.scope_to_text[scope] = text
+            elif text not in self.scope_to_text[scope]:
+                self.scope_to_text[scope] += '  %s' % text
 
     def append(self, scope, text):
         assert text.endswith('.')
@@ -141,68 +699,307 @@ class Changelog:
         else:
             self.scope_to_text[scope] = '%s' % text
 
+class StagedChangelog(Changelog):
+    """
+    The Changelog for a file from a Chain of refactorings, holding the
+    entries from each stage (scope_to_text holds all of them, merged).
+
+    If separate is true, the text has each stage's entries in turn,
+    rather than the merged entries.
+    """
+    def __init__(self, filename, stages, separate=False):
+        Changelog.__init__(self, filename)
+        self.stages = stages # list of Changelog
+        self.separate = separate
+        self._merge()
+
+    def _merge(self):
+        self.scope_to_text = OrderedDict()
+        for stage in self.stages:
+            Changelog.extend(self, stage)
+
+    def as_text(self, lasttext):
+        if not self.separate:
+            return Changelog.as_text(self, lasttext)
+        result = []
+        for stage in self.stages:
+            text, lasttext = stage.as_text(lasttext)
+            result.append(text)
+        return ''.join(result), lasttext
+
+    def to_json(self):
+        obj = Changelog.to_json(self)
+        obj['stages'] = [stage.to_json() for stage in self.stages]
+        obj['separate'] = self.separate
+        return obj
+
+    def make_empty(self):
+        return StagedChangelog(self.filename,
+                               [stage.make_empty() for stage in self.stages],
+                               self.separate)
+
+    def for_file(self, filename):
+        return StagedChangelog(filename,
+                               [stage.for_file(filename)
+                                for stage in self.stages],
+                               self.separate)
+
+    def extend(self, other):
+        # Extend stage by stage, so that the merged entries are in the
+        # same order as if the stages had been run one after another:
+        for stage, other_stage in zip(self.stages, other.stages):
+            stage.extend(other_stage)
+        self._merge()
+
+    def append(self, scope, text):
+        # (As if by the last stage):
+        self.stages[-1].append(scope, text)
+        self._merge()
+
+class QuoteAwareTextWrapper(textwrap.TextWrapper):
+    """
+    A TextWrapper that doesn't break within quoted strings
+    """
+    # The chunks of text: a quoted string (running to the end of the
+    # text if it's unterminated), a run of whitespace, or a word (which
+    # can contain quotes after its first character):
+    CHUNK_PATTERN = re.compile(r'"[^"]*"?|\s+|[^\s"]\S*')
+
+    def _split(self, text):
+        return self.CHUNK_PATTERN.findall(text)
+
+_wrapper = QuoteAwareTextWrapper()
+
+@timed('wrap')
 def wrap(text):
     """
     Word-wrap (to 70 columns) then add leading tab
     Don't break within quoted strings
     """
+    result = []
+    for line in text.splitlines():
+        result.append('\n'.join(['\t%s' % wl
+                                 for wl in _wrapper.wrap(line)]))
+        result.append('\n')
+    return ''.join(result)
 
-    class MyTextWrapper(textwrap.TextWrapper):
-        # Don't break within quoted strings
-        def _split(self, text):
-            # states:
-            ENTRY, WORD, WHITESPACE, QUOTE = range(4)
+############################################################################
+# Diffs
+############################################################################
+def _format_range(start, stop):
+    """
+    Format a hunk's line range the way "diff -u" does
+    """
+    length = stop - start
+    if length == 1:
+        return '%i' % (start + 1)
+    if not length:
+        # An empty range is given as the line before it:
+        return '%i,0' % start
+    return '%i,%i' % (start + 1, length)
+
+def _diff_line(prefix, line):
+    if line.endswith('\n'):
+        return prefix + line
+    return prefix + line + '\n\\ No newline at end of file\n'
+
+# The number of lines of context in diffs:
+DIFF_CONTEXT = 3
+
+@timed('diff')
+def make_diff(path, old, new, context=DIFF_CONTEXT):
+    """
+    Generate a git-style unified diff turning str old into str new,
+    labelled with path (relative to the top of the source tree), suitable
+    for "git apply".  Returns '' if there are no changes.
+    """
+    if old == new:
+        return ''
+    result = ['diff --git a/%s b/%s\n' % (path, path),
+              '--- a/%s\n' % path,
+              '+++ b/%s\n' % path]
+    lines = unified_diff(old.splitlines(True), new.splitlines(True),
+                         n=context)
+    # We already wrote our own header, so skip the "---" and "+++" lines
+    # of unified_diff's (but not content lines that look like them):
+    for line in islice(lines, 2, None):
+        if line.startswith('@@'):
+            result.append(line)
+        else:
+            result.append(_diff_line(line[0], line[1:]))
+    return ''.join(result)
 
-            self.chunks = []
-            self.state = ENTRY
-            self.curchunk = ''
+def _get_changed_blocks(old, edits):
+    """
+    Convert a sorted list of Edit instances to old into a sequence of
+    (line_idx, lo, hi, old_lines, new_lines) tuples, where old[lo:hi]
+    consists of the whole lines old_lines, starting at line line_idx
+    (0-based), which are to be replaced by new_lines.
 
-            for ch in text:
-                if self.state == ENTRY:
-                    if ch.isspace():
-                        self._change_state_to(WHITESPACE, ch)
-                    elif ch == '"':
-                        self._change_state_to(QUOTE, ch)
-                    else:
-                        self._change_state_to(WORD, ch)
-                elif self.state == WORD:
-                    if ch.isspace():
-                        self._change_state_to(WHITESPACE, ch)
-                    else:
-                        self.curchunk += ch
-                elif self.state == WHITESPACE:
-                    if ch.isspace():
-                        self.curchunk += ch
-                    elif ch == '"':
-                        self._change_state_to(QUOTE, ch)
-                    else:
-                        self._change_state_to(WORD, ch)
-                elif self.state == QUOTE:
-                    if ch == '"':
-                        self.curchunk += ch
-                        self.chunks.append(self.curchunk)
-                        self.state = ENTRY
-                        self.curchunk = ''
-                    else:
-                        self.curchunk += ch
-                else:
-                    raise ValueError('Unknown state: %s' % state)
-            self._change_state_to(ENTRY, '')
-            return self.chunks
-
-        def _change_state_to(self, newstate, ch):
-            self.state = newstate
-            if self.curchunk:
-                self.chunks.append(self.curchunk)
-            self.curchunk = ch
-
-    result = ''
-    tw = MyTextWrapper()
-    for line in text.splitlines():
-        result += '\n'.join(['\t%s' % wl
-                             for wl in tw.wrap(line)])
-        result += '\n'
-    return result
+    Edits sharing a line are merged, and lines that are unaffected
+    by an edit are trimmed.
+    """
+    # Expand the edits to whole lines, merging those that share lines,
+    # giving a list of [lo, hi, edits] triples:
+    groups = []
+    for e in edits:
+        lo = old.rfind('\n', 0, e.start) + 1
+        hi = old.find('\n', e.end)
+        hi = len(old) if hi == -1 else hi + 1
+        if groups and lo < groups[-1][1]:
+            groups[-1][1] = max(hi, groups[-1][1])
+            groups[-1][2].append(e)
+        else:
+            groups.append([lo, hi, [e]])
+
+    line_idx = 0
+    pos = 0
+    for lo, hi, group_edits in groups:
+        line_idx += old.count('\n', pos, lo)
+        pos = lo
+        old_lines = old[lo:hi].splitlines(True)
+        new_lines = apply_edits(old[lo:hi],
+                                [Edit(e.start - lo, e.end - lo, e.replacement)
+                                 for e in group_edits]).splitlines(True)
+        # Trim common leading lines:
+        start = 0
+        while (start < len(old_lines) and start < len(new_lines)
+               and old_lines[start] == new_lines[start]):
+            lo += len(old_lines[start])
+            start += 1
+        # ...and common trailing lines:
+        end_old, end_new = len(old_lines), len(new_lines)
+        while (end_old > start and end_new > start
+               and old_lines[end_old - 1] == new_lines[end_new - 1]):
+            end_old -= 1
+            end_new -= 1
+            hi -= len(old_lines[end_old])
+        if start == end_old and start == end_new:
+            # No net change:
+            continue
+        yield (line_idx + start, lo, hi,
+               old_lines[start:end_old], new_lines[start:end_new])
+
+@timed('diff')
+def make_diff_from_edits(path, old, edits, context=DIFF_CONTEXT):
+    """
+    Equivalent to make_diff, but building the hunks directly from a sorted
+    list of Edit instances turning str old into the new text, so that the
+    cost scales with the number of edits, rather than the size of the file.
+    """
+    blocks = list(_get_changed_blocks(old, edits))
+    if not blocks:
+        return ''
+
+    # Group the blocks into hunks, where the context would otherwise
+    # overlap:
+    hunks = []
+    for block in blocks:
+        if (hunks
+            and block[0] - (hunks[-1][-1][0] + len(hunks[-1][-1][3])) <= 2 * context):
+            hunks[-1].append(block)
+        else:
+            hunks.append([block])
+
+    result = ['diff --git a/%s b/%s\n' % (path, path),
+              '--- a/%s\n' % path,
+              '+++ b/%s\n' % path]
+    line_delta = 0 # offset of new line numbers relative to old ones
+    for hunk in hunks:
+        # Leading context:
+        first_line, lo = hunk[0][0], hunk[0][1]
+        ctx_lo = lo
+        for i in range(context):
+            if ctx_lo == 0:
+                break
+            ctx_lo = old.rfind('\n', 0, ctx_lo - 1) + 1
+        leading = old[ctx_lo:lo].splitlines(True)
+
+        # Trailing context:
+        hi = ctx_hi = hunk[-1][2]
+        for i in range(context):
+            if ctx_hi == len(old):
+                break
+            ctx_hi = old.find('\n', ctx_hi)
+            ctx_hi = len(old) if ctx_hi == -1 else ctx_hi + 1
+        trailing = old[hi:ctx_hi].splitlines(True)
+
+        lines = [_diff_line(' ', line) for line in leading]
+        old_len = new_len = len(leading)
+        prev_hi = None
+        for _, block_lo, block_hi, old_lines, new_lines in hunk:
+            if prev_hi is not None:
+                between = old[prev_hi:block_lo].splitlines(True)
+                lines += [_diff_line(' ', line) for line in between]
+                old_len += len(between)
+                new_len += len(between)
+            lines += [_diff_line('-', line) for line in old_lines]
+            lines += [_diff_line('+', line) for line in new_lines]
+            old_len += len(old_lines)
+            new_len += len(new_lines)
+            prev_hi = block_hi
+        lines += [_diff_line(' ', line) for line in trailing]
+        old_len += len(trailing)
+        new_len += len(trailing)
+
+        old_start = first_line - len(leading)
+        new_start = old_start + line_delta
+        result.append('@@ -%s +%s @@\n'
+                      % (_format_range(old_start, old_start + old_len),
+                         _format_range(new_start, new_start + new_len)))
+        result += lines
+        line_delta += new_len - old_len
+    return ''.join(result)
+
+def get_edits(srcobj, dsttext):
+    """
+    Get the list of Edit instances turning srcobj into dsttext, as
+    recorded by Source.replace, or None if dsttext wasn't built that way
+    (in which case a textual diff is needed)
+    """
+    latest = srcobj.get_latest()
+    if latest.base is srcobj._str and latest._str == dsttext:
+        return latest.edits
+
+class DiffCollector:
+    """
+    The diffs generated by a run, keyed by the path of the changed file,
+    so that they can be emitted as a single patch, ordered by path,
+    rather than interleaved by whichever worker finished first
+    """
+    def __init__(self):
+        self.diffs = {} # map from path to diff text
+
+    def add(self, path, diff):
+        if diff:
+            self.diffs[path] = diff
+
+    def write(self, f):
+        """
+        Write all of the diffs to file-like object f, as one patch
+        """
+        for path in sorted(self.diffs):
+            f.write(self.diffs[path])
+
+    def write_split(self, cll, outdir):
+        """
+        Write one patch per ChangeLog directory into outdir,
+        returning the list of paths written
+        """
+        per_dir = {}
+        for path in sorted(self.diffs):
+            dir_ = cll.locate_dir(path)
+            per_dir.setdefault(dir_, []).append(self.diffs[path])
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        result = []
+        for dir_ in sorted(per_dir):
+            name = os.path.relpath(dir_, cll.basedir).replace('/', '_')
+            filename = os.path.join(outdir, '%s.patch' % name)
+            with open(filename, 'w') as f:
+                f.write(''.join(per_dir[dir_]))
+            result.append(filename)
+        return result
 
 def tabify_line(line):
     assert '\t' not in line
@@ -230,12 +1027,123 @@ def untabify(s):
     """
     return s.expandtabs(8)
 
+class Edit(namedtuple('Edit', ('start', 'end', 'replacement'))):
+    """
+    A replacement of text[start:end] by the given replacement
+    """
+    pass
+
+def compose_edits(edits, text, later):
+    """
+    Given "edits", a sorted list of non-overlapping Edit instances turning
+    some base string into str "text", and "later", a sorted list of
+    non-overlapping Edit instances in terms of "text", return a sorted
+    list of Edit instances turning the base string directly into the
+    result of applying "later" to "text".
+
+    Edits that overlap or touch are merged.
+    """
+    # Express the existing edits in terms of "text", as
+    # (start, end, delta) triples:
+    spans = []
+    delta = 0
+    for e in edits:
+        start = e.start + delta
+        end = start + len(e.replacement)
+        delta += len(e.replacement) - (e.end - e.start)
+        spans.append((start, end, delta))
+
+    result = []
+    i = j = 0
+    delta = 0 # delta due to the edits before the current position
+    while i < len(spans) or j < len(later):
+        # Start a cluster at whichever comes first:
+        if j == len(later) or (i < len(spans) and spans[i][0] < later[j].start):
+            if j == len(later) or spans[i][1] < later[j].start:
+                # An existing edit unaffected by the later edits:
+                result.append(edits[i])
+                delta = spans[i][2]
+                i += 1
+                continue
+            lo = spans[i][0]
+        else:
+            lo = later[j].start
+        base_lo = lo - delta
+        hi = lo
+        pieces = []
+        pos = lo
+        # Consume everything that overlaps or touches the cluster:
+        while True:
+            if i < len(spans) and spans[i][0] <= hi:
+                hi = max(hi, spans[i][1])
+                delta = spans[i][2]
+                i += 1
+            elif j < len(later) and later[j].start <= hi:
+                pieces.append(text[pos:later[j].start])
+                pieces.append(later[j].replacement)
+                pos = later[j].end
+                hi = max(hi, later[j].end)
+                j += 1
+            else:
+                break
+        pieces.append(text[pos:hi])
+        result.append(Edit(base_lo, hi - delta, ''.join(pieces)))
+    return result
+
+def apply_edits(text, edits):
+    """
+    Apply a sorted list of non-overlapping Edit instances to str text
+    """
+    pieces = []
+    pos = 0
+    for e in edits:
+        pieces.append(text[pos:e.start])
+        pieces.append(e.replacement)
+        pos = e.end
+    pieces.append(text[pos:])
+    return ''.join(pieces)
+
+def _common_prefix_len(a, b):
+    # Binary search, so that the comparisons happen a slice at a time:
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def diff_as_edits(old, new):
+    """
+    Get a list of Edit instances turning str old into str new, for when the
+    edits weren't recorded: a single edit spanning everything between the
+    common prefix and the common suffix
+    """
+    if old == new:
+        return []
+    prefix = _common_prefix_len(old, new)
+    suffix = _common_prefix_len(old[prefix:][::-1], new[prefix:][::-1])
+    return [Edit(prefix, len(old) - suffix, new[prefix:len(new) - suffix])]
+
 def get_last_match_multiline(pattern, text):
+    return run_regex(pattern, len(text), _get_last_match_multiline,
+                     pattern, text)
+
+def _get_last_match_multiline(pattern, text):
     m = None
     for m in re.finditer(pattern, text, re.MULTILINE | re.DOTALL):
         pass
     return m
 
+class WindowOverrun(Exception):
+    """
+    Raised by a Source with a window when a match starting within the
+    window runs past its end, so that the window can't be refactored
+    separately from what follows it
+    """
+    pass
+
 class Source:
     def __init__(self, s, filename=None, changes=None):
         self._str = s
@@ -248,6 +1156,62 @@ class Source:
         else:
             self.changes = set()
 
+        # self.base: the str that this Source was derived from,
+        # and self.edits: the list of Edit instances turning it into
+        # this one:
+        self.base = s
+        self.edits = []
+
+        # A 1-element list, shared by this Source and all those derived
+        # from it, holding the most recently derived one:
+        self._tip = [self]
+
+        # self.window: if set, a (start, end) pair restricting finditer,
+        # finditer_multiline and search to the matches that start within
+        # part of the string (for when a large file is split into chunks;
+        # see split_at_top_level):
+        self.window = None
+
+    def _derive(self, s, edits, changes=None):
+        """
+        Make a new Source from this one, tracking the edits made
+        """
+        result = Source(s, filename=self.filename, changes=changes)
+        result.base = self.base
+        result.edits = edits
+        result._tip = self._tip
+        if self.window:
+            # Assume that the changes were made within the window:
+            start, end = self.window
+            result.window = (start, end + len(s) - len(self._str))
+        self._tip[0] = result
+        return result
+
+    def _finditer_in_window(self, pattern, flags=0):
+        """
+        Generate the matches that start within the window, as a run over
+        the whole string would find them (so the string isn't cut short
+        at the end of the window, which would change what e.g. "$" and
+        lookaheads match there), raising WindowOverrun if one of them
+        runs past the end of the window
+        """
+        start, end = self.window
+        for m in re.compile(pattern, flags).finditer(self._str, start):
+            if m.start() >= end:
+                break
+            if m.end() > end:
+                raise WindowOverrun('%s: match at %i runs past the end of'
+                                    ' the window at %i'
+                                    % (self.filename, m.start(), end))
+            yield m
+
+    def get_latest(self):
+        """
+        Get the most recent Source derived from this one (or any of its
+        relatives) via replace or wrap
+        """
+        return self._tip[0]
+
     def str(self, as_tabs=0):
         # Convert to tab-based representation on output:
         if as_tabs:
@@ -277,23 +1241,59 @@ class Source:
                                        if ch.isspace()
                                        else '.'))
 
+    @timed('match')
     def finditer(self, pattern):
         """
         Return the matches in reverse order so that changes later on
         don't disturb indices into the string earlier on.
         """
-        return list(re.finditer(pattern, self._str))[::-1]
-
+        if self.window:
+            start, end = self.window
+            matches = run_regex(pattern, end - start, list,
+                                self._finditer_in_window(pattern))
+        else:
+            matches = run_regex(pattern, len(self._str), list,
+                                re.finditer(pattern, self._str))
+        add_count('matches', len(matches))
+        if current_events is not None:
+            self._record_matches(pattern, matches)
+        return matches[::-1]
+
+    @timed('match')
     def finditer_multiline(self, pattern):
         """
         Return the matches in reverse order so that changes later on
         don't disturb indices into the string earlier on.
         """
-        return list(re.finditer(pattern, self._str, re.MULTILINE | re.DOTALL))[::-1]
-
+        if self.window:
+            start, end = self.window
+            matches = run_regex(pattern, end - start, list,
+                                self._finditer_in_window(
+                                    pattern, re.MULTILINE | re.DOTALL))
+        else:
+            matches = run_regex(pattern, len(self._str), list,
+                                re.finditer(pattern, self._str,
+                                            re.MULTILINE | re.DOTALL))
+        add_count('matches', len(matches))
+        if current_events is not None:
+            self._record_matches(pattern, matches)
+        return matches[::-1]
+
+    def _record_matches(self, pattern, matches):
+        pattern = getattr(pattern, 'pattern', pattern)
+        current_events.extend(('match', pattern, m.start(), m.end())
+                              for m in matches)
+
+    @timed('match')
     def search(self, pattern):
-        return re.search(pattern, self._str)
-
+        if self.window:
+            start, end = self.window
+            return run_regex(pattern, end - start,
+                             next, self._finditer_in_window(pattern), None)
+        return run_regex(pattern, len(self._str),
+                         re.search, pattern, self._str)
+
+    @timed('replace', 'edits')
     def replace(self, from_idx, to_idx, replacement):
         # Inherit changes from before the replacement:
         changes = set([idx
@@ -307,12 +1307,21 @@ class Source:
         changes |= set([from_idx + len(replacement) + (idx - to_idx)
                         for idx in self.changes
                         if idx >= to_idx])
-        result =  Source(self._str[:from_idx] + replacement + self._str[to_idx:],
-                         filename=self.filename,
-                         changes=changes)
+        if not self.edits or to_idx < self.edits[0].start:
+            # Common case: refactorings tend to work backwards through the
+            # file, so this edit precedes all those so far:
+            edits = [Edit(from_idx, to_idx, replacement)] + self.edits
+        else:
+            edits = compose_edits(self.edits, self._str,
+                                  [Edit(from_idx, to_idx, replacement)])
+        result = self._derive(self._str[:from_idx] + replacement + self._str[to_idx:],
+                              edits, changes)
+        if current_events is not None:
+            current_events.append(('edit', from_idx, to_idx, replacement))
         #result.show_changes()
         return result
 
+    @timed('comment checks')
     def within_comment_at(self, idx):
         # Detect C++-style comments:
         line = self.get_line_at(idx)
@@ -331,6 +1340,7 @@ class Source:
         src = src[final_open_comment:]
         return '*/' not in src
 
+    @timed('string checks')
     def within_string_literal_at(self, idx):
         # Have we seen an odd number of quotes?
         within_quotes = False
@@ -350,7 +1360,14 @@ class Source:
             within_quotes = not within_quotes
         return within_quotes
 
+    @timed('scope', 'scope lookups')
     def get_change_scope_at(self, idx, raise_exception=False):
+        scope = self._get_change_scope_at(idx, raise_exception)
+        if current_events is not None:
+            current_events.append(('scope', idx, scope))
+        return scope
+
+    def _get_change_scope_at(self, idx, raise_exception=False):
         if self.filename:
             if self.filename.endswith('.md'):
                 return self._md_get_change_scope_at(idx, raise_exception)
@@ -498,11 +1515,17 @@ class Source:
             result.append( (line, touched) )
         return result
 
+    @timed('wrap')
     def wrap(self, just_changed=1, tabify_changes=1):
         # See http://www.gnu.org/prep/standards/standards.html#Formatting
         new_lines = []
         old_lines = self.get_changed_lines()
+        # Track the edits made, as replacements of whole lines:
+        line_edits = []
+        offset = 0
         for line, touched in old_lines:
+            orig_line = line
+            first_new_line = len(new_lines)
             if touched or not just_changed:
                 line = untabify(line)
                 while len(line) > 80:
@@ -530,7 +1553,15 @@ class Source:
                 if tabify_changes:
                     line = tabify(line)
             new_lines.append(line)
-        return Source(('\n'.join(new_lines)) + '\n')
+            if len(new_lines) > first_new_line + 1 or line != orig_line:
+                line_edits.append(
+                    Edit(offset, offset + len(orig_line),
+                         '\n'.join(new_lines[first_new_line:])))
+            offset += len(orig_line) + 1
+        if not self._str.endswith('\n'):
+            line_edits.append(Edit(len(self._str), len(self._str), '\n'))
+        return self._derive(('\n'.join(new_lines)) + '\n',
+                            compose_edits(self.edits, self._str, line_edits))
 
     def _get_split_point(self, line, max_length=80):
         """
@@ -615,27 +1646,787 @@ class Source:
         else:
             return line
 
-def refactor_file(path, relative_path, refactoring, printdiff,
-                  applychanges):
-    with open(path) as f:
-        srctext = f.read()
-        srcobj = Source(srctext, relative_path)
-    #print(src)
-    assert path.startswith('../src/gcc/')
-    dsttext, changelog = refactoring(relative_path, srcobj)
+class Chain:
+    """
+    A refactoring built from a list of refactorings ("stages"), which are
+    applied in turn to the same Source in memory, so that each file is
+    read, diffed and written just once.
+
+    Each stage sees the Source built by the previous one (so that the
+    edits made by the whole chain are still tracked), but with a fresh
+    set of changes, as if it were being run on its own.
+
+    The Changelog for each file is a StagedChangelog, with the entries
+    from all of the stages merged, or, with separate_changelogs, listed
+    stage by stage.
+
+    If there's a context, it is passed to the stages that take one (as a
+    third argument), so that refactorings written without one can still
+    be chained with those that use it.
+    """
+    def __init__(self, stages, separate_changelogs=False):
+        assert stages
+        self.stages = stages
+        self.separate_changelogs = separate_changelogs
+        self.takes_context = [takes_context(stage) for stage in stages]
+
+    def __call__(self, clog_filename, src, *context):
+        changelogs = []
+        for refactoring, takes in zip(self.stages, self.takes_context):
+            dsttext, changelog = refactoring(clog_filename, src,
+                                             *(context if takes else ()))
+            assert isinstance(changelog, Changelog)
+            changelogs.append(changelog)
+            latest = src.get_latest()
+            if latest._str == dsttext:
+                src = latest._derive(dsttext, latest.edits)
+            else:
+                # The stage didn't build its result via the Source, so
+                # we've lost track of the edits (and the final diff will
+                # have to be a textual one):
+                window = src.window
+                src = Source(dsttext, src.filename)
+                if window:
+                    start, end = window
+                    src.window = (start, end + len(dsttext) - len(latest._str))
+        return dsttext, StagedChangelog(clog_filename, changelogs,
+                                        self.separate_changelogs)
+
+def takes_context(refactoring):
+    """
+    Can the refactoring (a function, or a callable object such as a
+    Chain) be passed a context, as a third argument?
+    """
+    fn = refactoring
+    if not (inspect.isfunction(fn) or inspect.ismethod(fn)):
+        fn = getattr(fn, '__call__', None)
+        if not (inspect.isfunction(fn) or inspect.ismethod(fn)):
+            # (e.g. a functools.partial; assume that it does):
+            return True
+    args, varargs, keywords, defaults = inspect.getargspec(fn)
+    if inspect.ismethod(fn):
+        args = args[1:]
+    return varargs is not None or len(args) >= 3
+
+def refactor_text(srctext, relative_path, refactoring, context=None,
+                  window=None):
+    """
+    Run the refactoring on str srctext, returning a
+    (dsttext, Changelog, edits) triple, where edits is the list of
+    Edit instances turning srctext into dsttext, as recorded by
+    Source, or None if they weren't recorded.
+
+    If context is not None, it is passed to the refactoring as an
+    additional argument.
+
+    If window is not None, it is a (start, end) pair: only that part of
+    srctext is to be refactored (though the rest is available as context).
+    """
+    srcobj = Source(srctext, relative_path)
+    srcobj.window = window
+    with timing('refactor'):
+        if context is not None:
+            dsttext, changelog = refactoring(relative_path, srcobj, context)
+        else:
+            dsttext, changelog = refactoring(relative_path, srcobj)
     assert isinstance(changelog, Changelog)
     #print(dst)
 
-    if printdiff:
-        for line in unified_diff(srctext.splitlines(),
-                                 dsttext.splitlines(),
-                                 fromfile=path, tofile=path):
-            sys.stdout.write('%s\n' % line)
+    return dsttext, changelog, get_edits(srcobj, dsttext)
+
+def read_file(path):
+    with open(path) as f:
+        return f.read()
+
+# The process's umask (which can only be read by setting it, so this is
+# done once, before there are any other threads):
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+def write_file_atomically(path, text):
+    """
+    Replace the content of the file at path with text (or create it), by
+    writing to a temporary file alongside it and renaming that into place,
+    so that the file is never seen half-written
+    """
+    dirname, basename = os.path.split(path)
+    fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.%s.' % basename)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        if os.path.exists(path):
+            shutil.copymode(path, tmppath)
+        else:
+            # (mkstemp makes the file private; use the mode that open
+            # would have):
+            os.chmod(tmppath, 0666 & ~UMASK)
+        os.rename(tmppath, path)
+    except:
+        os.unlink(tmppath)
+        raise
+
+def prepend_to_file(path, texts):
+    """
+    Add the given strs to the start of the file at path, the last of them
+    first (as if each had been prepended in turn), rewriting it just once.
+
+    The new content is written to a temporary file alongside it, with the
+    old content streamed in after it (rather than read into memory), and
+    renamed into place, so that the file is never seen half-written.
+    """
+    dirname, basename = os.path.split(path)
+    fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.%s.' % basename)
+    try:
+        with os.fdopen(fd, 'w') as dst:
+            for text in reversed(texts):
+                dst.write(text)
+            with open(path) as src:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        shutil.copymode(path, tmppath)
+        os.rename(tmppath, path)
+    except:
+        os.unlink(tmppath)
+        raise
+
+def read_head(path, num_lines):
+    """
+    Read the start of the file at path: at least its first num_lines lines
+    (or all of it, if it's shorter)
+    """
+    chunks = []
+    newlines = 0
+    with open(path) as f:
+        while newlines < num_lines:
+            chunk = f.read(8192)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            newlines += chunk.count('\n')
+    return ''.join(chunks)
+
+def refactor_file(path, relative_path, refactoring, applychanges,
+                  context=None, srctext=None, srcdir='../src'):
+    """
+    Run the refactoring on the file at the given path (within the source
+    tree at srcdir), returning a FileResult
+
+    If context is not None, it is passed to the refactoring as an
+    additional argument.
+
+    If srctext is not None, it is used as the content of the file,
+    rather than reading it.
+    """
+    if srctext is None:
+        with timing('read'):
+            srctext = read_file(path)
+    #print(src)
+    dsttext, changelog, edits = refactor_text(srctext, relative_path,
+                                              refactoring, context)
+
+    gitpath = os.path.relpath(path, srcdir)
+    assert not gitpath.startswith('..')
+    if edits is not None:
+        diff = make_diff_from_edits(gitpath, srctext, edits)
+    else:
+        diff = make_diff(gitpath, srctext, dsttext)
+        edits = diff_as_edits(srctext, dsttext)
     if applychanges and srctext != dsttext:
-        with open(path, 'w') as f:
-            f.write(dsttext)
+        with timing('write'):
+            write_file_atomically(path, dsttext)
+
+    return FileResult(path, changelog, diff,
+                      base_id=get_blob_id(srctext), edits=edits,
+                      result_id=get_blob_id(dsttext))
+
+TOP_LEVEL_END_PATTERN = re.compile('^}.*\n', re.MULTILINE)
+
+def split_at_top_level(text, chunk_size):
+    """
+    Split str text into consecutive (start, end) windows of roughly
+    chunk_size characters, breaking only after lines starting with a
+    closing brace i.e. at the ends of top-level declarations
+    """
+    windows = []
+    start = 0
+    for m in TOP_LEVEL_END_PATTERN.finditer(text):
+        if m.end() - start >= chunk_size:
+            windows.append((start, m.end()))
+            start = m.end()
+    if start < len(text):
+        if windows and len(text) - start < chunk_size // 2:
+            # Don't bother with a small trailing chunk:
+            windows[-1] = (windows[-1][0], len(text))
+        else:
+            windows.append((start, len(text)))
+    return windows
+
+def stitch_chunks(chunks):
+    """
+    Combine the results of refactoring the chunks of a file into
+    the result for the whole file.
+
+    chunks is a list of (window, Changelog, edits) triples, ordered by
+    window.  Returns a (Changelog, edits) pair.
+
+    Since the refactorings work backwards through the source (see
+    Source.finditer), the ChangeLogs are combined last chunk first,
+    to give the same order as refactoring the file in one go.
+    """
+    changelog = chunks[0][1].make_empty()
+    for window, chunk_changelog, chunk_edits in reversed(chunks):
+        changelog.extend(chunk_changelog)
+    edits = []
+    for window, chunk_changelog, chunk_edits in chunks:
+        for e in chunk_edits:
+            assert not edits or edits[-1].end <= e.start
+            edits.append(e)
+    return changelog, edits
+
+def get_blob_id(text):
+    """
+    Get the id that git would use for a blob with the given content
+    """
+    return sha1('blob %i\0%s' % (len(text), text)).hexdigest()
+
+class FileResult:
+    """
+    The outcome of refactoring one file: the Changelog for it, together
+    with the text of the diff (if any), the git blob ids of the
+    original and refactored content, and the list of Edit instances
+    turning one into the other.
+
+    These are built within the worker processes and sent back to the
+    parent, which is responsible for all output.
+
+    If the run is being timed (see --report), timings is the Timings for
+    the refactoring of the file.  If there are Hooks, events is the list
+    of events recorded whilst refactoring it.
+    """
+    def __init__(self, path, changelog, diff, base_id=None, edits=None,
+                 result_id=None, timings=None, events=None):
+        self.path = path
+        self.changelog = changelog
+        self.diff = diff
+        self.base_id = base_id
+        self.edits = edits
+        self.result_id = result_id
+        self.timings = timings
+        self.events = events
+
+    def to_json(self):
+        return {'path': self.path,
+                'base': self.base_id,
+                'result': self.result_id,
+                'edits': [list(e) for e in self.edits],
+                'changelog': self.changelog.to_json()}
+
+    def to_record(self):
+        """
+        Get a compact form of this result, built from the types that
+        marshal supports
+        """
+        return (self.path,
+                self.changelog.to_json(),
+                self.diff,
+                self.base_id,
+                ([tuple(e) for e in self.edits]
+                 if self.edits is not None else None),
+                self.result_id,
+                self.timings.to_json() if self.timings else None,
+                self.events)
+
+    @staticmethod
+    def from_record(record):
+        path, changelog, diff, base_id, edits, result_id, timings, events = \
+            record
+        return FileResult(path, Changelog.from_json(changelog), diff,
+                          base_id=base_id,
+                          edits=([Edit(*e) for e in edits]
+                                 if edits is not None else None),
+                          result_id=result_id,
+                          timings=(Timings.from_json(timings)
+                                   if timings else None),
+                          events=events)
+
+    @staticmethod
+    def from_json(obj):
+        return FileResult(_from_json_str(obj['path']),
+                          Changelog.from_json(obj['changelog']),
+                          None,
+                          base_id=_from_json_str(obj['base']),
+                          edits=[Edit(start, end, _from_json_str(replacement))
+                                 for start, end, replacement in obj['edits']],
+                          result_id=_from_json_str(obj['result']))
+
+class Spool:
+    """
+    An alternative to sending FileResult instances back from the workers
+    through the pool's pipe (which pickles them): each worker appends
+    marshalled records to its own file within a spool directory,
+    returning just a (filename, offset, length) triple, and the parent
+    reads the records directly from mmap-ed views of those files.
+    """
+    def __init__(self):
+        self.dirname = tempfile.mkdtemp(prefix='refactor-spool-')
+        # Worker side: the file we're appending to, and the pid that owns it
+        # (to cope with being inherited via fork):
+        self._file = None
+        self._pid = None
+        # Parent side: map from filename to mmap:
+        self._maps = {}
+
+    def write(self, result):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._file = open(os.path.join(self.dirname,
+                                           '%i.spool' % self._pid), 'ab')
+        data = marshal.dumps(result.to_record())
+        offset = self._file.tell()
+        self._file.write(data)
+        # The parent must be able to see it as soon as we return:
+        self._file.flush()
+        return (self._file.name, offset, len(data))
+
+    def read(self, location):
+        filename, offset, length = location
+        m = self._maps.get(filename)
+        if m is None or offset + length > len(m):
+            # Not yet mapped, or the file has grown since:
+            if m is not None:
+                m.close()
+            with open(filename, 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[filename] = m
+        return FileResult.from_record(marshal.loads(buffer(m, offset, length)))
+
+    def close(self):
+        for m in self._maps.values():
+            m.close()
+        self._maps = {}
+        shutil.rmtree(self.dirname)
+
+class Profiler:
+    """
+    Profiling of the tasks within the worker processes, for --profile:
+    each worker runs its tasks under cProfile, and samples its stack
+    (every SAMPLE_INTERVAL seconds of CPU time, via SIGPROF) whilst doing
+    so, writing its accumulated stats and stack counts to its own files
+    within a directory after each task.  The parent merges them (see
+    merge) once the workers are done.
+    """
+    SAMPLE_INTERVAL = 0.001
+
+    def __init__(self):
+        self.dirname = tempfile.mkdtemp(prefix='refactor-profile-')
+        # Worker side: the profile and the map from folded stack to
+        # number of samples, and the pid that owns them (to cope with
+        # being inherited via fork):
+        self._profile = None
+        self._samples = None
+        self._pid = None
+        self._previous_handler = None
+
+    def run(self, fn, *args):
+        """
+        Call fn(*args), profiling it
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._profile = cProfile.Profile()
+            self._samples = {}
+            self._previous_handler = signal.signal(signal.SIGPROF,
+                                                   self._sample)
+            # (Restart system calls, e.g. reads, that the samples interrupt):
+            signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.SAMPLE_INTERVAL,
+                         self.SAMPLE_INTERVAL)
+        self._profile.enable()
+        try:
+            return fn(*args)
+        finally:
+            self._profile.disable()
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            self._write()
+
+    def _sample(self, signum, frame):
+        # Record the stack, outermost first, from just below run:
+        names = []
+        while frame and frame.f_code is not self.run.__func__.__code__:
+            code = frame.f_code
+            names.append('%s (%s:%i)' % (code.co_name,
+                                         os.path.basename(code.co_filename),
+                                         code.co_firstlineno))
+            frame = frame.f_back
+        if names:
+            stack = ';'.join(reversed(names))
+            self._samples[stack] = self._samples.get(stack, 0) + 1
+
+    def _write(self):
+        basename = os.path.join(self.dirname, '%i' % self._pid)
+        self._profile.dump_stats(basename + '.pstats')
+        with open(basename + '.folded', 'w') as f:
+            for stack, count in self._samples.iteritems():
+                f.write('%s %i\n' % (stack, count))
+
+    def merge(self, pstats_path, folded_path):
+        """
+        Merge the workers' stats into one pstats file, and their stacks
+        into one file of folded stacks (as used by flamegraph.pl)
+        """
+        filenames = sorted(os.listdir(self.dirname))
+        stats = None
+        samples = {}
+        for filename in filenames:
+            path = os.path.join(self.dirname, filename)
+            if filename.endswith('.pstats'):
+                if stats is None:
+                    stats = pstats.Stats(path)
+                else:
+                    stats.add(path)
+            elif filename.endswith('.folded'):
+                with open(path) as f:
+                    for line in f:
+                        stack, count = line.rsplit(' ', 1)
+                        samples[stack] = samples.get(stack, 0) + int(count)
+        if stats is not None:
+            stats.dump_stats(pstats_path)
+        with open(folded_path, 'w') as f:
+            for stack in sorted(samples):
+                f.write('%s %i\n' % (stack, samples[stack]))
+
+    def close(self):
+        if self._pid == os.getpid():
+            # (We sampled in this process too, e.g. when not using a
+            # pool):
+            signal.signal(signal.SIGPROF, self._previous_handler)
+            self._pid = None
+        shutil.rmtree(self.dirname)
+
+class Progress:
+    """
+    A status line for a run, on stderr: the tasks done out of the total,
+    the edits so far, the throughput, the ETA, and the file that has been
+    in progress the longest.
+
+    Each worker notes the task it is working on (and since when) in its
+    own slot of arrays in shared memory, which the parent reads whenever
+    it updates the line (every INTERVAL seconds, from a thread).  The
+    arrays are inherited by the workers, so the Progress must be made
+    before the pool is.
+    """
+    INTERVAL = 0.5
+
+    def __init__(self, tasks, out=sys.stderr):
+        self.out = out
+        self.paths = [get_task_path(task) for task in tasks]
+        self.num_tasks = len(tasks)
+        self.total_bytes = sum(get_task_size(task) for task in tasks)
+        self.done_tasks = 0
+        self.done_bytes = 0
+        self.edits = 0
+        self.start = monotonic()
+        # A slot per worker (as make_pool makes one per CPU), each
+        # holding the index within paths of the file being worked on (or
+        # -1), and the time at which work on it started:
+        num_slots = multiprocessing.cpu_count()
+        self._next_slot = multiprocessing.Value('i', 0)
+        self._indices = multiprocessing.RawArray('i', [-1] * num_slots)
+        self._starts = multiprocessing.RawArray('d', num_slots)
+        self._pid = None
+        self._slot = None
+        self._index = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    # Worker side:
+    def started(self, path):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            with self._next_slot.get_lock():
+                self._slot = self._next_slot.value
+                self._next_slot.value += 1
+            if self._slot >= len(self._indices):
+                # (A replacement for a worker that died; not shown):
+                self._slot = None
+            self._index = dict((path, i)
+                               for i, path in enumerate(self.paths))
+        if self._slot is not None:
+            self._starts[self._slot] = monotonic()
+            self._indices[self._slot] = self._index.get(path, -1)
+
+    def stopped(self):
+        if self._slot is not None:
+            self._indices[self._slot] = -1
+
+    # Parent side:
+    def begin(self):
+        """
+        Start updating the status line (this must be done after the
+        workers have been started, as the thread can't be handed to them)
+        """
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopping.wait(self.INTERVAL):
+            self.update()
+
+    def finished(self, task, result):
+        self.done_tasks += 1
+        self.done_bytes += get_task_size(task)
+        self.edits += len(result.edits or ())
+
+    def get_longest_running(self):
+        """
+        Get a (path, seconds) pair for the file that the workers have been
+        working on the longest, or None if they're idle
+        """
+        oldest = None
+        for index, start in zip(self._indices, self._starts):
+            if index >= 0 and (oldest is None or start < oldest[0]):
+                oldest = (start, self.paths[index])
+        if oldest is None:
+            return None
+        return oldest[1], monotonic() - oldest[0]
+
+    def get_line(self):
+        elapsed = monotonic() - self.start
+        rate = self.done_bytes / elapsed if elapsed else 0.0
+        if rate:
+            eta = '%is' % ((self.total_bytes - self.done_bytes) / rate)
+        else:
+            eta = '?'
+        line = ('%i/%i files, %i edits, %.1f MB/s, ETA %s'
+                % (self.done_tasks, self.num_tasks, self.edits,
+                   rate / (1024 * 1024), eta))
+        longest = self.get_longest_running()
+        if longest:
+            line += ', slowest: %s (%.1fs)' % longest
+        return line
+
+    def update(self):
+        # (Overwrite the line, clearing any remains of the previous one):
+        self.out.write('\r%s\x1b[K' % self.get_line())
+        self.out.flush()
+
+    def close(self):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join()
+            self.update()
+            self.out.write('\n')
+
+class RunLog:
+    """
+    A structured log of a run (see --log): a JSON line per event, with
+    one for each task (i.e. each file, or chunk of a file), as its result
+    is handled
+    """
+    def __init__(self, f):
+        self.f = f
+        self.start = monotonic()
+
+    def write(self, event, **fields):
+        fields.update(event=event, time=monotonic() - self.start)
+        self.f.write(_to_json_line(fields))
+
+    def close(self):
+        self.f.close()
+
+    def finished(self, task, result):
+        fields = {'path': result.path,
+                  'bytes': get_task_size(task),
+                  'edits': len(result.edits or ())}
+        if isinstance(task, tuple):
+            fields['chunk'] = list(task[1:])
+        if result.timings:
+            fields.update(seconds=result.timings.get_total(),
+                          phases=result.timings.phases,
+                          counters=result.timings.counters,
+                          pid=result.timings.pid)
+        self.write('task finished', **fields)
+
+def track_results(tasks, results, progress=None, log=None):
+    """
+    Generate the results for the tasks, noting each one in the Progress
+    and RunLog (if any) as it arrives
+    """
+    for task, result in izip(tasks, results):
+        if progress:
+            progress.finished(task, result)
+        if log:
+            log.finished(task, result)
+        yield result
+
+def get_task_path(task):
+    if isinstance(task, tuple):
+        return task[0]
+    return task
+
+def get_task_size(task):
+    """
+    Get the number of bytes that the task is to refactor
+    """
+    if isinstance(task, tuple):
+        path, start, end = task
+        return end - start
+    return os.path.getsize(task)
+
+class IOThreads:
+    """
+    Threads in the parent process that read the files ahead of the
+    workers, and write out the refactored files behind them, so that the
+    workers only have to compute.
+
+    The contents of each file that has been read are kept (in "texts")
+    until they are taken via take_text, for use in writing it out.
+    """
+    def __init__(self, num_threads, depth=None):
+        self.pool = ThreadPool(num_threads)
+        # How many tasks to read ahead of the one being handed out, and
+        # how many can be handed out before their results are consumed:
+        self.depth = depth if depth else 4 * num_threads
+        self._slots = threading.Semaphore(self.depth)
+        self._reads = {} # map from path to AsyncResult
+        self.texts = {} # map from path to str
+        self._writes = []
+
+    def read_ahead(self, tasks):
+        """
+        Generate (task, text) pairs for the given tasks, in order, where
+        text is the content of the file that the task is for.
 
-    return changelog
+        Pool.imap takes everything from its iterable as soon as it can,
+        so this blocks once depth tasks have been handed out whose
+        results haven't been taken from consuming, rather than reading
+        the whole tree into memory.
+        """
+        pending = deque()
+        for task in tasks:
+            path = get_task_path(task)
+            if path not in self._reads:
+                self._reads[path] = self.pool.apply_async(read_file, (path, ))
+            pending.append(task)
+            if len(pending) > self.depth:
+                yield self._get_read(pending.popleft())
+        while pending:
+            yield self._get_read(pending.popleft())
+
+    def _get_read(self, task):
+        self._slots.acquire()
+        path = get_task_path(task)
+        text = self._reads[path].get()
+        self.texts[path] = text
+        return task, text
+
+    def consuming(self, results):
+        """
+        Generate the results of the tasks from read_ahead, letting it hand
+        out another task as each one is taken
+        """
+        for result in results:
+            self._slots.release()
+            yield result
+
+    def take_text(self, path):
+        """
+        Get the content that was read for the given path (or None if it
+        wasn't read by us), forgetting it
+        """
+        self._reads.pop(path, None)
+        return self.texts.pop(path, None)
+
+    def write(self, path, text):
+        self._writes.append(self.pool.apply_async(write_file_atomically,
+                                                  (path, text)))
+
+    def close(self):
+        """
+        Wait for the writes to finish, raising any error from them
+        """
+        self.pool.close()
+        self.pool.join()
+        for result in self._writes:
+            result.get()
+
+############################################################################
+# Edit journals
+############################################################################
+# The files being refactored can contain arbitrary bytes, so we
+# round-trip them through JSON as latin-1:
+def _to_json_line(obj):
+    return json.dumps(obj, encoding='latin-1', sort_keys=True) + '\n'
+
+def _from_json_str(value):
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    return value
+
+class Journal:
+    """
+    A replayable record of a run: per file, the git blob id of the content
+    that was refactored, the edits made to it, and its Changelog,
+    stored as JSON lines.
+
+    This decouples the (expensive) analysis from applying the edits,
+    generating diffs, and building the ChangeLog entries.
+    """
+    VERSION = 1
+
+    def __init__(self, script, revision, srcdir, results,
+                 clogname='ChangeLog'):
+        self.script = script
+        self.revision = revision
+        self.srcdir = srcdir
+        self.results = results # list of FileResult, ordered by path
+        self.clogname = clogname
+
+    def write(self, f):
+        f.write(_to_json_line({'journal': self.VERSION,
+                               'script': self.script,
+                               'revision': self.revision,
+                               'srcdir': self.srcdir,
+                               'clogname': self.clogname}))
+        for result in self.results:
+            f.write(_to_json_line(result.to_json()))
+
+    @staticmethod
+    def read(f):
+        header = json.loads(f.readline())
+        if header.get('journal') != Journal.VERSION:
+            raise ValueError('unsupported journal version: %r'
+                             % header.get('journal'))
+        results = [FileResult.from_json(json.loads(line))
+                   for line in f
+                   if line.strip()]
+        return Journal(header['script'], header['revision'],
+                       _from_json_str(header['srcdir']), results,
+                       _from_json_str(header['clogname']))
+
+    @staticmethod
+    def merge(journals):
+        """
+        Combine the journals from several runs of the same refactoring
+        over disjoint sets of files (e.g. the shards of a --shard run)
+        into one
+        """
+        first = journals[0]
+        results = {}
+        for journal in journals:
+            for attr in ('script', 'revision', 'srcdir', 'clogname'):
+                if getattr(journal, attr) != getattr(first, attr):
+                    raise ValueError('journals differ in %s: %r vs %r'
+                                     % (attr, getattr(first, attr),
+                                        getattr(journal, attr)))
+            for result in journal.results:
+                if result.path in results:
+                    raise ValueError('%s appears in more than one journal'
+                                     % result.path)
+                results[result.path] = result
+        return Journal(first.script, first.revision, first.srcdir,
+                       [results[path] for path in sorted(results)],
+                       first.clogname)
 
 class Author(namedtuple('Author', ('name', 'email'))):
     pass
@@ -646,98 +2437,1423 @@ def get_revision():
 AUTHOR = Author('David Malcolm', 'dmalcolm@redhat.com')
 GIT_URL = 'https://github.com/davidmalcolm/gcc-refactoring-scripts'
 
-class ChangeSet:
-    def __init__(self, script, refactoring):
+def make_changelog_additions(cll, script, revision):
+    headertext = wrap(('Patch autogenerated by %s from\n'
+                       '%s\n'
+                       'revision %s')
+                      % (script, GIT_URL, revision))
+    today = date.today()
+    return ChangeLogAdditions(cll, today.isoformat(), AUTHOR, headertext)
+
+class BaseChangeSet:
+    """
+    The scheduling of the work for a run as tasks, and the accumulation of
+    their results, shared by ChangeSet and MultiTreeChangeSet: subclasses
+    provide do_one_path, do_one_chunk, stitch and add_result
+    """
+    def get_tasks(self, paths, split_threshold=None, chunk_size=None):
+        """
+        Get the list of tasks for the given paths: each is either a path,
+        or, for files larger than split_threshold, a (path, start, end)
+        triple for each chunk of the file.  The chunks are scheduled first,
+        so that the largest files don't finish last.
+        """
+        if not split_threshold:
+            return list(paths)
+        chunks = []
+        others = []
+        for path in paths:
+            if os.path.getsize(path) <= split_threshold:
+                others.append(path)
+                continue
+            with open(path) as f:
+                text = f.read()
+            windows = split_at_top_level(text, chunk_size or split_threshold)
+            if len(windows) < 2:
+                others.append(path)
+                continue
+            chunks += [(path, start, end) for start, end in windows]
+        return chunks + others
+
+    def do_one_task(self, task, srctext=None):
+        if self.profiler:
+            return self.profiler.run(self._do_one_recorded_task, task, srctext)
+        return self._do_one_recorded_task(task, srctext)
+
+    def _do_one_recorded_task(self, task, srctext):
+        if not self.record_events:
+            return self._do_one_timed_task(task, srctext)
+        # Record the events within the task, for the parent's Hooks:
+        events = [('file_started', os.getpid())]
+        previous = activate_events(events)
+        try:
+            result = self._do_one_timed_task(task, srctext)
+        finally:
+            activate_events(previous)
+        result.events = events
+        return result
+
+    def _do_one_timed_task(self, task, srctext):
+        if not self.timing:
+            return self._do_one_task(task, srctext)
+        # Record the timings for the task, charging whatever isn't within
+        # a more specific phase to "other":
+        timings = Timings(self.profile_regexes, self.profile_memory)
+        if self.profile_memory:
+            peak_rss = get_peak_rss()
+        previous = activate_timings(timings)
+        try:
+            with timings.phase('other'):
+                result = self._do_one_task(task, srctext)
+        finally:
+            activate_timings(previous)
+        if self.profile_memory:
+            # The worker's peak RSS so far, and how much this task raised it:
+            timings.peaks['rss'] = get_peak_rss()
+            timings.peaks['rss growth'] = timings.peaks['rss'] - peak_rss
+        result.timings = timings
+        return result
+
+    def _do_one_task(self, task, srctext):
+        if self.progress:
+            self.progress.started(get_task_path(task))
+        try:
+            if isinstance(task, tuple):
+                return self.do_one_chunk(*task, srctext=srctext)
+            return self.do_one_path(task, srctext)
+        finally:
+            if self.progress:
+                self.progress.stopped()
+
+    def add_results(self, tasks, results):
+        """
+        Accumulate the results for the given tasks, stitching together
+        the chunks of any files that were split
+        """
+        # map from path to list of (window, FileResult) pairs:
+        chunks = OrderedDict()
+        # (results may be an iterator, so that each result is handled,
+        # and written out, as soon as it arrives):
+        for task, result in izip(tasks, results):
+            if isinstance(task, tuple):
+                path, start, end = task
+                chunks.setdefault(path, []).append(((start, end), result))
+            else:
+                self.add_result(result)
+        for path, chunk_results in chunks.iteritems():
+            self.add_result(self.stitch(path, chunk_results))
+
+class ChangeSet(BaseChangeSet):
+    def __init__(self, script, refactoring, applychanges=True,
+                 context_factory=None, cll=None, srcdir='../src'):
+        self.script = script
         self.refactoring = refactoring
-        self.cll = ChangeLogLayout('../src')
-        revision = get_revision()
-        headertext = wrap(('Patch autogenerated by %s from\n'
-                           '%s\n'
-                           'revision %s')
-                          % (script, GIT_URL, revision))
-        today = date.today()
-        self.cla = ChangeLogAdditions(self.cll, today.isoformat(),
-                                      AUTHOR, headertext)
+        self.applychanges = applychanges
+        # If set, a callable returning the model used by the refactoring
+        # (e.g. Options or GimpleTypes) for the source tree (given its
+        # srcdir), passed to the refactoring as a 3rd argument; this is
+        # built once per process, by prepare:
+        self.context_factory = context_factory
+        self.context = None
+        self.srcdir = srcdir
+        self.cll = cll if cll else ChangeLogLayout(self.srcdir)
+        self.revision = get_revision()
+        self.cla = make_changelog_additions(self.cll, script, self.revision)
         self.changelogs = {} # map from path to changelog
-
-    def do_one_path(self, path):
+        self.diffs = DiffCollector()
+        self.results = {} # map from path to FileResult
+        # If set, a Spool through which workers return their results:
+        self.spool = None
+        # If set, IOThreads in the parent process, which read the files
+        # for the workers, and write out the results:
+        self.io = None
+        # If set, a callable returning the list of Rule instances for
+        # --survey (passed the context, if there is one), and the rules,
+        # once built by get_survey_rules:
+        self.survey_rules = None
+        self.rules = None
+        # map from path to list of other paths with the same content,
+        # whose results are copied from it (see dedup):
+        self.duplicates = {}
+        # If set, each task records a Timings (profiling the regexes and
+        # memory too, if profile_regexes and profile_memory are set), which
+        # add_result gathers (as a map from path to Timings):
+        self.timing = False
+        self.profile_regexes = False
+        self.profile_memory = False
+        self.timings = {}
+        # If set, each task records its events (see Hooks), which
+        # add_result passes to the hooks, in the parent (these are set
+        # after the pool has been made, as they needn't be picklable):
+        self.record_events = False
+        self.hooks = []
+        # If set, a Profiler for the tasks (see --profile):
+        self.profiler = None
+        # If set, the Progress of the run, for the workers to note which
+        # file they're working on:
+        self.progress = None
+
+    def do_one_path(self, path, srctext=None):
         """
         Refactor the given path.
 
         If we're using multiprocessing.Pool, this runs in a subprocess,
-        and hence we must avoid shared state.
+        and hence we must avoid shared state (and must not write to
+        stdout).
+
+        Return a FileResult, which the parent process can accumulate
+        within the ChangeSet instance via add_result.
 
-        Return a (path, Changelog) pair, which the parent process can
-        accumulate within the ChangeSet instance's changelogs dict.
+        If srctext is supplied, it is the content of the file, as read
+        by the parent's IOThreads, which then also write out the result.
         """
-        print(path)
         relative_path = self.cll.get_path_relative_to_changelog(path)
-        changelog = refactor_file(path,
-                                  relative_path,
-                                  self.refactoring,
-                                  printdiff=True,
-                                  applychanges=True)
-        assert isinstance(changelog, Changelog)
-        return path, changelog
+        self.prepare()
+        result = refactor_file(path,
+                               relative_path,
+                               self.refactoring,
+                               applychanges=(self.applychanges
+                                             and srctext is None),
+                               context=self.context,
+                               srctext=srctext,
+                               srcdir=self.srcdir)
+        assert isinstance(result.changelog, Changelog)
+        return result
+
+    def do_one_chunk(self, path, start, end, srctext=None):
+        """
+        Refactor the given window of the given path, without writing
+        anything, returning a FileResult for the chunk (without a diff).
+
+        Its edits are None if the refactoring touched anything outside
+        of the window, or matched something running past its end, in
+        which case the file has to be refactored as a whole.
+        """
+        relative_path = self.cll.get_path_relative_to_changelog(path)
+        self.prepare()
+        if srctext is None:
+            with timing('read'):
+                srctext = read_file(path)
+        try:
+            dsttext, changelog, edits = refactor_text(srctext, relative_path,
+                                                      self.refactoring,
+                                                      self.context,
+                                                      window=(start, end))
+        except WindowOverrun:
+            return FileResult(path, Changelog(relative_path), None,
+                              base_id=get_blob_id(srctext))
+        if edits is None:
+            edits = diff_as_edits(srctext, dsttext)
+        for e in edits:
+            if e.start < start or e.end > end:
+                edits = None
+                break
+        return FileResult(path, changelog, None,
+                          base_id=get_blob_id(srctext), edits=edits)
+
+    def dedup(self, paths):
+        """
+        Group the given paths by their content and their name relative to
+        their ChangeLog (which is all that the refactoring sees of them),
+        returning the paths that need refactoring: the first one in each
+        group.  The results for the others are copied from it by
+        add_result.
+        """
+        unique, self.duplicates = group_duplicates(paths, self.get_dedup_key)
+        return unique
+
+    def get_dedup_key(self, path):
+        # (Refactorings can depend on the name, e.g. to skip some files):
+        return (self.cll.get_path_relative_to_changelog(path),
+                get_blob_id(read_file(path)))
+
+    def copy_result(self, result, path):
+        """
+        Get a FileResult for path from the result for another file with
+        the same content, writing out the file (if we're applying changes)
+        """
+        srctext = read_file(path)
+        if get_blob_id(srctext) != result.base_id:
+            # The file changed since dedup; refactor it for itself:
+            return self.do_one_path(path)
+        changelog = result.changelog.for_file(
+            self.cll.get_path_relative_to_changelog(path))
+        if result.result_id == result.base_id:
+            return FileResult(path, changelog, '',
+                              base_id=result.base_id, edits=result.edits,
+                              result_id=result.result_id)
+        if self.applychanges:
+            self.write_file(path, apply_edits(srctext, result.edits))
+        return FileResult(path, changelog,
+                          make_diff_from_edits(os.path.relpath(path, self.srcdir),
+                                               srctext, result.edits),
+                          base_id=result.base_id, edits=result.edits,
+                          result_id=result.result_id)
+
+    def stitch(self, path, chunk_results):
+        """
+        Combine the results for the chunks of a file (a list of
+        (window, FileResult) pairs), writing out the result (if we're
+        applying changes), and returning the FileResult for the whole file
+        """
+        srctext = self.io.take_text(path) if self.io else None
+        if srctext is None:
+            srctext = read_file(path)
+        base_id = get_blob_id(srctext)
+        if any(result.edits is None or result.base_id != base_id
+               for window, result in chunk_results):
+            # Something touched the file outside of its chunk, or the
+            # file changed underneath us; refactor it as a whole:
+            sys.stderr.write('%s: unable to refactor in chunks\n' % path)
+            return self.do_one_path(path)
+        changelog, edits = stitch_chunks(
+            [(window, result.changelog, result.edits)
+             for window, result in sorted(chunk_results,
+                                          key=lambda item: item[0])])
+        dsttext = apply_edits(srctext, edits)
+        if self.applychanges and srctext != dsttext:
+            self.write_file(path, dsttext)
+        timings = events = None
+        if self.timing:
+            timings = Timings()
+            for window, result in chunk_results:
+                timings.add(result.timings)
+        if self.record_events:
+            events = []
+            for window, result in sorted(chunk_results,
+                                         key=lambda item: item[0]):
+                events += result.events
+        return FileResult(path, changelog,
+                          make_diff_from_edits(os.path.relpath(path, self.srcdir),
+                                               srctext, edits),
+                          base_id=base_id, edits=edits,
+                          result_id=get_blob_id(dsttext),
+                          timings=timings, events=events)
+
+    def get_survey_rules(self):
+        if self.rules is None:
+            self.prepare()
+            if self.context_factory:
+                self.rules = self.survey_rules(self.context)
+            else:
+                self.rules = self.survey_rules()
+        return self.rules
+
+    def survey_path(self, path):
+        """
+        Count the matches for each of the survey rules within the file at
+        path, returning a (path relative to the source tree, counts) pair
+        """
+        return (os.path.relpath(path, self.srcdir),
+                survey_text(self.cll.get_path_relative_to_changelog(path),
+                            read_file(path),
+                            self.get_survey_rules()))
+
+    def prepare(self):
+        """
+        Build the context for the refactoring, if it needs one and we
+        haven't already done so in this process
+        """
+        if self.context_factory and self.context is None:
+            self.context = self.context_factory(self.srcdir)
+
+    def contains(self, path):
+        """
+        Is path within our source tree?
+        """
+        return not os.path.relpath(path, self.srcdir).startswith('..')
+
+    def write_file(self, path, text):
+        if self.io:
+            self.io.write(path, text)
+        else:
+            write_file_atomically(path, text)
+
+    def add_result(self, result):
+        if self.io:
+            # If the file was read by our IOThreads, the worker left the
+            # writing of it to us:
+            srctext = self.io.take_text(result.path)
+            if (self.applychanges and srctext is not None
+                and result.base_id != result.result_id):
+                self.write_file(result.path,
+                                apply_edits(srctext, result.edits))
+        self.changelogs[result.path] = result.changelog
+        self.diffs.add(result.path, result.diff)
+        if result.timings:
+            self.timings[result.path] = result.timings
+        for hook in self.hooks:
+            for event in result.events or ():
+                getattr(hook, event[0])(result.path, *event[1:])
+            hook.file_finished(result)
+        if result.edits or result.changelog.scope_to_text:
+            self.results[result.path] = result
+        for path in self.duplicates.pop(result.path, ()):
+            self.add_result(self.copy_result(result, path))
 
     def build_changelog(self, clogname='ChangeLog'):
         for path in sorted(self.changelogs):
             self.cla.add_file(path, self.changelogs[path])
-        self.cla.apply(printdiff=True, clogname=clogname)
+        self.cla.apply(self.diffs, clogname=clogname,
+                       applychanges=self.applychanges)
+        for hook in self.hooks:
+            for dir_ in sorted(self.cla.text_per_dir):
+                hook.changelog_written(os.path.join(dir_, clogname),
+                                       self.cla.text_per_dir[dir_])
+
+    def get_journal(self, clogname='ChangeLog'):
+        return Journal(self.script, self.revision, self.srcdir,
+                       [self.results[path]
+                        for path in sorted(self.results)],
+                       clogname)
+
+class MultiTreeChangeSet(BaseChangeSet):
+    """
+    A ChangeSet for each of several source trees (e.g. checkouts of trunk
+    and of release branches), so that one pool of workers can refactor
+    the files of all of them, with each tree getting its own ChangeLog
+    entries and patch.
+
+    Files that have the same content at the same place in more than one
+    tree are only refactored once (see dedup).
+    """
+    def __init__(self, changesets):
+        self.changesets = changesets
+        self.refactoring = changesets[0].refactoring
+        self.spool = None
+        self.io = None
+        # map from path to list of other paths with the same content,
+        # whose results are copied from it:
+        self.duplicates = {}
+        # If set, each task records a Timings (gathered by the ChangeSet
+        # for its tree), profiling the regexes and memory too if
+        # profile_regexes and profile_memory are set:
+        self.timing = False
+        self.profile_regexes = False
+        self.profile_memory = False
+        # If set, each task records its events (passed to the Hooks by the
+        # ChangeSet for its tree):
+        self.record_events = False
+        # If set, a Profiler for the tasks, and the Progress of the run:
+        self.profiler = None
+        self.progress = None
+
+    def get_changeset(self, path):
+        for cs in self.changesets:
+            if cs.contains(path):
+                return cs
+        raise ValueError('%s is not within any of the source trees' % path)
+
+    def dedup(self, paths, by_content=False):
+        """
+        Group the given paths by their location within their tree and
+        their key for ChangeSet.dedup, returning the paths that need
+        refactoring.
+
+        If by_content is true, group them just by the latter, as for
+        ChangeSet.dedup.
+        """
+        def get_key(path):
+            cs = self.get_changeset(path)
+            key = cs.get_dedup_key(path)
+            if by_content:
+                return key
+            return (os.path.relpath(path, cs.srcdir), ) + key
+        unique, self.duplicates = group_duplicates(paths, get_key)
+        return unique
+
+    def prepare(self):
+        for cs in self.changesets:
+            cs.prepare()
+
+    def do_one_path(self, path, srctext=None):
+        return self.get_changeset(path).do_one_path(path, srctext)
+
+    def do_one_chunk(self, path, start, end, srctext=None):
+        return self.get_changeset(path).do_one_chunk(path, start, end, srctext)
+
+    def stitch(self, path, chunk_results):
+        return self.get_changeset(path).stitch(path, chunk_results)
+
+    def add_result(self, result):
+        self.get_changeset(result.path).add_result(result)
+        for path in self.duplicates.pop(result.path, ()):
+            cs = self.get_changeset(path)
+            cs.add_result(cs.copy_result(result, path))
+
+    def build_changelog(self, clogname='ChangeLog'):
+        for cs in self.changesets:
+            cs.build_changelog(clogname)
+
+def group_duplicates(paths, get_key):
+    """
+    Group paths by get_key(path) (e.g. the blob id of the file's content),
+    returning a (unique, duplicates) pair: the list of the first path
+    for each key, and a dict mapping from each of these to the list of
+    the other paths with the same key
+    """
+    first_path = {} # map from key to path
+    unique = []
+    duplicates = {}
+    for path in paths:
+        key = get_key(path)
+        if key in first_path:
+            duplicates.setdefault(first_path[key], []).append(path)
+        else:
+            first_path[key] = path
+            unique.append(path)
+    return unique, duplicates
 
 # multiprocessing.Pool uses pickle, which can't cope with
 # instance methods, lambdas, or nested functions.  Hence we have to do
-# this via functions and globals, alas:
+# this via functions and globals, alas.  The ChangeSet is handed to each
+# worker once, via the pool's initializer, which also builds the
+# refactoring's context, once per worker.
 global_cs = None
-def do_one_path(path):
-    return global_cs.do_one_path(path)
+def init_worker(cs):
+    global global_cs
+    global_cs = cs
+    # (We inherit the parent's Timings for --report; the tasks record
+    # their own):
+    activate_timings(None)
+    cs.prepare()
+
+def do_one_task(task):
+    return return_result(global_cs.do_one_task(task))
+
+def do_one_task_with_text(item):
+    """
+    As do_one_task, for a (task, text) pair from IOThreads.read_ahead
+    """
+    task, srctext = item
+    return return_result(global_cs.do_one_task(task, srctext))
+
+def survey_path(path):
+    return global_cs.survey_path(path)
+
+def return_result(result):
+    if global_cs.spool:
+        return global_cs.spool.write(result)
+    return result
+
+############################################################################
+# Surveys
+############################################################################
+class Rule(namedtuple('Rule', ('name', 'pattern', 'literal', 'guard'))):
+    """
+    Something that a refactoring looks for, for use by --survey: a regex
+    pattern, and, optionally:
+      - literal: a string that any match must contain (to quickly skip
+        files that can't match)
+      - guard: a callable, called as guard(clog_filename, src, m) for
+        each match, returning False for those that the refactoring
+        would leave alone
+    """
+    def __new__(cls, name, pattern, literal=None, guard=None):
+        return super(Rule, cls).__new__(cls, name, re.compile(pattern),
+                                        literal, guard)
+
+def survey_text(clog_filename, text, rules):
+    """
+    Count the matches for each of the rules within str text, returning
+    a list of counts
+    """
+    counts = []
+    src = None
+    for rule in rules:
+        count = 0
+        if rule.literal is None or rule.literal in text:
+            for m in rule.pattern.finditer(text):
+                if rule.guard:
+                    if src is None:
+                        src = Source(text, clog_filename)
+                    if not rule.guard(clog_filename, src, m):
+                        continue
+                count += 1
+        counts.append(count)
+    return counts
+
+def write_survey(out, format, rule_names, counts_by_path):
+    """
+    Write the results of a survey to out, as CSV or JSON: the counts for
+    each rule within each file (counts_by_path being a dict mapping from
+    path to list of counts), and their totals within each directory.
+    Files and directories without any matches are omitted.
+    """
+    files = dict((path, counts)
+                 for path, counts in counts_by_path.iteritems()
+                 if any(counts))
+    dirs = {}
+    for path, counts in files.iteritems():
+        dir_ = os.path.dirname(path)
+        if dir_ in dirs:
+            dirs[dir_] = [a + b for a, b in zip(dirs[dir_], counts)]
+        else:
+            dirs[dir_] = list(counts)
+    if format == 'csv':
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(['path'] + rule_names)
+        for path in sorted(files):
+            writer.writerow([path] + files[path])
+        # The directories' totals, with a trailing slash:
+        for dir_ in sorted(dirs):
+            writer.writerow([dir_ + '/'] + dirs[dir_])
+    else:
+        def sparse(counts):
+            return OrderedDict((name, count)
+                               for name, count in zip(rule_names, counts)
+                               if count)
+        json.dump(OrderedDict([('rules', rule_names),
+                               ('files', OrderedDict((path, sparse(files[path]))
+                                                     for path in sorted(files))),
+                               ('dirs', OrderedDict((dir_, sparse(dirs[dir_]))
+                                                    for dir_ in sorted(dirs)))]),
+                  out, indent=1)
+        out.write('\n')
+
+############################################################################
+# Estimation
+############################################################################
+def get_stratum(cll, path):
+    """
+    Get the stratum for a file when sampling: its ChangeLog directory,
+    and the power of 4 of its size
+    """
+    size = os.path.getsize(path)
+    # (In integers, as math.log puts some exact powers in the bucket
+    # below):
+    return (cll.locate_dir(path), (size.bit_length() - 1) // 2 if size else 0)
+
+def stratified_sample(cll, paths, sample_size, rng=random):
+    """
+    Pick about sample_size of the paths at random, in proportion to the
+    number in each stratum (see get_stratum), but at least one from each.
+    Returns a dict mapping from stratum to a (paths, sample) pair.
+    """
+    strata = {}
+    for path in paths:
+        strata.setdefault(get_stratum(cll, path), []).append(path)
+    result = {}
+    for stratum, stratum_paths in strata.iteritems():
+        count = int(round(sample_size * len(stratum_paths) / float(len(paths))))
+        count = min(max(count, 1), len(stratum_paths))
+        result[stratum] = (stratum_paths, rng.sample(stratum_paths, count))
+    return result
+
+def estimate(cs, paths, sample_size, out, rng=random, num_workers=None):
+    """
+    Run the ChangeSet's refactoring (without writing anything) on a
+    stratified sample of the paths, writing to out a projection of how
+    long the full run would take, and how much it would change.
+
+    Returns a dict of the projected totals.
+    """
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    strata = stratified_sample(cs.cll, paths, sample_size, rng)
+    start = time.time()
+    # Build the refactoring's context up front, so as not to count it
+    # against the first file (each worker builds it once):
+    cs.prepare()
+    prepare_time = time.time() - start
+    times = [] # list of (seconds, path) pairs
+    dirs = set()
+    # Per-quantity lists of (stratum size, list of sampled values):
+    observations = {'time': [], 'edits': [], 'files': []}
+    for stratum in sorted(strata):
+        stratum_paths, sample = strata[stratum]
+        values = {'time': [], 'edits': [], 'files': []}
+        for path in sample:
+            t0 = time.time()
+            # (As the text is passed in, this doesn't write the file):
+            result = cs.do_one_path(path, read_file(path))
+            elapsed = time.time() - t0
+            times.append((elapsed, path))
+            values['time'].append(elapsed)
+            values['edits'].append(len(result.edits))
+            values['files'].append(1 if result.edits else 0)
+            if result.changelog.scope_to_text:
+                dirs.add(cs.cll.locate_dir(path))
+        for name in observations:
+            observations[name].append((len(stratum_paths), values[name]))
+
+    def project(observations):
+        """
+        Get the projected total, and the half-width of its (roughly) 95%
+        confidence interval
+        """
+        total = 0.0
+        variance = 0.0
+        for stratum_size, values in observations:
+            n = len(values)
+            mean = sum(values) / float(n)
+            total += stratum_size * mean
+            if n > 1:
+                var = sum((v - mean) ** 2 for v in values) / (n - 1)
+                variance += (stratum_size ** 2 * (1 - n / float(stratum_size))
+                             * var / n)
+        return total, 1.96 * math.sqrt(variance)
+
+    projected = dict((name, project(observations[name]))
+                     for name in observations)
+    out.write('sampled %i of %i files (%i strata) in %.1fs\n'
+              % (len(times), len(paths), len(strata), time.time() - start))
+    total_time, error = projected['time']
+    out.write('projected time: %.1fs +/- %.1fs serial'
+              ' (about %.1fs with %i worker(s))\n'
+              % (total_time, error, total_time / num_workers, num_workers))
+    if cs.context_factory:
+        out.write('plus %.1fs per worker to build the context\n'
+                  % prepare_time)
+    out.write('projected edits: %i +/- %i, in %i +/- %i files\n'
+              % (projected['edits'] + projected['files']))
+    out.write('ChangeLog directories touched by the sample: %s\n'
+              % (', '.join(os.path.relpath(dir_, cs.srcdir)
+                           for dir_ in sorted(dirs))
+                 if dirs else '(none)'))
+    out.write('slowest files in the sample:\n')
+    for elapsed, path in sorted(times, reverse=True)[:5]:
+        out.write('  %8.3fs  %s (%i bytes)\n'
+                  % (elapsed, path, os.path.getsize(path)))
+    projected['dirs'] = sorted(dirs)
+    return projected
+
+############################################################################
+# Run reports
+############################################################################
+def make_report(script, elapsed, run_timings, timings_by_path, top=20):
+    """
+    Build the --report for a run, as a dict: the elapsed time, the
+    parent's Timings for the phases of the run as a whole, the Timings
+    for the refactoring of each file (from the workers), totalled, and
+    the top slowest files
+    """
+    totals = Timings()
+    for timings in timings_by_path.itervalues():
+        totals.add(timings)
+    slowest = sorted(timings_by_path.iteritems(),
+                     key=lambda item: (-item[1].get_total(), item[0]))[:top]
+    return {'script': script,
+            'elapsed': elapsed,
+            'run': run_timings.to_json(),
+            'files': dict(totals.to_json(),
+                          count=len(timings_by_path),
+                          total=totals.get_total()),
+            'slowest': [dict(timings.to_json(), path=path,
+                             total=timings.get_total())
+                        for path, timings in slowest]}
+
+def write_regex_profile(out, regexes, top=None):
+    """
+    Write a table of the regexes profiled by --profile-regexes (as the
+    regexes of a Timings), costliest first
+    """
+    out.write('%8s %10s %10s %10s  %s\n'
+              % ('calls', 'seconds', 'MB', 'worst', 'pattern'))
+    for pattern, (calls, seconds, num_bytes, worst) in \
+            sorted(regexes.iteritems(),
+                   key=lambda item: (-item[1][1], item[0]))[:top]:
+        text = repr(pattern)
+        if len(text) > 60:
+            text = text[:57] + '...'
+        out.write('%8i %10.3f %10.1f %10.4f  %s\n'
+                  % (calls, seconds, num_bytes / 1e6, worst, text))
+
+def write_memory_profile(out, timings_by_path, top=None):
+    """
+    Write tables of the memory usage sampled by --profile-memory, given
+    the Timings for each file: the peak RSS of each worker, the files
+    that raised their worker's peak the most (and the phase in which
+    the RSS was highest for them), and the highest RSS in each phase
+    """
+    MB = 1024.0 * 1024.0
+    workers = {} # map from pid to [peak RSS, number of files]
+    phases = Timings(memory=True)
+    for timings in timings_by_path.itervalues():
+        worker = workers.setdefault(timings.pid, [0, 0])
+        worker[0] = max(worker[0], timings.peaks.get('rss', 0))
+        worker[1] += 1
+        phases.add(timings)
+
+    out.write('peak RSS per worker:\n')
+    out.write('%8s %10s %8s\n' % ('pid', 'MB', 'files'))
+    for pid, (peak, num_files) in sorted(workers.iteritems(),
+                                         key=lambda item: -item[1][0]):
+        out.write('%8i %10.1f %8i\n' % (pid, peak / MB, num_files))
+
+    out.write("files raising their worker's peak RSS the most:\n")
+    out.write('%10s %10s  %-16s %s\n'
+              % ('growth MB', 'peak MB', 'phase', 'path'))
+    for path, timings in sorted(
+            timings_by_path.iteritems(),
+            key=lambda item: (-item[1].peaks.get('rss growth', 0),
+                              -max(item[1].memory.values() or [0]),
+                              item[0]))[:top]:
+        phase = max(sorted(timings.memory), key=timings.memory.get) \
+            if timings.memory else ''
+        out.write('%10.1f %10.1f  %-16s %s\n'
+                  % (timings.peaks.get('rss growth', 0) / MB,
+                     timings.peaks.get('rss', 0) / MB,
+                     phase, path))
+
+    out.write('highest RSS per phase:\n')
+    out.write('%10s  %s\n' % ('MB', 'phase'))
+    for phase, rss in sorted(phases.memory.iteritems(),
+                             key=lambda item: (-item[1], item[0])):
+        out.write('%10.1f  %s\n' % (rss / MB, phase))
+
+def write_report(f, report):
+    json.dump(report, f, encoding='latin-1', indent=1, separators=(',', ': '),
+              sort_keys=True)
+    f.write('\n')
+
+############################################################################
+# Watch mode
+############################################################################
+class Inotify:
+    """
+    A minimal wrapper around Linux's inotify API, via ctypes
+    """
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+
+    EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.dirs = {} # map from watch descriptor to path
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.dirs[wd] = path
+
+    def read_events(self, timeout=None):
+        """
+        Wait for events (for up to timeout seconds, if given), returning
+        a list of (path, mask) pairs, where path is the path of the file
+        (or directory) within the watched directory
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as err:
+            if err.errno == errno.EINTR:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = \
+                self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if wd in self.dirs:
+                events.append((os.path.join(self.dirs[wd], name), mask))
+            elif mask & self.IN_Q_OVERFLOW:
+                events.append((None, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+# (Modules imported from the current directory have a __file__ relative
+# to it, i.e. to the directory that we started in):
+START_DIR = os.getcwd()
+
+def get_source_path(module):
+    """
+    Get the absolute path to the source of a module, or None if it
+    doesn't have one (e.g. a builtin one)
+    """
+    path = getattr(module, '__file__', None)
+    if path is None:
+        return None
+    if path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    return os.path.normpath(os.path.join(START_DIR, path))
+
+def get_local_modules(namespace, dirname):
+    """
+    Get a map from name to module for the modules within dirname that
+    code with the given globals imports, directly or indirectly (going
+    by the modules, functions and classes that they refer to)
+    """
+    modules = {}
+    pending = [namespace]
+    while pending:
+        for value in pending.pop().values():
+            if not isinstance(value, types.ModuleType):
+                value = sys.modules.get(getattr(value, '__module__', None))
+            if (value is None or value.__name__ == '__main__'
+                or value.__name__ in modules):
+                continue
+            path = get_source_path(value)
+            if path and os.path.dirname(path) == dirname:
+                modules[value.__name__] = value
+                pending.append(vars(value))
+    return modules
+
+def get_script_dependencies(path, modules):
+    """
+    Get the paths to a script, to refactor.py, and to the source files
+    of the given modules (e.g. those that the script imports, from
+    get_local_modules), i.e. the files whose changes the script needs
+    reloading for
+    """
+    paths = set([os.path.abspath(path), get_source_path(sys.modules[__name__])])
+    for module in modules.values():
+        paths.add(get_source_path(module))
+    return paths
+
+class Watcher:
+    """
+    Re-run a ChangeSet's refactoring on files below the gcc directory of
+    its source tree as they are modified, without touching them, writing
+    the diff for each file to "out" whenever it changes (so that the
+    diffs show what the refactoring still disagrees with).
+
+    If anything in script_paths (by default, the script, refactor.py and
+    the modules alongside the script that it imports) changes, the
+    process is re-executed with argv, to pick up the new rules.
+    """
+    FILE_EVENTS = Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO
+    DIR_EVENTS = FILE_EVENTS | Inotify.IN_CREATE
+
+    def __init__(self, cs, argv, path_filter, skip_testsuite=False,
+                 script_paths=None, out=sys.stdout):
+        self.cs = cs
+        self.argv = argv
+        self.path_filter = path_filter
+        self.skip_testsuite = skip_testsuite
+        self.out = out
+        self.inotify = Inotify()
+        if script_paths is None:
+            script = os.path.abspath(argv[0])
+            modules = get_local_modules(vars(sys.modules['__main__']),
+                                        os.path.dirname(script))
+            script_paths = get_script_dependencies(script, modules)
+        self.script_paths = set(os.path.abspath(path)
+                                for path in script_paths)
+        for dirname in set(os.path.dirname(path)
+                           for path in self.script_paths):
+            self.inotify.add_watch(dirname, self.FILE_EVENTS)
+        self.gccdir = os.path.join(cs.srcdir, 'gcc')
+        for dirpath, dirnames, filenames in os.walk(self.gccdir):
+            if self.skip_testsuite and 'testsuite' in dirnames:
+                dirnames.remove('testsuite')
+            self.inotify.add_watch(dirpath, self.DIR_EVENTS)
+        # Per-file caches of the results, and of the diffs we've shown:
+        self.results = dict(cs.results)
+        self.diffs = dict(cs.diffs.diffs)
+
+    def run(self):
+        sys.stderr.write('watching %s for changes...\n' % self.gccdir)
+        while True:
+            events = self.inotify.read_events()
+            # Wait for the rest of a burst of events (e.g. from an editor
+            # saving several files):
+            while events:
+                more = self.inotify.read_events(0.1)
+                if not more:
+                    break
+                events += more
+            self.handle_events(events)
+
+    def handle_events(self, events):
+        paths = []
+        for path, mask in events:
+            if path is None:
+                sys.stderr.write('too many changes at once; rerunning\n')
+                self.restart()
+            if os.path.abspath(path) in self.script_paths:
+                sys.stderr.write('%s changed; rerunning\n' % path)
+                self.restart()
+            if mask & Inotify.IN_ISDIR:
+                if mask & Inotify.IN_CREATE:
+                    if not (self.skip_testsuite
+                            and os.path.basename(path) == 'testsuite'):
+                        self.inotify.add_watch(path, self.DIR_EVENTS)
+                continue
+            if path not in paths and self.path_filter(path):
+                paths.append(path)
+        for path in sorted(paths):
+            self.update(path)
+
+    def update(self, path):
+        """
+        Refactor the file at path, reporting any change to its diff
+        """
+        try:
+            srctext = read_file(path)
+        except IOError:
+            # (e.g. it's already been deleted again):
+            return
+        result = self.results.get(path)
+        if not result or result.base_id != get_blob_id(srctext):
+            # (As the text is passed in, this doesn't write the file):
+            result = self.cs.do_one_path(path, srctext)
+            self.results[path] = result
+        diff = result.diff if result.diff else ''
+        if diff == self.diffs.get(path, ''):
+            return
+        self.diffs[path] = diff
+        if diff:
+            sys.stderr.write('%s: changed\n' % path)
+            self.out.write(diff)
+            self.out.flush()
+        else:
+            sys.stderr.write('%s: nothing left to do\n' % path)
+
+    def restart(self):
+        self.inotify.close()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execv(sys.executable, [sys.executable] + self.argv)
 
 def c_and_h_files(path):
     return (os.path.isfile(path)
             and (path.endswith('.c') or
                  path.endswith('.h')))
 
+def find_paths(skip_testsuite=False, path_filter=c_and_h_files,
+               srcdir='../src'):
+    """
+    Gather paths from a checkout of gcc, by default a sister-directory
+    checkout in "../src"
+    """
+    paths = []
+    def visit(arg, dirname, names):
+        if skip_testsuite:
+            if 'testsuite' in names:
+                names.remove('testsuite')
+        for name in sorted(names):
+            path = os.path.join(dirname, name)
+            if path_filter(path):
+                paths.append(path)
+    os.path.walk(os.path.join(srcdir, 'gcc'), visit, None)
+    return paths
+
+def parse_shard(arg):
+    """
+    Parse a "--shard I/N" argument, returning an (I, N) pair
+    """
+    m = re.match(r'^([0-9]+)/([0-9]+)$', arg)
+    if not m:
+        raise argparse.ArgumentTypeError('expected I/N, got %r' % arg)
+    index, count = int(m.group(1)), int(m.group(2))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('shard %i is not within 1..%i'
+                                         % (index, count))
+    return index, count
+
+def get_shard(paths, shard):
+    """
+    Get the deterministic slice of the paths for the given (I, N) shard.
+
+    The paths are dealt out round-robin in sorted order, so that big
+    directories are spread across the shards.
+    """
+    index, count = shard
+    return sorted(paths)[index - 1::count]
+
+def parse_args(argv):
+    argp = argparse.ArgumentParser(description='Apply a refactoring to GCC')
+    argp.add_argument('--patch', metavar='FILE', default=None,
+                      help=('write the combined patch to FILE'
+                            ' (default: stdout)'))
+    argp.add_argument('--split-patches', metavar='DIR', default=None,
+                      help='write one patch per ChangeLog directory into DIR')
+    argp.add_argument('--journal', metavar='FILE', default=None,
+                      help=('write an edit journal to FILE, for use by'
+                            ' edit_journal.py'))
+    argp.add_argument('--report', metavar='FILE', default=None,
+                      help=('write a JSON report on where the time went to'
+                            ' FILE: per phase of the run, and per phase of'
+                            ' refactoring each file, with counts of the'
+                            ' matches, edits and scope lookups'))
+    argp.add_argument('--report-top', metavar='N', type=int, default=20,
+                      help=('how many of the slowest files to list in the'
+                            ' --report (default: %(default)s)'))
+    argp.add_argument('--profile-regexes', metavar='N', type=int,
+                      nargs='?', const=20, default=None,
+                      help=('profile the regexes run by the refactoring,'
+                            ' writing the N costliest (default: 20), with'
+                            ' their call counts, times and bytes scanned,'
+                            ' to stderr at the end of the run'))
+    argp.add_argument('--profile-memory', metavar='N', type=int,
+                      nargs='?', const=20, default=None,
+                      help=('sample the memory used by the workers,'
+                            ' writing the peak RSS of each worker, the N'
+                            ' files (default: 20) that raised it the most,'
+                            ' and the highest RSS in each phase of the'
+                            ' refactoring, to stderr at the end of the run'))
+    argp.add_argument('--profile', metavar='PREFIX', default=None,
+                      help=('profile the refactoring of the files within'
+                            ' the workers, writing the merged cProfile'
+                            ' stats to PREFIX.pstats, and the sampled'
+                            ' stacks, folded (for flamegraph.pl), to'
+                            ' PREFIX.folded'))
+    argp.add_argument('--no-progress', action='store_false', default=True,
+                      dest='progress',
+                      help=("don't show the status line of the run on"
+                            " stderr (it is only shown if that's a"
+                            " terminal)"))
+    argp.add_argument('--log', metavar='FILE', default=None,
+                      help=('write a log of the run to FILE, as JSON lines,'
+                            ' with one for each file (or chunk of a file)'
+                            ' giving its size, edits and timings'))
+    argp.add_argument('--dry-run', action='store_true', default=False,
+                      help="don't modify any files")
+    argp.add_argument('--split-threshold', metavar='BYTES', type=int,
+                      default=None,
+                      help=('split files larger than this at top-level'
+                            ' declarations, and refactor the chunks'
+                            ' concurrently (falling back to refactoring'
+                            ' the file as a whole if a match or an edit'
+                            ' runs across the chunks)'))
+    argp.add_argument('--chunk-size', metavar='BYTES', type=int,
+                      default=256 * 1024,
+                      help='approximate size of the chunks of split files')
+    argp.add_argument('--transport', choices=('pipe', 'spool'),
+                      default='pipe',
+                      help=('how workers return their results: pickled'
+                            ' through the pool (the default), or via'
+                            ' mmap-ed spool files'))
+    argp.add_argument('--io-threads', metavar='N', type=int, default=0,
+                      help=('read the files ahead of the workers, and write'
+                            ' out the results, using N threads in the'
+                            ' parent process'))
+    argp.add_argument('--srcdir', metavar='DIR', action='append',
+                      dest='srcdirs', default=None,
+                      help=('the gcc checkout to refactor (default: ../src);'
+                            ' give it several times to refactor several'
+                            ' checkouts in one run, in which case the'
+                            ' --patch and --journal FILEs must contain'
+                            ' "%%s", for the name of each checkout\'s'
+                            ' directory'))
+    argp.add_argument('--dedup', action='store_true', default=False,
+                      help=('refactor each distinct file content just'
+                            ' once, copying the result to the other files'
+                            ' with that content and the same name relative'
+                            ' to their ChangeLog'))
+    argp.add_argument('--survey', choices=('csv', 'json'), default=None,
+                      help=("instead of refactoring, count the matches for"
+                            " each of the script's rules within each file"
+                            " (and directory), writing them to stdout"))
+    argp.add_argument('--estimate', metavar='N', type=int, default=None,
+                      help=('instead of a full run, refactor (without'
+                            ' writing anything) a stratified random sample'
+                            ' of about N files, and report the projected'
+                            ' time and changes for the full run'))
+    argp.add_argument('--watch', action='store_true', default=False,
+                      help=("after the run, keep watching the gcc directory"
+                            " of the source tree (see --srcdir), without"
+                            " modifying anything, refactoring files as they"
+                            " are modified, and writing out their diffs;"
+                            " rerun everything if the script changes"))
+    argp.add_argument('--shard', metavar='I/N', type=parse_shard,
+                      default=None,
+                      help=('only refactor the I-th of N slices of the'
+                            ' files, without modifying any of them,'
+                            ' writing the results to the --journal FILE;'
+                            ' combine the shards with'
+                            ' "edit_journal.py merge"'))
+    argp.add_argument('paths', nargs='*',
+                      help=('files to refactor'
+                            ' (default: everything below the gcc'
+                            ' directory of each --srcdir)'))
+    options = argp.parse_args(argv[1:])
+    if options.shard and not options.journal:
+        argp.error('--shard requires --journal')
+    for name in ('report', 'profile_regexes', 'profile_memory', 'profile'):
+        if getattr(options, name) and (options.survey or options.estimate):
+            argp.error('--%s is not supported with --survey or --estimate'
+                       % name.replace('_', '-'))
+    if not options.srcdirs:
+        options.srcdirs = ['../src']
+    if len(options.srcdirs) > 1:
+        for name in ('survey', 'estimate', 'watch', 'shard'):
+            if getattr(options, name):
+                argp.error('--%s requires a single --srcdir' % name)
+        names = [get_tree_name(srcdir) for srcdir in options.srcdirs]
+        if len(set(names)) < len(names):
+            argp.error('the --srcdir directories must have distinct names')
+        if not (options.patch or options.split_patches):
+            argp.error('several --srcdir require --patch or --split-patches')
+        for name in ('patch', 'journal'):
+            filename = getattr(options, name)
+            if filename and '%s' not in filename:
+                argp.error('--%s must contain "%%s" with several --srcdir'
+                           % name)
+    return options
+
+def get_tree_name(srcdir):
+    """
+    Get the name of a source tree, for use in the names of its outputs
+    """
+    return os.path.basename(os.path.abspath(srcdir))
+
+def make_pool(cs):
+    """
+    Make a multiprocessing.Pool of workers for the ChangeSet, each
+    initialized via init_worker
+    """
+    return multiprocessing.Pool(None, init_worker, (cs, )) # uses cpu_count
+
 def main(script, refactoring, argv, skip_testsuite=False,
          path_filter=c_and_h_files,
-         clogname='ChangeLog'):
+         clogname='ChangeLog',
+         context_factory=None,
+         separate_changelogs=False,
+         survey_rules=None,
+         hooks=None):
+    """
+    Run the refactoring over GCC's source tree.
+
+    The refactoring is called as refactoring(clog_filename, src) for each
+    file, returning a (str, Changelog) pair.
+
+    refactoring can also be a list of refactorings, to be applied one
+    after another to each file, as a Chain (with separate_changelogs
+    passed to it).
+
+    survey_rules, if given, is a callable returning a list of Rule
+    instances (passed the context, if there is one), for use by --survey.
+
+    If context_factory is supplied, it is called once per worker
+    process (and source tree), as context_factory(srcdir), and its result
+    is passed to the refactoring as a 3rd argument:
+    refactoring(clog_filename, src, context) (or, for a list of
+    refactorings, to those that take it).  Use this for models that are
+    expensive to build.
+
+    hooks, if given, is a list of Hooks instances, to be told about the
+    events of the run.
+    """
+    options = parse_args(argv)
+
+    if isinstance(refactoring, list):
+        refactoring = Chain(refactoring, separate_changelogs)
+
+    if options.report:
+        # Record the time spent in the phases of the run (in this process),
+        # and have the workers time each file:
+        start = monotonic()
+        run_timings = Timings()
+        activate_timings(run_timings)
+
     # Gather list of paths of files to be refactored
-    if len(argv) > 1:
-        # Use paths specified at the command line
-        paths = argv[1:]
-    else:
-        # Gather paths from a sister-directory checkout of gcc,
-        # assuming it was checked out to "../src"
-        paths = []
-        def visit(arg, dirname, names):
-            if skip_testsuite:
-                if 'testsuite' in names:
-                    names.remove('testsuite')
-            for name in sorted(names):
-                path = os.path.join(dirname, name)
-                if path_filter(path):
-                    print(path)
-                    paths.append(path)
-        os.path.walk('../src/gcc', visit, None)
+    with timing('find paths'):
+        if options.paths:
+            # Use paths specified at the command line
+            paths = options.paths
+        else:
+            paths = []
+            for srcdir in options.srcdirs:
+                paths += find_paths(skip_testsuite, path_filter, srcdir)
 
     # Hack this in to easily work on just a subset of files:
     if 0:
         paths = paths[:15]
 
-    # Generate metadata for the set of changes
-    cs = ChangeSet(script, refactoring)
-
-    # Build the set of changes
-    if 1:
-        # Parallelized implementation:
-        global global_cs
-        global_cs = cs
-        pool = multiprocessing.Pool(None) # uses cpu_count
-        for path, changelog in pool.map(do_one_path, paths):
-            cs.changelogs[path] = changelog
+    # A shard only records its results; the files and ChangeLogs are
+    # updated once the shards have been merged:
+    if options.shard:
+        paths = get_shard(paths, options.shard)
+
+    # Generate metadata for the set of changes, for each source tree
+    changesets = [ChangeSet(script, refactoring,
+                            applychanges=not (options.dry_run or options.shard
+                                              or options.watch
+                                              or options.estimate
+                                              or options.survey),
+                            context_factory=context_factory,
+                            srcdir=srcdir)
+                  for srcdir in options.srcdirs]
+    several = len(changesets) > 1
+    if several:
+        cs = MultiTreeChangeSet(changesets)
     else:
-        # Serial implementation:
-        for path in paths:
-            path, changelog = cs.do_one_path(path)
-            cs.changelogs[path] = changelog
-
-    cs.build_changelog(clogname)
+        cs = changesets[0]
+
+    if options.survey:
+        if not survey_rules:
+            raise ValueError('%s does not support --survey' % script)
+        cs.survey_rules = survey_rules
+        # (Build the rules before the workers are started, so that with
+        # "fork" they inherit them):
+        rule_names = [rule.name for rule in cs.get_survey_rules()]
+        pool = make_pool(cs)
+        counts_by_path = dict(pool.map(survey_path, paths, chunksize=16))
+        pool.close()
+        pool.join()
+        write_survey(sys.stdout, options.survey, rule_names, counts_by_path)
+        return
+
+    if options.estimate:
+        estimate(cs, paths, options.estimate, sys.stdout)
+        return
+
+    if several or options.dedup:
+        with timing('dedup'):
+            if several:
+                unique = cs.dedup(paths, by_content=options.dedup)
+            else:
+                unique = cs.dedup(paths)
+        sys.stderr.write('%i of %i files are duplicates\n'
+                         % (len(paths) - len(unique), len(paths)))
+        paths = unique
+
+    if (options.report or options.profile_regexes or options.profile_memory
+        or options.log or hooks):
+        cs.timing = True
+        cs.profile_regexes = bool(options.profile_regexes)
+        cs.profile_memory = bool(options.profile_memory)
+    if hooks:
+        cs.record_events = True
+        for hook in hooks:
+            hook.run_started(script, paths)
+
+    with timing('refactor'):
+        tasks = cs.get_tasks(paths, options.split_threshold, options.chunk_size)
+        dispatched = dispatching(tasks, hooks) if hooks else tasks
+        progress = log = None
+        if options.progress and sys.stderr.isatty():
+            progress = cs.progress = Progress(tasks)
+        if options.log:
+            log = RunLog(open(options.log, 'w'))
+            log.write('run started', script=script, files=len(paths),
+                      tasks=len(tasks))
+
+        # Build the set of changes
+        if 1:
+            # Parallelized implementation:
+            if options.transport == 'spool':
+                cs.spool = Spool()
+            if options.profile:
+                cs.profiler = Profiler()
+            try:
+                pool = make_pool(cs)
+                if hooks:
+                    for tree_cs in changesets:
+                        tree_cs.hooks = hooks
+                if progress:
+                    progress.begin()
+                if options.io_threads:
+                    # (This is done after making the pool, as the threads
+                    # can't be handed to the workers):
+                    cs.io = IOThreads(options.io_threads)
+                    for tree_cs in changesets:
+                        tree_cs.io = cs.io
+                    results = cs.io.consuming(
+                        pool.imap(do_one_task_with_text,
+                                  cs.io.read_ahead(dispatched)))
+                elif progress or log:
+                    # (Handle each result as it arrives):
+                    results = pool.imap(do_one_task, dispatched)
+                else:
+                    results = pool.map(do_one_task, dispatched)
+                if cs.spool:
+                    results = (cs.spool.read(location)
+                               for location in results)
+                if progress or log:
+                    results = track_results(tasks, results, progress, log)
+                cs.add_results(tasks, results)
+                if progress:
+                    progress.close()
+                pool.close()
+                pool.join()
+                if cs.io:
+                    cs.io.close()
+                if cs.profiler:
+                    cs.profiler.merge(options.profile + '.pstats',
+                                      options.profile + '.folded')
+            finally:
+                # (Even if the run failed, so as not to leave the spool's
+                # or the profiler's files behind):
+                if cs.spool:
+                    cs.spool.close()
+                if cs.profiler:
+                    cs.profiler.close()
+        else:
+            # Serial implementation:
+            cs.add_results(tasks, [cs.do_one_task(task) for task in tasks])
+
+    with timing('changelog'):
+        cs.build_changelog(clogname)
+
+    with timing('output'):
+        for tree_cs in changesets:
+            # With several trees, each one's outputs are named after it:
+            journal, patch, split_patches = \
+                options.journal, options.patch, options.split_patches
+            if several:
+                name = get_tree_name(tree_cs.srcdir)
+                if journal:
+                    journal = journal.replace('%s', name)
+                if patch:
+                    patch = patch.replace('%s', name)
+                if split_patches:
+                    split_patches = os.path.join(split_patches, name)
+
+            if journal:
+                with open(journal, 'w') as f:
+                    tree_cs.get_journal(clogname).write(f)
+
+            # Emit the diffs, as one patch, in a deterministic order:
+            if split_patches:
+                for filename in tree_cs.diffs.write_split(tree_cs.cll,
+                                                          split_patches):
+                    sys.stderr.write('wrote %s\n' % filename)
+            if patch:
+                with open(patch, 'w') as f:
+                    tree_cs.diffs.write(f)
+            elif not split_patches:
+                tree_cs.diffs.write(sys.stdout)
+
+    for hook in hooks or ():
+        hook.run_finished()
+    if log:
+        log.write('run finished')
+        log.close()
+
+    timings_by_path = {}
+    for tree_cs in changesets:
+        timings_by_path.update(tree_cs.timings)
+
+    if options.profile_regexes:
+        totals = Timings(regexes=True)
+        for timings in timings_by_path.itervalues():
+            totals.add(timings)
+        write_regex_profile(sys.stderr, totals.regexes,
+                            options.profile_regexes)
+
+    if options.profile_memory:
+        write_memory_profile(sys.stderr, timings_by_path,
+                             options.profile_memory)
+
+    if options.report:
+        activate_timings(None)
+        with open(options.report, 'w') as f:
+            write_report(f, make_report(script, monotonic() - start,
+                                        run_timings, timings_by_path,
+                                        options.report_top))
+
+    if options.watch:
+        if options.paths:
+            # Only watch the given files:
+            watched = set(os.path.normpath(path) for path in options.paths)
+            path_filter = lambda path: path in watched
+        Watcher(cs, argv, path_filter, skip_testsuite).run()
@@ -2,7 +2,7 @@ from collections import namedtuple, OrderedDict
 import re
 import sys
 
-from refactor import main, Changelog
+from refactor import main, Changelog, Rule
 
 class Macro(namedtuple("Macro", ("name", "pattern", "expansion"))):
     pass
@@ -62,16 +62,19 @@ field_replacements = \
       ('x_label_to_block_map', 'label_to_block_map'),
       ('x_profile_status', 'profile_status') )
 
-def expand_cfun_macros(clog_filename, src):
-    if clog_filename in ('basic-block.h',
+# Files to leave alone:
+excluded_files = ('basic-block.h',
+
+                  # testsuite/
+                  'gcc.dg/tree-ssa/20041122-1.c',
 
-                         # testsuite/
-                         'gcc.dg/tree-ssa/20041122-1.c',
+                  # This one has its own struct control_flow_graph
+                  # with an x_entry_block_ptr field:
+                  'gcc.target/ia64/pr49303.c',
+                  )
 
-                         # This one has its own struct control_flow_graph
-                         # with an x_entry_block_ptr field:
-                         'gcc.target/ia64/pr49303.c',
-                         ):
+def expand_cfun_macros(clog_filename, src):
+    if clog_filename in excluded_files:
         return src.str(as_tabs=0), Changelog(clog_filename)
     tabify_changes = '\t' in src._str
 
@@ -166,6 +169,20 @@ def expand_cfun_macros(clog_filename, src):
     src = src.wrap(tabify_changes=tabify_changes)
     return src.str(as_tabs=0), changelog
 
+def is_candidate(clog_filename, src, m):
+    """
+    Would expand_cfun_macros change the given match?
+    """
+    return (clog_filename not in excluded_files
+            and not src.within_comment_at(m.start())
+            and not src.within_string_literal_at(m.start()))
+
+def get_survey_rules():
+    return ([Rule(macro.name, macro.pattern, macro.name, is_candidate)
+             for macro in macros]
+            + [Rule(old, '->%s' % old, old, is_candidate)
+               for old, new in field_replacements])
+
 if __name__ == '__main__':
     # Just n_basic_blocks for now:
     macros = [macro
@@ -174,4 +191,5 @@ if __name__ == '__main__':
     field_replacements = [(old, new)
                           for (old, new) in field_replacements
                           if new == 'n_basic_blocks']
-    main('refactor_cfun.py', expand_cfun_macros, sys.argv)
+    main('refactor_cfun.py', expand_cfun_macros, sys.argv,
+         survey_rules=get_survey_rules)
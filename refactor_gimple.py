@@ -1,4 +1,5 @@
 from collections import OrderedDict
+import os
 import re
 import sys
 
@@ -43,15 +44,16 @@ downcast_pattern2 = re.compile(DOWNCAST_PATTERN2, re.MULTILINE | re.DOTALL)
 #code_to_subname = dict((key, value) for _, key, value in subclasses)
 
 class GimpleTypes:
-    def __init__(self):
+    def __init__(self, srcdir='../src'):
         from pprint import pprint
-        self.gsdefs = GimpleTypes.parse_gsstruct_def()
+        gccdir = os.path.join(srcdir, 'gcc')
+        self.gsdefs = GimpleTypes.parse_gsstruct_def(gccdir)
         #pprint(self.gsdefs)
 
-        self.gimple_defs = GimpleTypes.parse_gimple_def()
+        self.gimple_defs = GimpleTypes.parse_gimple_def(gccdir)
         #pprint(self.gimple_defs)
 
-        self.parse_gimple_h()
+        self.parse_gimple_h(gccdir)
 
         # Mapping from GSS_foo to (struct_name, has_tree_operands) pair:
         self.gsscodes = {}
@@ -98,12 +100,12 @@ class GimpleTypes:
         return struct[len('gimple_statement_'):] + '_stmt'
 
     @staticmethod
-    def parse_gsstruct_def():
+    def parse_gsstruct_def(gccdir):
         """
         gsstruct.def defines "enum gimple_statement_structure_enum"
         """
         gss_defs = []
-        with open('../src/gcc/gsstruct.def') as f:
+        with open(os.path.join(gccdir, 'gsstruct.def')) as f:
             for line in f:
                 m = re.match('^DEFGSSTRUCT\((.+?), (.+?), (.+?)\)$', line)
                 if m:
@@ -111,12 +113,12 @@ class GimpleTypes:
         return gss_defs
 
     @staticmethod
-    def parse_gimple_def():
+    def parse_gimple_def(gccdir):
         """
         gimple.def defines "enum gimple_code"
         """
         gimple_defs = []
-        with open('../src/gcc/gimple.def') as f:
+        with open(os.path.join(gccdir, 'gimple.def')) as f:
             txt = f.read()
             for m in re.finditer('^DEFGSCODE\((.+?),\s+"(.+?)",\s+(.+?)\)$',
                                  txt,
@@ -124,7 +126,7 @@ class GimpleTypes:
                 gimple_defs.append(m.groups())
         return gimple_defs
 
-    def parse_gimple_h(self):
+    def parse_gimple_h(self, gccdir):
         """
         Scrape out the inheritance hierarchy from gimple.h
         """
@@ -132,7 +134,7 @@ class GimpleTypes:
             {'gimple_statement_base' : None,
              'gimple_statement_with_ops_base' : 'gimple_statement_base'}
 
-        with open('../src/gcc/gimple.h') as f:
+        with open(os.path.join(gccdir, 'gimple.h')) as f:
             txt = f.read()
             pattern = (r'struct' + ws + r'GTY\(\((.*?)\)\)' + ws
                        + identifier_group + ws + ':' + ws + 'public' + ws
@@ -289,14 +291,17 @@ def add_is_a_helpers(changelog, src, is_a_helpers, gt):
                           helpers)
     return src
 
-def convert_to_inheritance(clog_filename, src):
+def convert_to_inheritance(clog_filename, src, gt=None):
     """
     Look for code of the form:
         "->gsbase."
     followed by non-whitespace, and replace it with:
         "->"
+
+    gt is the GimpleTypes to use; it is built afresh if not supplied.
     """
-    gt = GimpleTypes()
+    if gt is None:
+        gt = GimpleTypes()
 
     is_a_helpers = set()
 
@@ -359,4 +364,5 @@ def convert_to_inheritance(clog_filename, src):
 
 if __name__ == '__main__':
     main('refactor_gimple.py', convert_to_inheritance, sys.argv,
-         skip_testsuite=True)
+         skip_testsuite=True,
+         context_factory=GimpleTypes)
@@ -3,7 +3,7 @@ import os
 import re
 import sys
 
-from refactor import main, Changelog
+from refactor import main, Changelog, Rule
 
 class Variable(namedtuple('Variable', ('type_', 'name'))):
     pass
@@ -200,11 +200,11 @@ def parse_all_opt_files(path):
     return records
 
 class Options:
-    def __init__(self):
+    def __init__(self, srcdir='../src'):
         # There are currently 111 option files:
         #   find . -name "*.opt"|wc -l
         #   111
-        self.records = parse_all_opt_files('../src/gcc')
+        self.records = parse_all_opt_files(os.path.join(srcdir, 'gcc'))
         #from pprint import pprint
         #pprint(self.records)
 
@@ -234,11 +234,99 @@ class Options:
                          for varname in self.varnames]
         #print(len(self.patterns))
 
+    def skips_varname(self, clog_filename, varname):
+        """
+        Should the given file be skipped altogether for the pattern for
+        varname?
+        """
+        if varname == 'TARGET_ACCUMULATE_OUTGOING_ARGS':
+            # Nasty special-case: we're handling Vars from all .opt
+            # files, and sh.opt has a
+            #   Var(TARGET_ACCUMULATE_OUTGOING_ARGS)
+            # and uses of this option in sh.c and sh.h, which must
+            # become GCC_OPTION (TARGET_ACCUMULATE_OUTGOING_ARGS)
+            # whereas i386.opt has a:
+            #   Mask(ACCUMULATE_OUTGOING_ARGS)
+            # leading to there being a TARGET_ACCUMULATE_OUTGOING_ARGS
+            # macro within options.h on i386 builds defined in terms
+            # of masking GCC_OPTION (target_flags).
+            #
+            # Hence only process this as a Var within the sh config
+            # subdir:
+            return 'config/sh/' not in clog_filename
+        return False
+
+    def is_candidate(self, clog_filename, src, m):
+        """
+        Should the given match of one of our patterns (with the varname
+        as group 1) be wrapped in GCC_OPTION?  (For --survey: when
+        refactoring, the skipped patterns aren't even run)
+        """
+        if self.skips_varname(clog_filename, m.group(1)):
+            return False
+        return self.is_match_candidate(clog_filename, src, m)
+
+    def is_match_candidate(self, clog_filename, src, m):
+        """
+        As is_candidate, for a file that isn't skipped for the pattern
+        """
+        varname = m.group(1)
+
+        # Don't handle code that's already been touched:
+        MACRO = 'GCC_OPTION ('
+        if src._str[m.start(1) - len(MACRO):m.start(1)] == MACRO:
+            return False
+
+        # Avoid changing variable definitions in print-rtl.c that
+        # are guarded by #ifdef GENERATOR_FILE:
+        line = src.get_line_at(m.start(1))
+        if line.startswith('int'):
+            return False
+
+        # opt_for_fn(fndecl, opt) is its own macro, which potentially
+        # looks up option "opt" in a function-specific location.
+        # Don't touch such macros (currently all uses are the only
+        # thing on their line):
+        if 'opt_for_fn' in line:
+            return False
+
+        # Don't change things within comments.  In particular, this
+        # avoids lots of rewriting of the word "optimize" to
+        # "GCC_OPTION (optimize)".
+        if src.within_comment_at(m.start(1)):
+            return False
+
+        # Don't change things within string literals e.g. within
+        # spec strings in gcc.c.   It's OK within .md files, since
+        # the C fragments in those files occur within strings.
+        if src.within_string_literal_at(m.start(1)) \
+           and not clog_filename.endswith('.md'):
+            return False
+
+        # config/vms/vms.opt has Var(flag_vms_malloc64);
+        # gcc/ada/gcc-interface/gigi.h #defines it for other
+        # targets.
+        if line.startswith('#define %s' % varname):
+            return False
+
+        # Don't handle options within attributes, as these
+        # are for the build compiler:
+        ATTRIBUTE = '__attribute__(('
+        if src._str[m.start(1) - len(ATTRIBUTE):m.start(1)] == ATTRIBUTE:
+            return False
+
+        # 'gcc/ada/gcc-interface/misc.c' has a mix of explicit
+        # variables for some of the options, and other options
+        # used normally; it must be done by hand
+        if clog_filename == 'gcc-interface/misc.c':
+            return False
+
+        return True
+
     def make_macros_visible(self,clog_filename, src):
         changelog = Changelog(clog_filename)
         scopes = OrderedDict()
         count = 0
-        changes = 0
         for varname, pattern in self.patterns:
             match = 0
             count += 1
@@ -246,71 +334,11 @@ class Options:
                 if count % 100 == 0:
                     print('count: %i' % count)
 
-            if varname == 'TARGET_ACCUMULATE_OUTGOING_ARGS':
-                # Nasty special-case: we're handling Vars from all .opt
-                # files, and sh.opt has a
-                #   Var(TARGET_ACCUMULATE_OUTGOING_ARGS)
-                # and uses of this option in sh.c and sh.h, which must
-                # become GCC_OPTION (TARGET_ACCUMULATE_OUTGOING_ARGS)
-                # whereas i386.opt has a:
-                #   Mask(ACCUMULATE_OUTGOING_ARGS)
-                # leading to there being a TARGET_ACCUMULATE_OUTGOING_ARGS
-                # macro within options.h on i386 builds defined in terms
-                # of masking GCC_OPTION (target_flags).
-                #
-                # Hence only process this as a Var within the sh config
-                # subdir:
-                if 'config/sh/' not in clog_filename:
-                    continue
+            if self.skips_varname(clog_filename, varname):
+                continue
 
             for m in src.finditer(pattern):
-                # Don't handle code that's already been touched:
-                MACRO = 'GCC_OPTION ('
-                if src._str[m.start(1) - len(MACRO):m.start(1)] == MACRO:
-                    continue
-
-                # Avoid changing variable definitions in print-rtl.c that
-                # are guarded by #ifdef GENERATOR_FILE:
-                line = src.get_line_at(m.start(1))
-                if line.startswith('int'):
-                    continue
-
-                # opt_for_fn(fndecl, opt) is its own macro, which potentially
-                # looks up option "opt" in a function-specific location.
-                # Don't touch such macros (currently all uses are the only
-                # thing on their line):
-                if 'opt_for_fn' in line:
-                    continue
-
-                # Don't change things within comments.  In particular, this
-                # avoids lots of rewriting of the word "optimize" to
-                # "GCC_OPTION (optimize)".
-                if src.within_comment_at(m.start(1)):
-                    continue
-
-                # Don't change things within string literals e.g. within
-                # spec strings in gcc.c.   It's OK within .md files, since
-                # the C fragments in those files occur within strings.
-                if src.within_string_literal_at(m.start(1)) \
-                   and not clog_filename.endswith('.md'):
-                    continue
-
-                # config/vms/vms.opt has Var(flag_vms_malloc64);
-                # gcc/ada/gcc-interface/gigi.h #defines it for other
-                # targets.
-                if line.startswith('#define %s' % varname):
-                    continue
-
-                # Don't handle options within attributes, as these
-                # are for the build compiler:
-                ATTRIBUTE = '__attribute__(('
-                if src._str[m.start(1) - len(ATTRIBUTE):m.start(1)] == ATTRIBUTE:
-                    continue
-
-                # 'gcc/ada/gcc-interface/misc.c' has a mix of explicit
-                # variables for some of the options, and other options
-                # used normally; it must be done by hand
-                if clog_filename == 'gcc-interface/misc.c':
+                if not self.is_match_candidate(clog_filename, src, m):
                     continue
 
                 scope = src.get_change_scope_at(m.start(), True)
@@ -319,8 +347,6 @@ class Options:
                 if scope not in scopes:
                     scopes[scope] = scope
                 match = 1
-                changes += 1
-                print('changes: %i' % changes)
 
         for scope in scopes.keys()[::-1]:
             changelog.append(scope,
@@ -328,6 +354,13 @@ class Options:
 
         return src.str(), changelog
 
+def make_macros_visible(clog_filename, src, options):
+    return options.make_macros_visible(clog_filename, src)
+
+def get_survey_rules(options):
+    return [Rule(varname, pattern, varname, options.is_candidate)
+            for varname, pattern in sorted(options.patterns)]
+
 def path_filter(path):
     if not os.path.isfile(path):
         return False
@@ -348,7 +381,8 @@ def path_filter(path):
     return True
 
 if __name__ == '__main__':
-    options = Options()
-    main('refactor_options.py', options.make_macros_visible, sys.argv,
+    main('refactor_options.py', make_macros_visible, sys.argv,
          skip_testsuite=True,
-         path_filter=path_filter)
+         path_filter=path_filter,
+         context_factory=Options,
+         survey_rules=get_survey_rules)
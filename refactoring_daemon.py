@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""
+A long-running server for the refactoring scripts, which keeps the list
+of files, the ChangeLogLayout, the scripts' models (e.g. Options or
+GimpleTypes) and the per-file results in memory between runs, so that
+targeted runs during development of a refactoring don't have to pay for
+them each time.
+
+Run it from the scripts directory (as for the scripts themselves):
+
+  python refactoring_daemon.py serve
+      Listen for requests on a Unix socket
+  python refactoring_daemon.py run SCRIPT [ARGS]
+      Have the server run the refactoring in SCRIPT (e.g.
+      refactor_options.py), as if by "python SCRIPT ARGS", writing the
+      patch to stdout (or the --patch FILE).  The server does the work
+      itself, so only --dry-run, --patch and the paths are supported,
+      and any other options are refused.
+  python refactoring_daemon.py rescan
+      Have the server forget the list of files and the ChangeLogLayout
+  python refactoring_daemon.py stop
+      Shut down the server
+
+The scripts are reloaded whenever they, or the modules alongside them
+that they import (or refactor.py), are modified, which also discards
+their models and their cached results.
+"""
+import argparse
+import inspect
+import json
+import os
+import socket
+import SocketServer
+from StringIO import StringIO
+import sys
+import tempfile
+import time
+import traceback
+
+# (The server uses the rest of refactor via the module, so that it sees
+# the new versions when refactor.py is reloaded):
+import refactor
+from refactor import _from_json_str, _to_json_line, parse_args
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(),
+                              'refactoring-daemon-%i.sock' % os.getuid())
+
+# The script options that "run" supports (by their dests):
+SUPPORTED_OPTIONS = ('dry_run', 'patch', 'paths')
+
+REFACTOR_PATH = refactor.get_source_path(refactor)
+
+class Script:
+    """
+    A refactoring script, as loaded by the server: the arguments with
+    which it calls refactor.main, and the state that we keep for it
+    """
+    def __init__(self, path):
+        self.path = path
+        self.dirname = os.path.dirname(path)
+        # The script's globals, which must outlive the loading of it, as
+        # its functions need them:
+        self.namespace = {'__name__': '__main__', '__file__': path}
+        self.args = self._get_main_args()
+        # The modules that it imports from alongside it, and the files
+        # that we reload it for (with their modification times):
+        self.modules = refactor.get_local_modules(self.namespace,
+                                                  self.dirname)
+        self.mtimes = dict((path, os.path.getmtime(path))
+                           for path in self.get_dependencies())
+        refactoring = self.args['refactoring']
+        if isinstance(refactoring, list):
+            refactoring = refactor.Chain(refactoring,
+                                         self.args['separate_changelogs'])
+        self.refactoring = refactoring
+        self.context = None
+        self.paths = None
+        self.results = {} # map from path to FileResult
+
+    def _get_main_args(self):
+        """
+        Run the script as __main__, but with refactor.main replaced by a
+        function that captures its arguments (with the defaults filled in)
+        """
+        calls = []
+        def capture(*args, **kwargs):
+            calls.append(inspect.getcallargs(real_main, *args, **kwargs))
+        with open(self.path) as f:
+            code = compile(f.read(), self.path, 'exec')
+        real_main = refactor.main
+        refactor.main = capture
+        # (As when running it, it can import modules from alongside it):
+        sys.path.insert(0, self.dirname)
+        try:
+            exec code in self.namespace
+        finally:
+            sys.path.remove(self.dirname)
+            refactor.main = real_main
+        if len(calls) != 1:
+            raise ValueError('%s does not call refactor.main' % self.path)
+        return calls[0]
+
+    def get_dependencies(self):
+        """
+        Get the paths to the script, and to the source files of the
+        modules that it depends on
+        """
+        return refactor.get_script_dependencies(self.path, self.modules)
+
+    def is_stale(self):
+        for path, mtime in self.mtimes.iteritems():
+            if not os.path.exists(path) or os.path.getmtime(path) != mtime:
+                return True
+        return False
+
+    def unload(self):
+        """
+        Forget the modules that the script imported from alongside it,
+        so that loading it again imports them afresh, returning True if
+        refactor.py has been modified (and so reloaded, in place, as the
+        server and other scripts refer to it)
+        """
+        for name in self.modules:
+            if name != 'refactor':
+                sys.modules.pop(name, None)
+        if os.path.getmtime(REFACTOR_PATH) == self.mtimes[REFACTOR_PATH]:
+            return False
+        reload(refactor)
+        return True
+
+    def get_context(self):
+        if self.args['context_factory'] and self.context is None:
+            self.context = self.args['context_factory']('../src')
+        return self.context
+
+    def get_paths(self):
+        if self.paths is None:
+            self.paths = refactor.find_paths(self.args['skip_testsuite'],
+                                             self.args['path_filter'])
+        return self.paths
+
+class Server(SocketServer.UnixStreamServer):
+    """
+    Handles one request at a time (see Handler) on behalf of all of its
+    clients, so that the state can be shared without locking
+    """
+    def __init__(self, socket_path):
+        SocketServer.UnixStreamServer.__init__(self, socket_path, Handler)
+        self.scripts = {} # map from abspath to Script
+        self.cll = None
+        self.stopping = False
+
+    def get_script(self, path):
+        path = os.path.abspath(path)
+        script = self.scripts.get(path)
+        if script is None or script.is_stale():
+            if script is not None and script.unload():
+                # (The layout is an instance of the old version):
+                self.cll = None
+            script = self.scripts[path] = Script(path)
+        return script
+
+    def get_cll(self):
+        if self.cll is None:
+            self.cll = refactor.ChangeLogLayout('../src')
+        return self.cll
+
+    def rescan(self):
+        self.cll = None
+        for script in self.scripts.values():
+            script.paths = None
+
+    def run(self, request):
+        """
+        Run a script over some files, returning a dict with the patch,
+        and some statistics about the run
+        """
+        start = time.time()
+        script = self.get_script(request['script'])
+        dry_run = request['dry_run']
+        cs = refactor.ChangeSet(script.args['script'], script.refactoring,
+                                applychanges=not dry_run,
+                                cll=self.get_cll())
+        cs.context = script.get_context()
+
+        # Paths are relative to the client's working directory:
+        if request['paths']:
+            paths = [os.path.relpath(os.path.join(request['cwd'], path))
+                     for path in request['paths']]
+        else:
+            paths = script.get_paths()
+
+        hits = 0
+        for path in paths:
+            srctext = refactor.read_file(path)
+            result = script.results.get(path)
+            if result and result.base_id == refactor.get_blob_id(srctext):
+                hits += 1
+            else:
+                # (As the text is passed in, this doesn't write the file):
+                result = cs.do_one_path(path, srctext)
+                script.results[path] = result
+            if not dry_run and result.base_id != result.result_id:
+                refactor.write_file_atomically(
+                    path, refactor.apply_edits(srctext, result.edits))
+            cs.add_result(result)
+        cs.build_changelog(script.args['clogname'])
+
+        patch = StringIO()
+        cs.diffs.write(patch)
+        return {'patch': patch.getvalue(),
+                'files': len(paths),
+                'cached': hits,
+                'elapsed': time.time() - start}
+
+class Handler(SocketServer.StreamRequestHandler):
+    """
+    Each request is a line of JSON, as is the response, which has an
+    "error" if something went wrong
+    """
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        try:
+            command = request['command']
+            if command == 'run':
+                response = self.server.run(request)
+            elif command == 'rescan':
+                self.server.rescan()
+                response = {}
+            elif command == 'stop':
+                self.server.stopping = True
+                response = {}
+            else:
+                raise ValueError('unknown command: %r' % command)
+        except Exception:
+            response = {'error': traceback.format_exc()}
+        self.wfile.write(_to_json_line(response))
+
+def request(obj, socket_path=DEFAULT_SOCKET):
+    """
+    Send a request (a dict) to the server, returning its response
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    try:
+        f = sock.makefile('rw')
+        f.write(_to_json_line(obj))
+        f.flush()
+        response = json.loads(f.readline())
+    finally:
+        sock.close()
+    if 'error' in response:
+        raise RuntimeError('error in refactoring daemon:\n%s'
+                           % response['error'])
+    return response
+
+def serve(socket_path=DEFAULT_SOCKET):
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = Server(socket_path)
+    try:
+        while not server.stopping:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+def main(argv):
+    argp = argparse.ArgumentParser(description='Run refactorings via a server')
+    argp.add_argument('--socket', default=DEFAULT_SOCKET,
+                      help='the Unix socket to use (default: %(default)s)')
+    subparsers = argp.add_subparsers(dest='command')
+    subparsers.add_parser('serve')
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('script')
+    run_parser.add_argument('args', nargs=argparse.REMAINDER,
+                            help='arguments, as for the script itself')
+    subparsers.add_parser('rescan')
+    subparsers.add_parser('stop')
+    options = argp.parse_args(argv[1:])
+
+    if options.command == 'serve':
+        serve(options.socket)
+    elif options.command == 'run':
+        script_options = parse_args([options.script] + options.args)
+        defaults = parse_args([options.script])
+        for name, value in sorted(vars(script_options).iteritems()):
+            if (name not in SUPPORTED_OPTIONS
+                and value != getattr(defaults, name)):
+                if name == 'srcdirs':
+                    name = 'srcdir'
+                argp.error('--%s is not supported via the daemon'
+                           % name.replace('_', '-'))
+        response = request({'command': 'run',
+                            'script': os.path.abspath(options.script),
+                            'dry_run': script_options.dry_run,
+                            'cwd': os.getcwd(),
+                            'paths': script_options.paths},
+                           options.socket)
+        if script_options.patch:
+            with open(script_options.patch, 'w') as f:
+                f.write(_from_json_str(response['patch']))
+        else:
+            sys.stdout.write(_from_json_str(response['patch']))
+        sys.stderr.write('%i file(s), %i cached, in %.3fs\n'
+                         % (response['files'], response['cached'],
+                            response['elapsed']))
+    else:
+        request({'command': options.command}, options.socket)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
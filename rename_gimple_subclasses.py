@@ -3,7 +3,7 @@ from collections import namedtuple, OrderedDict
 import os
 import sys
 
-from refactor import main, Changelog, Source, not_identifier
+from refactor import main, Changelog, Rule, Source, not_identifier
 from rename_gimple import _add_stars_in_decls
 
 class StmtClass(namedtuple('StmtClass',
@@ -217,6 +217,20 @@ def rename_types_in_str(text, where):
     src = rename_types_in_src(src, where, None)
     return src.str()
 
+def get_survey_rules():
+    rules = []
+    for subclass in stmt_classes:
+        for old in (subclass.orig_name,
+                    subclass.typedef,
+                    'const_%s' % subclass.typedef):
+            rules.append(Rule(old,
+                              not_identifier + ('(%s)(?![_a-zA-Z0-9])' % old),
+                              old))
+    rules.append(Rule('gimple_phi_iterator',
+                      not_identifier + '(gimple_phi_iterator)(?![_a-zA-Z0-9])',
+                      'gimple_phi_iterator'))
+    return rules
+
 def path_filter(path):
     return (os.path.isfile(path)
             and (path.endswith('.c') or
@@ -233,4 +247,5 @@ if __name__ == '__main__':
     main('rename_gimple_subclasses.py', rename_types, sys.argv,
          skip_testsuite=True,
          path_filter=path_filter,
-         clogname='ChangeLog.gimple-classes')
+         clogname='ChangeLog.gimple-classes',
+         survey_rules=get_survey_rules)
@@ -0,0 +1,93 @@
+import json
+import os
+import re
+import shutil
+from StringIO import StringIO
+import tempfile
+import unittest
+
+from bench_refactor import BENCHMARKS, MATCH, Fixture, fit_exponent, \
+    main, make_c_file, parse_size, run_benchmarks, write_comparison, \
+    write_results
+from refactor import Source, tabify
+
+class MakeCFileTests(unittest.TestCase):
+    def test_density(self):
+        for density in (0, 1, 10):
+            text = make_c_file(100 * 1024, density)
+            self.assertTrue(100 * 1024 <= len(text) < 101 * 1024)
+            self.assertAlmostEqual(len(re.findall(MATCH, text)),
+                                   density * len(text) / 1024.0,
+                                   delta=1.5)
+
+    def test_deterministic(self):
+        self.assertEqual(make_c_file(10000, 5), make_c_file(10000, 5))
+
+    def test_source(self):
+        text = make_c_file(10000, 5)
+        # It should be in the form that the scripts expect:
+        self.assertEqual(tabify(text), text)
+        src = Source(text, 'bench.c')
+        m = src.finditer(MATCH)[0]
+        self.assertTrue(src.get_change_scope_at(m.start()).startswith('fn_'))
+        self.assertFalse(src.within_comment_at(m.start()))
+        self.assertFalse(src.within_string_literal_at(m.start()))
+        self.assertTrue(src.within_comment_at(text.index('Compute')))
+        self.assertTrue(src.within_string_literal_at(text.index('a /*')))
+
+        # Once changed, the lines need wrapping:
+        fixture = Fixture(10000, 5)
+        wrapped = fixture.changed.wrap()
+        self.assertEqual(len(wrapped.edits), fixture.num_matches)
+
+class BenchTests(unittest.TestCase):
+    def test_fit_exponent(self):
+        self.assertAlmostEqual(fit_exponent([(10, 1e-6), (100, 1e-4),
+                                             (1000, 1e-2)]), 2.0)
+        self.assertEqual(fit_exponent([(10, 1e-6)]), None)
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('10K'), 10 * 1024)
+        self.assertEqual(parse_size('5m'), 5 * 1024 * 1024)
+        self.assertEqual(parse_size('123'), 123)
+
+    def test_run(self):
+        results = run_benchmarks(BENCHMARKS.keys(), [2048, 8192], [1, 10],
+                                 0.001, 10.0)
+        self.assertEqual(len(results['results']), len(BENCHMARKS) * 2 * 2)
+        self.assertEqual(len(results['exponents']), len(BENCHMARKS) * 2)
+        for result in results['results']:
+            self.assertTrue(result['ops_per_sec'] > 0)
+        for exponent in results['exponents']:
+            self.assertNotEqual(exponent['exponent'], None)
+        out = StringIO()
+        write_results(out, results)
+        self.assertIn('Source.get_change_scope_at', out.getvalue())
+
+    def test_skip(self):
+        # Everything takes longer than no time at all:
+        results = run_benchmarks(['tabify'], [2048, 8192], [1], 0.001, 0)
+        self.assertEqual([result.get('skipped')
+                          for result in results['results']],
+                         [None, True])
+        self.assertEqual(results['exponents'][0]['exponent'], None)
+
+    def test_main(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'bench.json')
+            main(['bench_refactor.py', '--benchmark', 'Source.get_line_at',
+                  '--size', '2K', '--size', '4K', '--density', '1',
+                  '--min-time', '0.001', '--json', path])
+            with open(path) as f:
+                old = json.load(f)
+            self.assertEqual([result['size'] for result in old['results']],
+                             [2336, 4262])
+            out = StringIO()
+            write_comparison(out, old, old)
+            self.assertIn('1.00x', out.getvalue())
+        finally:
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import os
+import shutil
+from StringIO import StringIO
+import unittest
+
+from edit_journal import Replay
+from refactor import Changelog, FileResult, Journal, Source, get_blob_id
+from test_refactor import make_script_tree, make_tree, run_script
+
+FOO_C = ('static void\n'
+         'foo (void)\n'
+         '{\n'
+         '  int n = n_basic_blocks;\n'
+         '}\n')
+
+class JournalTests(unittest.TestCase):
+    def setUp(self):
+        self.srcdir = make_tree({'gcc/ChangeLog': 'old entries\n',
+                                 'gcc/foo.c': FOO_C})
+
+    def tearDown(self):
+        shutil.rmtree(self.srcdir)
+
+    def make_journal(self):
+        src = Source(FOO_C, 'foo.c')
+        idx = FOO_C.index('n_basic_blocks')
+        dst = src.replace(idx, idx + len('n_basic_blocks'),
+                          'cfun->cfg->n_basic_blocks')
+        clog = Changelog('foo.c')
+        clog.append('foo', 'Remove usage of n_basic_blocks macro.')
+        result = FileResult(os.path.join(self.srcdir, 'gcc/foo.c'),
+                            clog, None,
+                            base_id=get_blob_id(FOO_C),
+                            edits=dst.edits,
+                            result_id=get_blob_id(dst.str()))
+        journal = Journal('refactor_test.py', 'abc123', self.srcdir, [result])
+        # Round-trip it through the on-disk format:
+        f = StringIO()
+        journal.write(f)
+        return Journal.read(StringIO(f.getvalue()))
+
+    def read(self, path):
+        with open(os.path.join(self.srcdir, path)) as f:
+            return f.read()
+
+    def test_round_trip(self):
+        journal = self.make_journal()
+        self.assertEqual(journal.script, 'refactor_test.py')
+        self.assertEqual(journal.srcdir, self.srcdir)
+        self.assertEqual(journal.clogname, 'ChangeLog')
+        result = journal.results[0]
+        self.assertEqual(result.changelog.as_text(None)[0],
+                         '\t* foo.c (foo): Remove usage of n_basic_blocks'
+                         ' macro.\n')
+        self.assertEqual(result.edits[0].replacement,
+                         'cfun->cfg->n_basic_blocks')
+
+    def test_round_trip_arbitrary_bytes(self):
+        result = FileResult('../src/gcc/foo.c', Changelog('foo.c'), None,
+                            base_id='0' * 40, edits=[(0, 1, '\xe9\xff\n')],
+                            result_id='1' * 40)
+        f = StringIO()
+        Journal('refactor_test.py', 'abc123', '../src', [result]).write(f)
+        journal = Journal.read(StringIO(f.getvalue()))
+        self.assertEqual(journal.results[0].edits[0].replacement, '\xe9\xff\n')
+
+    def test_verify(self):
+        out = StringIO()
+        self.assertTrue(Replay(self.make_journal()).verify(out))
+        self.assertIn('gcc/foo.c: pending', out.getvalue())
+
+    def test_diff(self):
+        out = StringIO()
+        Replay(self.make_journal()).diff(out)
+        self.assertIn('diff --git a/gcc/ChangeLog b/gcc/ChangeLog\n',
+                      out.getvalue())
+        self.assertIn('-  int n = n_basic_blocks;\n'
+                      '+  int n = cfun->cfg->n_basic_blocks;\n',
+                      out.getvalue())
+        # Nothing should have been touched:
+        self.assertEqual(self.read('gcc/foo.c'), FOO_C)
+
+    def test_changelog(self):
+        out = StringIO()
+        Replay(self.make_journal()).changelog(out)
+        self.assertIn('gcc/ChangeLog:\n', out.getvalue())
+        self.assertIn('\t* foo.c (foo): Remove usage of n_basic_blocks macro.\n',
+                      out.getvalue())
+
+    def test_apply(self):
+        replay = Replay(self.make_journal())
+        self.assertEqual(replay.apply(), 1)
+        self.assertIn('cfun->cfg->n_basic_blocks', self.read('gcc/foo.c'))
+        self.assertTrue(self.read('gcc/ChangeLog').endswith('\nold entries\n'))
+        self.assertIn('Patch autogenerated by refactor_test.py',
+                      self.read('gcc/ChangeLog'))
+
+        # Applying it again should be a no-op:
+        out = StringIO()
+        self.assertTrue(replay.verify(out))
+        self.assertIn('gcc/foo.c: applied', out.getvalue())
+        clog = self.read('gcc/ChangeLog')
+        self.assertEqual(replay.apply(), 0)
+        self.assertEqual(self.read('gcc/ChangeLog'), clog)
+
+    def test_apply_atomically(self):
+        # The file should be replaced (keeping its mode), rather than
+        # rewritten in place:
+        path = os.path.join(self.srcdir, 'gcc/foo.c')
+        os.chmod(path, 0640)
+        os.link(path, os.path.join(self.srcdir, 'old-foo.c'))
+        Replay(self.make_journal()).apply()
+        self.assertIn('cfun->cfg->n_basic_blocks', self.read('gcc/foo.c'))
+        self.assertEqual(self.read('old-foo.c'), FOO_C)
+        self.assertEqual(os.stat(path).st_mode & 0777, 0640)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.srcdir, 'gcc'))),
+                         ['ChangeLog', 'foo.c'])
+
+    def test_modified(self):
+        with open(os.path.join(self.srcdir, 'gcc/foo.c'), 'a') as f:
+            f.write('/* Some other change.  */\n')
+        replay = Replay(self.make_journal())
+        self.assertFalse(replay.verify(StringIO()))
+        self.assertRaises(ValueError, replay.apply)
+
+    def test_merge_overlapping(self):
+        journal = self.make_journal()
+        self.assertRaises(ValueError, Journal.merge, [journal, journal])
+
+class ShardTests(unittest.TestCase):
+    """
+    Run refactor_cfun.py as several shards, each in its own process,
+    and check that merging their bundles gives the same result as a
+    single run
+    """
+    def setUp(self):
+        files = {}
+        for name in ('a', 'b', 'c', 'd', 'e'):
+            files['src/gcc/%s.c' % name] = FOO_C.replace('foo', name)
+        self.tmpdir = make_script_tree(files)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_shards(self):
+        expected = os.path.join(self.tmpdir, 'expected.patch')
+        run_script(self.tmpdir, '--dry-run', '--patch', expected)
+
+        journals = []
+        for i in range(1, 4):
+            bundle = os.path.join(self.tmpdir, 'shard-%i.json' % i)
+            run_script(self.tmpdir, '--shard', '%i/3' % i,
+                       '--journal', bundle, '--patch', os.devnull)
+            with open(bundle) as f:
+                journals.append(Journal.read(f))
+        self.assertEqual([len(journal.results) for journal in journals],
+                         [2, 2, 1])
+
+        replay = Replay(Journal.merge(journals),
+                        os.path.join(self.tmpdir, 'src'))
+        out = StringIO()
+        replay.diff(out)
+        with open(expected) as f:
+            self.assertEqual(out.getvalue(), f.read())
+
+        # The shards shouldn't have touched the tree:
+        with open(os.path.join(self.tmpdir, 'src/gcc/a.c')) as f:
+            self.assertEqual(f.read(), FOO_C.replace('foo', 'a'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,96 @@
+import csv
+import json
+import os
+import pstats
+import random
+import re
+import select
+import shutil
+import signal
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+from subprocess import check_call, Popen, PIPE
+import sys
+import tempfile
+import threading
 import unittest
 
-from refactor import tabify, \
+from refactor import tabify, wrap, \
     ChangeLogLayout, ChangeLogAdditions, Changelog, \
-    AUTHOR, Source
+    AUTHOR, Source, make_diff, DiffCollector, \
+    Edit, apply_edits, get_edits, make_diff_from_edits, \
+    FileResult, Spool, ChangeSet, make_pool, \
+    refactor_text, split_at_top_level, stitch_chunks, \
+    IOThreads, write_file_atomically, Chain, StagedChangelog, Inotify, \
+    get_stratum, stratified_sample, Rule, survey_text, write_survey, \
+    prepend_to_file, \
+    Timings, timed, Hooks, main, Profiler, Progress, WindowOverrun
+import refactor
 
 TEST_ISODATE = '1066-10-14'
 
+def make_tree(files):
+    """
+    Create a temporary directory populated with the given files (a dict
+    mapping from relative path to content), returning its path
+    """
+    tmpdir = tempfile.mkdtemp()
+    for path, content in files.items():
+        path = os.path.join(tmpdir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+    return tmpdir
+
+def init_git_repo(path):
+    """
+    Make path into a git repository with a commit, as the scripts need a
+    git revision to put in the ChangeLog
+    """
+    check_call(['git', 'init', '-q', path])
+    check_call(['git', '-c', 'user.name=test', '-c', 'user.email=test',
+                'commit', '-q', '--allow-empty', '-m', 'test'],
+               cwd=path)
+
+def make_script_tree(files):
+    """
+    As make_tree, but for running the scripts in: a git repository with
+    a scripts directory (to run them from), and a src/gcc/ChangeLog
+    (unless the files give another one), as well as the given files
+    """
+    tree = {'src/gcc/ChangeLog': 'old entries\n',
+            'scripts/README': ''}
+    tree.update(files)
+    tmpdir = make_tree(tree)
+    init_git_repo(tmpdir)
+    return tmpdir
+
+def start_script(tmpdir, *args):
+    """
+    Start refactor_cfun.py with the given arguments, from the scripts
+    directory of a tree made by make_script_tree, returning the Popen
+    (with its output unbuffered, and piped back)
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'refactor_cfun.py')
+    return Popen([sys.executable, '-u', script] + list(args),
+                 cwd=os.path.join(tmpdir, 'scripts'),
+                 stdout=PIPE, stderr=PIPE)
+
+def run_script(tmpdir, *args):
+    """
+    As start_script, but wait for it, returning its (stdout, stderr),
+    and failing if it does
+    """
+    proc = start_script(tmpdir, *args)
+    out, err = proc.communicate()
+    if proc.returncode:
+        raise AssertionError('refactor_cfun.py %s failed:\n%s'
+                             % (' '.join(args), err))
+    return out, err
+
 class GeneralTests(unittest.TestCase):
     def assertTabifyEquals(self, input_code, expected_result):
         actual_result = tabify(input_code)
@@ -25,6 +110,21 @@ class GeneralTests(unittest.TestCase):
                              '\t\t   "jump2",\n'
                              '\t\t   OPTGROUP_NONE,\n'))
 
+    def test_wrap(self):
+        # Quoted strings aren't broken, even if unterminated:
+        self.assertEqual(
+            wrap('* gimple.c (foo): Replace "gimple" typedef with "gimple *"'
+                 ' within "a quoted string of more than a few words\n'),
+            ('\t* gimple.c (foo): Replace "gimple" typedef with "gimple *" within\n'
+             '\t"a quoted string of more than a few words\n'))
+        self.assertEqual(
+            wrap('* foo.c: xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
+                 'x "a b" x"a b"\n\n(bar): Likewise.\n'),
+            ('\t* foo.c: xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx "a b"\n'
+             '\tx"a b"\n'
+             '\n'
+             '\t(bar): Likewise.\n'))
+
     def test_get_funcname(self):
         self.assertEqual(
             Source('void\n'
@@ -209,6 +309,1371 @@ class ChangeLogTests(unittest.TestCase):
              '\t* cgraph.h (cgraph_create_edge): Replace "gimple" typedef with\n'
              '\t"gimple *".\n'))
 
+class ChangeLogLayoutTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = make_tree({'gcc/ChangeLog': '',
+                                 'gcc/cp/ChangeLog': '',
+                                 'gcc/cp/foo.c': ''})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_locate_dir(self):
+        cll = ChangeLogLayout(self.tmpdir)
+        gccdir = os.path.join(self.tmpdir, 'gcc')
+        self.assertEqual(cll.dirs, [gccdir, os.path.join(gccdir, 'cp')])
+        self.assertEqual(cll.locate_dir(os.path.join(gccdir, 'cp/foo.c')),
+                         os.path.join(gccdir, 'cp'))
+        self.assertEqual(cll.locate_dir(os.path.join(gccdir, 'cpp/foo.c')),
+                         gccdir)
+        self.assertEqual(cll.locate_dir(os.path.join(gccdir, 'cp')),
+                         gccdir)
+        self.assertRaises(ValueError,
+                          cll.locate_dir, os.path.join(self.tmpdir, 'foo.c'))
+        # The dirs can be replaced:
+        cll.dirs = ['./libcpp']
+        self.assertEqual(cll.locate_dir('./libcpp/macro.c'), './libcpp')
+
+    def test_cache(self):
+        init_git_repo(self.tmpdir)
+        check_call(['git', 'add', 'gcc'], cwd=self.tmpdir)
+        dirs = ChangeLogLayout(self.tmpdir).dirs
+
+        # A ChangeLog that isn't in git yet isn't noticed...
+        os.mkdir(os.path.join(self.tmpdir, 'libcpp'))
+        with open(os.path.join(self.tmpdir, 'libcpp/ChangeLog'), 'w') as f:
+            f.write('')
+        self.assertEqual(ChangeLogLayout(self.tmpdir).dirs, dirs)
+        # ...unless the cache isn't used:
+        self.assertIn(os.path.join(self.tmpdir, 'libcpp'),
+                      ChangeLogLayout(self.tmpdir, use_cache=False).dirs)
+
+        # ...but adding it to git invalidates the cache:
+        check_call(['git', 'add', 'libcpp'], cwd=self.tmpdir)
+        self.assertEqual(ChangeLogLayout(self.tmpdir).dirs,
+                         sorted(dirs + [os.path.join(self.tmpdir, 'libcpp')]))
+
+class PrependTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = make_tree({'gcc/ChangeLog':
+                                     ''.join('old entry %i\n' % i
+                                             for i in range(100))})
+        self.clog = os.path.join(self.tmpdir, 'gcc/ChangeLog')
+        os.chmod(self.clog, 0640)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self):
+        with open(self.clog) as f:
+            return f.read()
+
+    def test_prepend_to_file(self):
+        old = self.read()
+        prepend_to_file(self.clog, ['first\n', 'second\n'])
+        self.assertEqual(self.read(), 'second\nfirst\n' + old)
+        self.assertEqual(os.stat(self.clog).st_mode & 0777, 0640)
+        self.assertEqual(os.listdir(os.path.dirname(self.clog)),
+                         ['ChangeLog'])
+
+    def test_write_new_file(self):
+        path = os.path.join(self.tmpdir, 'gcc/ChangeLog-2014')
+        write_file_atomically(path, 'new entries\n')
+        with open(path) as f:
+            self.assertEqual(f.read(), 'new entries\n')
+        self.assertEqual(os.stat(path).st_mode & 0777,
+                         0666 & ~refactor.UMASK)
+
+    def test_additions(self):
+        old = self.read()
+        cla = ChangeLogAdditions(ChangeLogLayout(self.tmpdir), TEST_ISODATE,
+                                 AUTHOR, 'This is some header text')
+        clog = Changelog('foo.c')
+        clog.append('bar', 'Do something.')
+        cla.add_file(os.path.join(self.tmpdir, 'gcc/foo.c'), clog)
+        diffs = DiffCollector()
+        cla.apply(diffs)
+        text = cla.text_per_dir[os.path.join(self.tmpdir, 'gcc')] + '\n'
+        self.assertEqual(self.read(), text + old)
+        # The diff is the same as for the whole of the old content:
+        self.assertEqual(diffs.diffs[self.clog],
+                         make_diff('gcc/ChangeLog', old, text + old))
+
+class DiffTests(unittest.TestCase):
+    def test_unchanged(self):
+        self.assertEqual(make_diff('gcc/foo.c', 'foo\n', 'foo\n'), '')
+
+    def test_simple(self):
+        self.maxDiff = 8192
+        self.assertMultiLineEqual(
+            make_diff('gcc/foo.c',
+                      'a\nb\nc\nd\ne\nf\ng\nh\n',
+                      'a\nb\nc\nd\nE\nf\ng\nh\n'),
+            ('diff --git a/gcc/foo.c b/gcc/foo.c\n'
+             '--- a/gcc/foo.c\n'
+             '+++ b/gcc/foo.c\n'
+             '@@ -2,7 +2,7 @@\n'
+             ' b\n'
+             ' c\n'
+             ' d\n'
+             '-e\n'
+             '+E\n'
+             ' f\n'
+             ' g\n'
+             ' h\n'))
+
+    def test_header_like_lines(self):
+        # Removed and added lines that start with "--" and "++" are
+        # content, not headers:
+        self.assertMultiLineEqual(
+            make_diff('gcc/foo.c', 'a\n--i;\nb\n', 'a\n++i;\nb\n'),
+            ('diff --git a/gcc/foo.c b/gcc/foo.c\n'
+             '--- a/gcc/foo.c\n'
+             '+++ b/gcc/foo.c\n'
+             '@@ -1,3 +1,3 @@\n'
+             ' a\n'
+             '---i;\n'
+             '+++i;\n'
+             ' b\n'))
+
+    def test_no_newline_at_end_of_file(self):
+        self.maxDiff = 8192
+        self.assertMultiLineEqual(
+            make_diff('gcc/foo.c', 'foo\nbar', 'foo\nbaz'),
+            ('diff --git a/gcc/foo.c b/gcc/foo.c\n'
+             '--- a/gcc/foo.c\n'
+             '+++ b/gcc/foo.c\n'
+             '@@ -1,2 +1,2 @@\n'
+             ' foo\n'
+             '-bar\n'
+             '\\ No newline at end of file\n'
+             '+baz\n'
+             '\\ No newline at end of file\n'))
+
+    def test_collector_is_ordered(self):
+        diffs = DiffCollector()
+        diffs.add('../src/gcc/b.c', make_diff('gcc/b.c', 'b\n', 'B\n'))
+        diffs.add('../src/gcc/unchanged.c', '')
+        diffs.add('../src/gcc/a.c', make_diff('gcc/a.c', 'a\n', 'A\n'))
+        out = StringIO()
+        diffs.write(out)
+        self.assertEqual(sorted(diffs.diffs), ['../src/gcc/a.c', '../src/gcc/b.c'])
+        self.assertTrue(out.getvalue().startswith('diff --git a/gcc/a.c'))
+        self.assertIn('diff --git a/gcc/b.c', out.getvalue())
+
+    def test_git_apply(self):
+        # Verify that "git apply" accepts the combined patch
+        tmpdir = make_tree({'gcc/foo.c': 'int\nfoo (void)\n{\n  return 0;\n}\n',
+                            'gcc/bar.h': 'extern int bar'})
+        try:
+            diffs = DiffCollector()
+            diffs.add('gcc/foo.c',
+                      make_diff('gcc/foo.c',
+                                'int\nfoo (void)\n{\n  return 0;\n}\n',
+                                'int\nfoo (void)\n{\n  return 1;\n}\n'))
+            diffs.add('gcc/bar.h',
+                      make_diff('gcc/bar.h', 'extern int bar', 'extern int baz'))
+            with open(os.path.join(tmpdir, 'all.patch'), 'w') as f:
+                diffs.write(f)
+            check_call(['git', 'apply', 'all.patch'], cwd=tmpdir)
+            with open(os.path.join(tmpdir, 'gcc/foo.c')) as f:
+                self.assertEqual(f.read(),
+                                 'int\nfoo (void)\n{\n  return 1;\n}\n')
+            with open(os.path.join(tmpdir, 'gcc/bar.h')) as f:
+                self.assertEqual(f.read(), 'extern int baz')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_split_per_changelog_dir(self):
+        tmpdir = make_tree({'gcc/ChangeLog': '',
+                            'gcc/testsuite/ChangeLog': ''})
+        try:
+            cll = ChangeLogLayout(tmpdir)
+            diffs = DiffCollector()
+            for path in ('gcc/foo.c', 'gcc/testsuite/foo.c'):
+                diffs.add(os.path.join(tmpdir, path),
+                          make_diff(path, 'foo\n', 'bar\n'))
+            outdir = os.path.join(tmpdir, 'patches')
+            written = diffs.write_split(cll, outdir)
+            self.assertEqual([os.path.basename(path) for path in written],
+                             ['gcc.patch', 'gcc_testsuite.patch'])
+            with open(written[1]) as f:
+                self.assertTrue(f.read().startswith(
+                        'diff --git a/gcc/testsuite/foo.c'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+class EditTests(unittest.TestCase):
+    def test_replace_tracks_edits(self):
+        src = Source('aaa bbb ccc ddd\n')
+        # Out of order, and overlapping an earlier edit:
+        dst = src.replace(12, 15, 'DDDD')
+        dst = dst.replace(0, 3, 'A')
+        dst = dst.replace(1, 5, ' BB')
+        self.assertEqual(dst.str(), 'A BB ccc DDDD\n')
+        self.assertEqual(dst.edits,
+                         [Edit(0, 7, 'A BB'), Edit(12, 15, 'DDDD')])
+        self.assertEqual(apply_edits(src.str(), dst.edits), dst.str())
+        self.assertIs(src.get_latest(), dst)
+        self.assertEqual(get_edits(src, dst.str()), dst.edits)
+
+    def test_get_edits_untracked(self):
+        src = Source('foo\n')
+        src.replace(0, 3, 'bar')
+        # Some text that wasn't built from src via replace:
+        self.assertEqual(get_edits(src, 'baz\n'), None)
+
+    def test_wrap_tracks_edits(self):
+        src = Source('int i;\n'
+                     '                      if (best_edge->dest != ENTRY)\n'
+                     'int j;\n')
+        idx = src.str().index('ENTRY')
+        dst = src.replace(idx, idx + 5, 'cfun->cfg->entry_block_ptr->next_bb')
+        dst = dst.wrap(tabify_changes=0)
+        self.assertEqual(dst.str(),
+                         'int i;\n'
+                         '                      if (best_edge->dest\n'
+                         '                          != cfun->cfg->entry_block_ptr->next_bb)\n'
+                         'int j;\n')
+        self.assertEqual(get_edits(src, dst.str()), dst.edits)
+        self.assertEqual(apply_edits(src.str(), dst.edits), dst.str())
+
+    def test_diff_from_edits(self):
+        old = ''.join(['line %i\n' % i for i in range(20)])
+        src = Source(old)
+        dst = src.replace(old.index('line 15'), old.index('line 15') + 7,
+                          'LINE 15')
+        dst = dst.replace(old.index('line 12'), old.index('line 13'), '')
+        dst = dst.replace(old.index('line 2'), old.index('line 2'),
+                          'new line\n')
+        self.maxDiff = 8192
+        self.assertMultiLineEqual(
+            make_diff_from_edits('gcc/foo.c', old, dst.edits),
+            make_diff('gcc/foo.c', old, dst.str()))
+
+    def test_diff_from_edits_at_end_of_file(self):
+        old = 'foo\nbar'
+        self.assertMultiLineEqual(
+            make_diff_from_edits('gcc/foo.c', old, [Edit(4, 7, 'baz\n')]),
+            make_diff('gcc/foo.c', old, 'foo\nbaz\n'))
+
+    def test_diff_from_edits_prepend(self):
+        # As used for ChangeLog files:
+        old = ''.join(['line %i\n' % i for i in range(1000)])
+        self.assertMultiLineEqual(
+            make_diff_from_edits('gcc/ChangeLog', old,
+                                 [Edit(0, 0, 'header\n\n')]),
+            ('diff --git a/gcc/ChangeLog b/gcc/ChangeLog\n'
+             '--- a/gcc/ChangeLog\n'
+             '+++ b/gcc/ChangeLog\n'
+             '@@ -1,3 +1,5 @@\n'
+             '+header\n'
+             '+\n'
+             ' line 0\n'
+             ' line 1\n'
+             ' line 2\n'))
+
+def make_result(path):
+    clog = Changelog(os.path.basename(path))
+    clog.append('foo', 'Do something.')
+    return FileResult(path, clog, 'diff of %s' % path,
+                      base_id='0' * 40, edits=[Edit(0, 1, 'replacement\xff')],
+                      result_id='1' * 40)
+
+test_spool = None
+def spool_one(path):
+    return test_spool.write(make_result(path))
+
+def fail_to_refactor(clog_filename, src):
+    raise ValueError('failed to refactor %s' % clog_filename)
+
+def get_files_left_by_failure(*args):
+    """
+    Run main in-process, with the given arguments, and a refactoring that
+    fails, returning the names of the temporary files that it leaves
+    """
+    tmpdir = make_script_tree({'src/gcc/a.c': 'int i;\n'})
+    oldcwd = os.getcwd()
+    os.chdir(os.path.join(tmpdir, 'scripts'))
+    tempfile.tempdir = os.path.join(tmpdir, 'tmp')
+    os.mkdir(tempfile.tempdir)
+    try:
+        try:
+            main('test_refactor.py', fail_to_refactor,
+                 ['test_refactor.py', '--dry-run', '--patch', os.devnull]
+                 + list(args))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('the refactoring did not fail')
+        return os.listdir(tempfile.tempdir)
+    finally:
+        tempfile.tempdir = None
+        os.chdir(oldcwd)
+        shutil.rmtree(tmpdir)
+
+class SpoolTests(unittest.TestCase):
+    def assertResultEqual(self, result, path):
+        self.assertEqual(result.path, path)
+        self.assertEqual(result.changelog.filename, os.path.basename(path))
+        self.assertEqual(result.changelog.scope_to_text.items(),
+                         [('foo', 'Do something.')])
+        self.assertEqual(result.diff, 'diff of %s' % path)
+        self.assertEqual(result.edits, [Edit(0, 1, 'replacement\xff')])
+        self.assertEqual(result.result_id, '1' * 40)
+
+    def test_round_trip(self):
+        spool = Spool()
+        try:
+            locations = [spool.write(make_result(path))
+                         for path in ('gcc/a.c', 'gcc/b.c')]
+            self.assertResultEqual(spool.read(locations[1]), 'gcc/b.c')
+            # Written after the file was first mapped:
+            location = spool.write(make_result('gcc/c.c'))
+            self.assertResultEqual(spool.read(location), 'gcc/c.c')
+            self.assertResultEqual(spool.read(locations[0]), 'gcc/a.c')
+        finally:
+            spool.close()
+
+    def test_from_pool(self):
+        global test_spool
+        test_spool = Spool()
+        try:
+            paths = ['gcc/%i.c' % i for i in range(20)]
+            pool = Pool(2)
+            locations = pool.map(spool_one, paths)
+            pool.close()
+            pool.join()
+            for path, location in zip(paths, locations):
+                self.assertResultEqual(test_spool.read(location), path)
+        finally:
+            test_spool.close()
+            test_spool = None
+
+    def test_failure(self):
+        self.assertEqual(get_files_left_by_failure('--transport', 'spool'),
+                         [])
+
+def busy(n):
+    return sum(i * i for i in xrange(n))
+
+class ProfilerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_merge(self):
+        pstats_path = os.path.join(self.tmpdir, 'out.pstats')
+        folded_path = os.path.join(self.tmpdir, 'out.folded')
+        handler = signal.getsignal(signal.SIGPROF)
+        profiler = Profiler()
+        try:
+            # Each worker writes its own files, which are merged:
+            pool = Pool(2, init_profiler, (profiler, ))
+            self.assertEqual(pool.map(profile_busy, [100000] * 4),
+                             [busy(100000)] * 4)
+            pool.close()
+            pool.join()
+            self.assertEqual(profiler.run(busy, 3000000), busy(3000000))
+            profiler.merge(pstats_path, folded_path)
+        finally:
+            profiler.close()
+        # (It sampled in this process too, but no longer does):
+        self.assertEqual(signal.getsignal(signal.SIGPROF), handler)
+        stats = pstats.Stats(pstats_path)
+        calls = dict((func[2], stat[0])
+                     for func, stat in stats.stats.iteritems())
+        self.assertEqual(calls['busy'], 5)
+        with open(folded_path) as f:
+            lines = f.readlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertTrue(stack.startswith('busy (test_refactor.py:'))
+            self.assertGreater(int(count), 0)
+
+    def test_script(self):
+        tmpdir = make_script_tree({'src/gcc/a.c':
+                                       'int i = n_basic_blocks;\n'})
+        self.addCleanup(shutil.rmtree, tmpdir)
+        out, err = run_script(tmpdir, '--dry-run', '--profile', '../out')
+        self.assertIn('+int i = cfun->cfg->n_basic_blocks;\n', out)
+        stats = pstats.Stats(os.path.join(tmpdir, 'out.pstats'))
+        self.assertIn('do_one_path', [func[2] for func in stats.stats])
+        self.assertTrue(os.path.exists(os.path.join(tmpdir, 'out.folded')))
+
+    def test_failure(self):
+        self.assertEqual(get_files_left_by_failure('--profile', '../out'), [])
+
+test_profiler = None
+def init_profiler(profiler):
+    global test_profiler
+    test_profiler = profiler
+
+def profile_busy(n):
+    return test_profiler.run(busy, n)
+
+class ProgressTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = make_tree({'gcc/a.c': 'a' * 1000,
+                                 'gcc/b.c': 'b' * 3000})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_line(self):
+        tasks = [os.path.join(self.tmpdir, 'gcc/a.c'),
+                 (os.path.join(self.tmpdir, 'gcc/b.c'), 0, 1000),
+                 (os.path.join(self.tmpdir, 'gcc/b.c'), 1000, 3000)]
+        out = StringIO()
+        progress = Progress(tasks, out)
+        self.assertEqual(progress.total_bytes, 4000)
+        try:
+            # A worker working on b.c (as for the ChangeSet, the Progress
+            # is handed to the workers as they start):
+            pool = Pool(1, init_progress, (progress, ))
+            pool.apply(note_progress, (tasks[1][0], ))
+            progress.finished(tasks[0], FileResult(tasks[0], None, None,
+                                                   edits=[Edit(0, 1, 'x')]))
+            line = progress.get_line()
+            self.assertTrue(line.startswith('1/3 files, 1 edits, '), line)
+            self.assertIn(', slowest: %s (' % tasks[1][0], line)
+            progress.update()
+            self.assertTrue(out.getvalue().startswith('\r1/3 files'))
+            # ...and then finishing it:
+            pool.apply(note_progress, (None, ))
+            pool.close()
+            pool.join()
+            self.assertNotIn('slowest', progress.get_line())
+        finally:
+            progress.close()
+
+    def test_log(self):
+        tmpdir = make_script_tree({'src/gcc/a.c': 'int i = n_basic_blocks;\n',
+                                   'src/gcc/b.c': 'int j;\n'})
+        self.addCleanup(shutil.rmtree, tmpdir)
+        out, err = run_script(tmpdir, '--dry-run', '--log', '../log')
+        # Nothing is written per file to stderr (which isn't a terminal):
+        self.assertEqual(err, '')
+        with open(os.path.join(tmpdir, 'log')) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual([entry['event'] for entry in entries],
+                         ['run started', 'task finished', 'task finished',
+                          'run finished'])
+        self.assertEqual(entries[0]['files'], 2)
+        a_c = entries[1]
+        self.assertEqual((a_c['path'], a_c['bytes'], a_c['edits']),
+                         ('../src/gcc/a.c', 24, 1))
+        self.assertEqual(a_c['counters']['matches'], 1)
+
+global_progress = None
+def init_progress(progress):
+    global global_progress
+    global_progress = progress
+
+def note_progress(path):
+    if path:
+        global_progress.started(path)
+    else:
+        global_progress.stopped()
+
+class IOThreadsTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = make_tree(dict(('%i.c' % i, 'content of %i\n' % i)
+                                     for i in range(10)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_ahead(self):
+        paths = [os.path.join(self.tmpdir, '%i.c' % i) for i in range(10)]
+        tasks = paths[:5] + [(paths[5], 0, 5), (paths[5], 5, 15)] + paths[6:]
+        io = IOThreads(3, depth=2)
+        pool = ThreadPool(1)
+        try:
+            # (As the tasks are consumed by main):
+            items = list(io.consuming(pool.imap(lambda item: item,
+                                                io.read_ahead(tasks))))
+        finally:
+            pool.close()
+            io.close()
+        self.assertEqual([task for task, text in items], tasks)
+        self.assertEqual(items[6], ((paths[5], 5, 15), 'content of 5\n'))
+        self.assertEqual(items[10], (paths[9], 'content of 9\n'))
+        self.assertEqual(io.take_text(paths[3]), 'content of 3\n')
+        self.assertEqual(io.take_text(paths[3]), None)
+
+    def test_depth(self):
+        paths = [os.path.join(self.tmpdir, '%i.c' % i) for i in range(10)]
+        io = IOThreads(1, depth=3)
+        items = []
+        def hand_out():
+            for item in io.read_ahead(paths):
+                items.append(item)
+        thread = threading.Thread(target=hand_out)
+        thread.start()
+        try:
+            # No more than depth tasks should be handed out until their
+            # results are consumed:
+            thread.join(0.2)
+            self.assertEqual(len(items), 3)
+            self.assertEqual(len(io.texts), 3)
+            for result in io.consuming(['result'] * 2):
+                pass
+            thread.join(0.2)
+            self.assertEqual(len(items), 5)
+        finally:
+            for result in io.consuming(['result'] * (10 - 2)):
+                pass
+            thread.join()
+            io.close()
+        self.assertEqual(len(items), 10)
+
+    def test_write(self):
+        path = os.path.join(self.tmpdir, '0.c')
+        os.chmod(path, 0751)
+        io = IOThreads(2)
+        io.write(path, 'new content\n')
+        io.close()
+        with open(path) as f:
+            self.assertEqual(f.read(), 'new content\n')
+        self.assertEqual(os.stat(path).st_mode & 0777, 0751)
+        # The temporary file should have been renamed into place:
+        self.assertEqual(len(os.listdir(self.tmpdir)), 10)
+
+    def test_write_failure(self):
+        io = IOThreads(1)
+        io.write(os.path.join(self.tmpdir, 'no-such-dir', '0.c'), '')
+        self.assertRaises(OSError, io.close)
+
+class EstimateTests(unittest.TestCase):
+    def setUp(self):
+        files = {'src/gcc/cp/ChangeLog': 'old entries\n'}
+        for i in range(40):
+            files['src/gcc/small-%i.c' % i] = 'int i = n_basic_blocks;\n'
+        for i in range(10):
+            files['src/gcc/big-%i.c' % i] = 'int i;\n' * 1000
+        files['src/gcc/cp/foo.c'] = 'int i;\n'
+        self.tmpdir = make_script_tree(files)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_stratified_sample(self):
+        srcdir = os.path.join(self.tmpdir, 'src')
+        paths = sorted(os.path.join(dirpath, name)
+                       for dirpath, dirnames, filenames in os.walk(srcdir)
+                       for name in filenames
+                       if name.endswith('.c'))
+        strata = stratified_sample(ChangeLogLayout(srcdir), paths, 10,
+                                   random.Random(0))
+        self.assertEqual(sorted((len(stratum_paths), len(sample))
+                                for stratum_paths, sample in strata.values()),
+                         [(1, 1), (10, 2), (40, 8)])
+        for stratum_paths, sample in strata.values():
+            self.assertTrue(set(sample) <= set(stratum_paths))
+
+    def test_get_stratum(self):
+        srcdir = os.path.join(self.tmpdir, 'src')
+        cll = ChangeLogLayout(srcdir)
+        path = os.path.join(srcdir, 'gcc/cp/foo.c')
+        strata = []
+        for size in (0, 1, 3, 4, 15, 16, 4 ** 5 - 1, 4 ** 5):
+            with open(path, 'w') as f:
+                f.truncate(size)
+            strata.append(get_stratum(cll, path))
+        self.assertEqual(strata,
+                         [(os.path.join(srcdir, 'gcc/cp'), bucket)
+                          for bucket in (0, 0, 0, 1, 1, 2, 4, 5)])
+
+    def test_estimate(self):
+        out, err = run_script(self.tmpdir, '--estimate', '10')
+        self.assertIn('sampled 11 of 51 files (3 strata)', out)
+        # All 40 of the small files need changing, and nothing else does:
+        self.assertIn('projected edits: 40 +/- 0, in 40 +/- 0 files', out)
+        self.assertIn('ChangeLog directories touched by the sample: gcc\n',
+                      out)
+        with open(os.path.join(self.tmpdir, 'src/gcc/small-0.c')) as f:
+            self.assertEqual(f.read(), 'int i = n_basic_blocks;\n')
+
+def not_in_comment(clog_filename, src, m):
+    return not src.within_comment_at(m.start())
+
+class SurveyTests(unittest.TestCase):
+    def test_survey_text(self):
+        rules = [Rule('n_basic_blocks', 'n_basic_blocks', 'n_basic_blocks',
+                      not_in_comment),
+                 Rule('ENTRY_BLOCK_PTR', 'ENTRY_BLOCK_PTR')]
+        text = ('/* Uses n_basic_blocks.  */\n'
+                'int i = n_basic_blocks + n_basic_blocks;\n')
+        self.assertEqual(survey_text('foo.c', text, rules), [2, 0])
+        # The literal lets us skip the file without running the pattern:
+        self.assertEqual(survey_text('foo.c', 'int i;\n',
+                                     [Rule('int', 'int', 'n_basic_blocks')]),
+                         [0])
+
+    def test_write_survey(self):
+        counts_by_path = {'gcc/foo.c': [2, 0],
+                          'gcc/bar.c': [1, 3],
+                          'gcc/baz.c': [0, 0],
+                          'gcc/cp/qux.c': [0, 1]}
+        out = StringIO()
+        write_survey(out, 'csv', ['a', 'b'], counts_by_path)
+        self.assertEqual(out.getvalue(),
+                         'path,a,b\n'
+                         'gcc/bar.c,1,3\n'
+                         'gcc/cp/qux.c,0,1\n'
+                         'gcc/foo.c,2,0\n'
+                         'gcc/,3,3\n'
+                         'gcc/cp/,0,1\n')
+        out = StringIO()
+        write_survey(out, 'json', ['a', 'b'], counts_by_path)
+        obj = json.loads(out.getvalue())
+        self.assertEqual(obj['rules'], ['a', 'b'])
+        self.assertEqual(obj['files']['gcc/cp/qux.c'], {'b': 1})
+        self.assertNotIn('gcc/baz.c', obj['files'])
+        self.assertEqual(obj['dirs']['gcc'], {'a': 3, 'b': 3})
+
+    def test_survey(self):
+        tmpdir = make_script_tree({'src/gcc/foo.c':
+                                       ('/* n_basic_blocks */\n'
+                                        'int i = n_basic_blocks;\n'),
+                                   'src/gcc/cp/bar.c': 'int i;\n'})
+        try:
+            out, err = run_script(tmpdir, '--survey', 'csv')
+            rows = list(csv.reader(StringIO(out)))
+            col = rows[0].index('n_basic_blocks')
+            self.assertEqual([(row[0], row[col]) for row in rows[1:]],
+                             [('gcc/foo.c', '1'), ('gcc/', '1')])
+            # A survey doesn't touch the tree:
+            with open(os.path.join(tmpdir, 'src/gcc/foo.c')) as f:
+                self.assertIn('int i = n_basic_blocks;\n', f.read())
+        finally:
+            shutil.rmtree(tmpdir)
+
+class DedupTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = make_script_tree(
+            {'src/gcc/config/ChangeLog': 'old entries\n',
+             'src/gcc/a.c': 'int i = n_basic_blocks;\n',
+             'src/gcc/b.c': 'int j = n_basic_blocks;\n',
+             'src/gcc/config/a.c': 'int i = n_basic_blocks;\n',
+             'src/gcc/config/i386/a.c': 'int i = n_basic_blocks;\n',
+             'src/gcc/config/i386/c.c': 'int i;\n',
+             'src/gcc/config/i386/d.c': 'int i;\n',
+             # (Excluded by refactor_cfun, by name):
+             'src/gcc/basic-block.h': 'int i = n_basic_blocks;\n'})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_script(self, *args):
+        return run_script(self.tmpdir, *args)
+
+    def test_dedup(self):
+        expected, err = self.run_script('--dry-run')
+        out, err = self.run_script('--dry-run', '--dedup')
+        # Only gcc/config/a.c is a copy of gcc/a.c, as far as the
+        # refactoring can tell (the others have different names):
+        self.assertIn('1 of 7 files are duplicates\n', err)
+        self.assertEqual(out, expected)
+        self.assertNotIn('basic-block.h', out)
+        # Each copy gets its own ChangeLog entry:
+        self.assertIn('+\t* a.c: Remove usage of n_basic_blocks macro.\n'
+                      '+\t* i386/a.c: Likewise.\n',
+                      out)
+
+        self.run_script('--dedup')
+        for path in ('src/gcc/a.c', 'src/gcc/config/a.c',
+                     'src/gcc/config/i386/a.c'):
+            with open(os.path.join(self.tmpdir, path)) as f:
+                self.assertEqual(f.read(), 'int i = cfun->cfg->n_basic_blocks;\n')
+        with open(os.path.join(self.tmpdir, 'src/gcc/basic-block.h')) as f:
+            self.assertEqual(f.read(), 'int i = n_basic_blocks;\n')
+
+class MultiTreeTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = make_script_tree(
+            {'trunk/gcc/ChangeLog': 'old entries\n',
+             'trunk/gcc/a.c': 'int i = n_basic_blocks;\n',
+             'trunk/gcc/b.c': 'int j = n_basic_blocks;\n',
+             'branch/gcc/ChangeLog': 'old entries\n',
+             'branch/gcc/a.c': 'int i = n_basic_blocks;\n',
+             'branch/gcc/b.c': 'int j;\n'})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_script(self, *args):
+        return run_script(self.tmpdir, *args)
+
+    def read(self, path):
+        with open(os.path.join(self.tmpdir, path)) as f:
+            return f.read()
+
+    def test_several_trees(self):
+        expected = {}
+        for name in ('trunk', 'branch'):
+            expected[name], err = self.run_script('--dry-run',
+                                                  '--srcdir', '../%s' % name)
+        out, err = self.run_script('--dry-run',
+                                   '--srcdir', '../trunk',
+                                   '--srcdir', '../branch',
+                                   '--patch', '../%s.patch')
+        # gcc/a.c is the same in both trees:
+        self.assertIn('1 of 4 files are duplicates\n', err)
+        for name in ('trunk', 'branch'):
+            self.assertEqual(self.read('%s.patch' % name), expected[name])
+        self.assertIn('+int j = cfun->cfg->n_basic_blocks;\n',
+                      expected['trunk'])
+        self.assertNotIn('gcc/b.c', expected['branch'])
+
+        self.run_script('--srcdir', '../trunk', '--srcdir', '../branch',
+                        '--patch', '../%s.patch')
+        for name in ('trunk', 'branch'):
+            self.assertEqual(self.read('%s/gcc/a.c' % name),
+                             'int i = cfun->cfg->n_basic_blocks;\n')
+            self.assertIn('* a.c: Remove usage of n_basic_blocks macro.\n',
+                          self.read('%s/gcc/ChangeLog' % name))
+
+class TimedExample:
+    # (timed only applies to functions defined at the top level of a
+    # module, or within classes there):
+    def __init__(self, test):
+        self.test = test
+
+    @timed('scope', 'scope lookups')
+    def lookup(self):
+        self.test.now += 0.25
+        return 'foo'
+
+class TimingsTests(unittest.TestCase):
+    def setUp(self):
+        # A fake clock, advanced by the tests:
+        self.now = 0.0
+        self.real_monotonic = refactor.monotonic
+        refactor.monotonic = lambda: self.now
+
+    def tearDown(self):
+        refactor.monotonic = self.real_monotonic
+        refactor.activate_timings(None)
+
+    def test_nesting(self):
+        timings = Timings()
+        timings.start('refactor')
+        self.now += 1.0
+        with timings.phase('match'):
+            self.now += 0.5
+        self.now += 2.0
+        timings.stop()
+        # The time spent matching isn't also charged to the refactoring:
+        self.assertEqual(timings.phases, {'refactor': 3.0, 'match': 0.5})
+        self.assertEqual(timings.get_total(), 3.5)
+
+    def test_timed(self):
+        lookup = TimedExample(self).lookup
+        # Without a current Timings, nothing is recorded:
+        self.assertEqual(lookup(), 'foo')
+        timings = Timings()
+        refactor.activate_timings(timings)
+        lookup = TimedExample(self).lookup
+        self.assertEqual(lookup(), 'foo')
+        lookup()
+        self.assertEqual(timings.phases, {'scope': 0.5})
+        self.assertEqual(timings.counters, {'scope lookups': 2})
+
+    def test_timed_unwrapped(self):
+        # The wrappers are only in place whilst there's a current Timings:
+        fn, wrapper = [(fn, wrapper)
+                       for fn, wrapper, owner in refactor._timed
+                       if fn.__name__ == 'within_comment_at'][0]
+        self.assertIs(vars(Source)['within_comment_at'], fn)
+        refactor.activate_timings(Timings())
+        self.assertIs(vars(Source)['within_comment_at'], wrapper)
+        refactor.activate_timings(Timings())
+        self.assertIs(vars(Source)['within_comment_at'], wrapper)
+        refactor.activate_timings(None)
+        self.assertIs(vars(Source)['within_comment_at'], fn)
+        self.assertIs(vars(refactor)['wrap'], wrap)
+
+    def test_source(self):
+        timings = Timings()
+        refactor.activate_timings(timings)
+        src = Source('int i = n_basic_blocks, j = n_basic_blocks;\n', 'foo.c')
+        for m in src.finditer('n_basic_blocks'):
+            src = src.replace(m.start(), m.end(), 'NUM_BLOCKS')
+        self.assertEqual(timings.counters, {'matches': 2, 'edits': 2})
+        self.assertEqual(sorted(timings.phases), ['match', 'replace'])
+
+    def test_regexes(self):
+        timings = Timings(regexes=True)
+        refactor.activate_timings(timings)
+        src = Source('int i = n_basic_blocks, j = n_basic_blocks;\n', 'foo.c')
+        src.window = (0, 24)
+        self.assertEqual(len(src.finditer('n_basic_blocks')), 1)
+        src.window = None
+        self.assertEqual(len(src.finditer('n_basic_blocks')), 2)
+        self.assertTrue(src.search(re.compile('j =')))
+        # (The fake clock doesn't move during the calls):
+        self.assertEqual(timings.regexes,
+                         {'n_basic_blocks': [2, 0.0, 24 + 44, 0.0],
+                          'j =': [1, 0.0, 44, 0.0]})
+
+        # They survive being sent back from a worker, and are combined:
+        timings = Timings.from_json(json.loads(json.dumps(timings.to_json())))
+        totals = Timings()
+        totals.add(timings)
+        totals.add(timings)
+        self.assertEqual(totals.regexes['j ='], [2, 0.0, 88, 0.0])
+
+        out = StringIO()
+        refactor.write_regex_profile(out, {'slow': [1, 2.0, 1000000, 2.0],
+                                           'fast': [5, 0.5, 3000000, 0.25]})
+        self.assertEqual(out.getvalue().splitlines()[1:],
+                         ['       1      2.000        1.0     2.0000  \'slow\'',
+                          '       5      0.500        3.0     0.2500  \'fast\''])
+
+    def test_memory(self):
+        MB = 1024 * 1024
+        a = Timings(memory=True)
+        a.pid = 100
+        a.memory = {'read': 10 * MB, 'match': 30 * MB}
+        a.peaks = {'rss': 40 * MB, 'rss growth': 5 * MB}
+        b = Timings(memory=True)
+        b.pid = 101
+        b.memory = {'read': 20 * MB, 'match': 25 * MB}
+        b.peaks = {'rss': 50 * MB, 'rss growth': 20 * MB}
+        # The chunks of a file are combined by taking the highest:
+        total = Timings()
+        total.add(a)
+        total.add(Timings.from_json(json.loads(json.dumps(b.to_json()))))
+        self.assertEqual(total.memory, {'read': 20 * MB, 'match': 30 * MB})
+        self.assertEqual(total.peaks, {'rss': 50 * MB, 'rss growth': 20 * MB})
+        self.assertEqual(total.pid, 101)
+
+        out = StringIO()
+        refactor.write_memory_profile(out, {'gcc/a.c': a, 'gcc/b.c': b})
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[2:4], ['     101       50.0        1',
+                                      '     100       40.0        1'])
+        # b.c raised its worker's peak the most; a.c peaked in "match":
+        self.assertTrue(lines[6].startswith('      20.0       50.0'))
+        self.assertTrue(lines[6].endswith('gcc/b.c'))
+        self.assertTrue(lines[7].endswith(' match            gcc/a.c'))
+        self.assertEqual(lines[-2:], ['      30.0  match',
+                                      '      20.0  read'])
+
+    def test_memory_sampling(self):
+        samples = []
+        def get_rss():
+            samples.append(len(samples))
+            return samples[-1]
+        real_get_rss = refactor.get_rss
+        refactor.get_rss = get_rss
+        try:
+            timings = Timings(memory=True)
+            with timings.phase('other'):
+                with timings.phase('refactor'):
+                    for i in range(10):
+                        with timings.phase('match'):
+                            pass
+                with timings.phase('write'):
+                    pass
+        finally:
+            refactor.get_rss = real_get_rss
+        # Only the outer phases are sampled, as each stretch of them ends
+        # (and not for each match):
+        self.assertEqual(len(samples), 5)
+        self.assertEqual(timings.memory, {'other': 4, 'refactor': 1,
+                                          'write': 3})
+
+    def test_add(self):
+        a = Timings()
+        a.phases = {'read': 1.0, 'match': 2.0}
+        a.count('matches', 3)
+        b = Timings.from_json(json.loads(json.dumps(a.to_json())))
+        b.add(a)
+        self.assertEqual(b.phases, {'read': 2.0, 'match': 4.0})
+        self.assertEqual(b.counters, {'matches': 6})
+
+    def test_report(self):
+        refactor.monotonic = self.real_monotonic
+        tmpdir = make_script_tree({'src/gcc/a.c': 'int i = n_basic_blocks;\n',
+                                   'src/gcc/b.c': 'int j;\n',
+                                   'src/gcc/c.c': ('int i = n_basic_blocks;\n'
+                                                   '}\n'
+                                                   'int j = n_basic_blocks;\n'
+                                                   '}\n')})
+        try:
+            report = os.path.join(tmpdir, 'report.json')
+            out, err = run_script(tmpdir, '--dry-run',
+                                  '--report', report, '--report-top', '2',
+                                  '--profile-memory',
+                                  '--transport', 'spool',
+                                  '--split-threshold', '30',
+                                  '--chunk-size', '20')
+            with open(report) as f:
+                report = json.load(f)
+            self.assertEqual(report['script'], 'refactor_cfun.py')
+            self.assertEqual(report['files']['count'], 3)
+            # c.c was refactored in two chunks, whose timings are combined:
+            self.assertEqual(report['files']['counters'],
+                             {'matches': 3, 'edits': 3, 'scope lookups': 3})
+            self.assertIn('read', report['files']['phases'])
+            self.assertIn('diff', report['files']['phases'])
+            self.assertIn('refactor', report['run']['phases'])
+            self.assertEqual(len(report['slowest']), 2)
+            totals = [item['total'] for item in report['slowest']]
+            self.assertEqual(totals, sorted(totals, reverse=True))
+            # With --profile-memory, each file has its peaks too:
+            for item in report['slowest']:
+                self.assertGreater(item['peaks']['rss'], 0)
+                self.assertGreater(item['memory']['refactor'], 0)
+            self.assertIn('peak RSS per worker:\n', err)
+            self.assertIn('../src/gcc/c.c\n', err)
+        finally:
+            shutil.rmtree(tmpdir)
+
+class InotifyTests(unittest.TestCase):
+    def test_events(self):
+        tmpdir = make_tree({'foo.c': ''})
+        inotify = Inotify()
+        try:
+            inotify.add_watch(tmpdir, Inotify.IN_CLOSE_WRITE | Inotify.IN_CREATE)
+            self.assertEqual(inotify.read_events(0), [])
+            with open(os.path.join(tmpdir, 'foo.c'), 'w') as f:
+                f.write('bar')
+            os.mkdir(os.path.join(tmpdir, 'subdir'))
+            events = inotify.read_events(1)
+            self.assertEqual(events,
+                             [(os.path.join(tmpdir, 'foo.c'),
+                               Inotify.IN_CLOSE_WRITE),
+                              (os.path.join(tmpdir, 'subdir'),
+                               Inotify.IN_CREATE | Inotify.IN_ISDIR)])
+        finally:
+            inotify.close()
+            shutil.rmtree(tmpdir)
+
+class WatchTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = make_script_tree({'src/gcc/foo.c': 'int i;\n'})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read_until(self, f, text, timeout=10):
+        """
+        Read lines from file f until one of them contains text
+        """
+        lines = []
+        while not lines or text not in lines[-1]:
+            if not select.select([f], [], [], timeout)[0]:
+                self.fail('timed out waiting for %r in %r' % (text, lines))
+            lines.append(f.readline())
+        return ''.join(lines)
+
+    def test_watch(self):
+        proc = start_script(self.tmpdir, '--watch')
+        try:
+            self.read_until(proc.stderr, 'watching')
+            with open(os.path.join(self.tmpdir, 'src/gcc/foo.c'), 'w') as f:
+                f.write('int i = n_basic_blocks;\n')
+            output = self.read_until(proc.stdout,
+                                     '+int i = cfun->cfg->n_basic_blocks;')
+            self.assertIn('diff --git a/gcc/foo.c b/gcc/foo.c\n', output)
+        finally:
+            proc.kill()
+            proc.wait()
+        # Watching shouldn't modify anything:
+        with open(os.path.join(self.tmpdir, 'src/gcc/foo.c')) as f:
+            self.assertEqual(f.read(), 'int i = n_basic_blocks;\n')
+
+    def test_watch_imports(self):
+        # Changes to the modules that the script imports from alongside
+        # it should rerun it too:
+        scriptsdir = os.path.join(self.tmpdir, 'scripts')
+        with open(os.path.join(scriptsdir, 'rename_helper.py'), 'w') as f:
+            f.write("NEW_NAME = 'NUM_BLOCKS'\n")
+        with open(os.path.join(scriptsdir, 'refactor_test.py'), 'w') as f:
+            f.write('import sys\n'
+                    'from refactor import main\n'
+                    'import rename_helper\n'
+                    'from test_refactor import rename_n_basic_blocks\n'
+                    "main('refactor_test.py', rename_n_basic_blocks,"
+                    ' sys.argv)\n')
+        env = dict(os.environ,
+                   PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        proc = Popen([sys.executable, '-u', 'refactor_test.py', '--watch'],
+                     cwd=scriptsdir, env=env, stdout=PIPE, stderr=PIPE)
+        try:
+            self.read_until(proc.stderr, 'watching')
+            with open(os.path.join(scriptsdir, 'rename_helper.py'), 'w') as f:
+                f.write("NEW_NAME = 'NUM_BBS'\n")
+            self.read_until(proc.stderr, 'rename_helper.py changed; rerunning')
+            self.read_until(proc.stderr, 'watching')
+        finally:
+            proc.kill()
+            proc.wait()
+
+class CountingContext:
+    """
+    A context that records the process it was built in
+    """
+    def __init__(self, srcdir):
+        self.pid = os.getpid()
+
+def get_context_pid(arg):
+    import refactor
+    return (os.getpid(), refactor.global_cs.context.pid)
+
+class ContextTests(unittest.TestCase):
+    def test_built_once_per_worker(self):
+        cs = ChangeSet('test_refactor.py', None,
+                       context_factory=CountingContext)
+        pool = make_pool(cs)
+        results = pool.map(get_context_pid, range(50), chunksize=1)
+        pool.close()
+        pool.join()
+        # Each worker should have built its own context, once:
+        for worker_pid, context_pid in results:
+            self.assertEqual(worker_pid, context_pid)
+        # ...and the parent shouldn't have built one at all:
+        self.assertIs(cs.context, None)
+
+    def test_prepare(self):
+        cs = ChangeSet('test_refactor.py', None,
+                       context_factory=CountingContext)
+        cs.prepare()
+        context = cs.context
+        cs.prepare()
+        self.assertIs(cs.context, context)
+
+CHUNKED_SRC = ''.join(['static void\n'
+                       'fn_%i (void)\n'
+                       '{\n'
+                       '  use (n_basic_blocks);\n'
+                       '}\n'
+                       '\n' % i
+                       for i in range(10)])
+
+def rename_n_basic_blocks(clog_filename, src):
+    """
+    A simple refactoring, for testing the driver
+    """
+    changelog = Changelog(clog_filename)
+    for m in src.finditer('n_basic_blocks'):
+        scope = src.get_change_scope_at(m.start())
+        src = src.replace(m.start(), m.end(), 'cfun->cfg->n_basic_blocks')
+        changelog.append(scope, 'Remove usage of n_basic_blocks macro.')
+    return src.str(), changelog
+
+def rename_use(clog_filename, src):
+    changelog = Changelog(clog_filename)
+    for m in src.finditer('use \\('):
+        scope = src.get_change_scope_at(m.start())
+        src = src.replace(m.start(), m.end(), 'consume (')
+        changelog.append(scope, 'Rename use to consume.')
+    return src.str(), changelog
+
+def add_comment(clog_filename, src):
+    """
+    A refactoring that doesn't use Source.replace
+    """
+    changelog = Changelog(clog_filename)
+    changelog.append(None, 'Add comment.')
+    return '/* Comment.  */\n' + src.str(), changelog
+
+def rename_with_context(clog_filename, src, context):
+    changelog = Changelog(clog_filename)
+    for m in src.finditer('n_basic_blocks'):
+        scope = src.get_change_scope_at(m.start())
+        src = src.replace(m.start(), m.end(), context)
+        changelog.append(scope, 'Use %s.' % context)
+    return src.str(), changelog
+
+class ChainTests(unittest.TestCase):
+    def test_chain(self):
+        text1, clog1, edits1 = refactor_text(CHUNKED_SRC, 'foo.c',
+                                             rename_n_basic_blocks)
+        text2, clog2, edits2 = refactor_text(text1, 'foo.c', rename_use)
+        dsttext, changelog, edits = \
+            refactor_text(CHUNKED_SRC, 'foo.c',
+                          Chain([rename_n_basic_blocks, rename_use]))
+        self.assertEqual(dsttext, text2)
+        # The edits should be relative to the original text:
+        self.assertEqual(apply_edits(CHUNKED_SRC, edits), text2)
+        self.assertEqual(changelog.scope_to_text['fn_3'],
+                         'Remove usage of n_basic_blocks macro.'
+                         '  Rename use to consume.')
+
+    def test_separate_changelogs(self):
+        dsttext, changelog, edits = \
+            refactor_text(CHUNKED_SRC[:100], 'foo.c',
+                          Chain([rename_n_basic_blocks, rename_use],
+                                separate_changelogs=True))
+        self.assertIsInstance(changelog, StagedChangelog)
+        self.assertEqual(changelog.as_text(None)[0],
+                         ('\t* foo.c (fn_1): Remove usage of n_basic_blocks'
+                          ' macro.\n'
+                          '\t(fn_0): Likewise.\n'
+                          '\t* foo.c (fn_1): Rename use to consume.\n'
+                          '\t(fn_0): Likewise.\n'))
+        result = FileResult('foo.c', changelog, None, edits=edits)
+        for copy in (FileResult.from_record(result.to_record()),
+                     FileResult.from_json(result.to_json())):
+            self.assertEqual(copy.changelog.as_text(None),
+                             changelog.as_text(None))
+
+    def test_chunks(self):
+        chain = Chain([rename_use, rename_n_basic_blocks])
+        whole_text, whole_clog, whole_edits = \
+            refactor_text(CHUNKED_SRC, 'foo.c', chain)
+        chunks = []
+        for window in split_at_top_level(CHUNKED_SRC, 100):
+            dsttext, clog, edits = refactor_text(CHUNKED_SRC, 'foo.c', chain,
+                                                 window=window)
+            chunks.append((window, clog, edits))
+        changelog, edits = stitch_chunks(chunks)
+        self.assertEqual(edits, whole_edits)
+        self.assertEqual(changelog.as_text(None), whole_clog.as_text(None))
+
+    def test_context(self):
+        # Only the stages that take a context are passed it:
+        dsttext, changelog, edits = \
+            refactor_text(CHUNKED_SRC, 'foo.c',
+                          Chain([rename_use, rename_with_context]),
+                          context='NUM_BLOCKS')
+        self.assertIn('consume (NUM_BLOCKS)', dsttext)
+        self.assertEqual(changelog.scope_to_text['fn_3'],
+                         'Rename use to consume.  Use NUM_BLOCKS.')
+
+    def test_append(self):
+        dsttext, changelog, edits = \
+            refactor_text(CHUNKED_SRC[:100], 'foo.c',
+                          Chain([rename_n_basic_blocks, rename_use],
+                                separate_changelogs=True))
+        changelog.append('fn_0', 'Add a comment.')
+        self.assertEqual(changelog.stages[1].scope_to_text['fn_0'],
+                         'Rename use to consume.  Add a comment.')
+        self.assertEqual(changelog.scope_to_text['fn_0'],
+                         'Remove usage of n_basic_blocks macro.'
+                         '  Rename use to consume.  Add a comment.')
+
+    def test_untracked_stage(self):
+        dsttext, changelog, edits = \
+            refactor_text(CHUNKED_SRC, 'foo.c',
+                          Chain([rename_n_basic_blocks, add_comment,
+                                 rename_use]))
+        self.assertTrue(dsttext.startswith('/* Comment.  */\n'))
+        self.assertIn('consume (cfun->cfg->n_basic_blocks)', dsttext)
+        self.assertEqual(edits, None)
+
+class RecordingHooks(Hooks):
+    def __init__(self):
+        self.events = []
+
+    def run_started(self, script, paths):
+        self.events.append(('run_started', script, sorted(paths)))
+
+    def file_dispatched(self, path):
+        self.events.append(('file_dispatched', path))
+
+    def file_started(self, path, pid):
+        self.events.append(('file_started', path, pid != os.getpid()))
+
+    def match(self, path, pattern, start, end):
+        self.events.append(('match', path, pattern, start, end))
+
+    def edit(self, path, start, end, replacement):
+        self.events.append(('edit', path, start, end, replacement))
+
+    def scope(self, path, idx, scope):
+        self.events.append(('scope', path, idx, scope))
+
+    def file_finished(self, result):
+        self.events.append(('file_finished', result.path,
+                            result.timings.counters))
+
+    def changelog_written(self, path, text):
+        self.events.append(('changelog_written', path, text))
+
+    def run_finished(self):
+        self.events.append(('run_finished', ))
+
+class HooksTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = make_script_tree({'src/gcc/a.c': CHUNKED_SRC,
+                                        'src/gcc/b.c': 'int i;\n'})
+        self.oldcwd = os.getcwd()
+        os.chdir(os.path.join(self.tmpdir, 'scripts'))
+
+    def tearDown(self):
+        os.chdir(self.oldcwd)
+        shutil.rmtree(self.tmpdir)
+
+    def run_main(self, *args):
+        hooks = RecordingHooks()
+        main('test_refactor.py', rename_n_basic_blocks,
+             ['test_refactor.py', '--dry-run', '--patch', os.devnull]
+             + list(args),
+             hooks=[hooks])
+        return hooks.events
+
+    def test_events(self):
+        events = self.run_main()
+        self.assertEqual(events[0], ('run_started', 'test_refactor.py',
+                                     ['../src/gcc/a.c', '../src/gcc/b.c']))
+        self.assertEqual(events[1:3],
+                         [('file_dispatched', '../src/gcc/a.c'),
+                          ('file_dispatched', '../src/gcc/b.c')])
+        a_events = [event for event in events
+                    if event[1:2] == ('../src/gcc/a.c', )]
+        self.assertEqual(a_events[1], ('file_started', '../src/gcc/a.c', True))
+        kinds = [event[0] for event in a_events]
+        self.assertEqual(kinds,
+                         ['file_dispatched', 'file_started']
+                         + ['match'] * 10 + ['scope', 'edit'] * 10
+                         + ['file_finished'])
+        # The last match is handled first:
+        idx = CHUNKED_SRC.rindex('n_basic_blocks')
+        self.assertEqual(a_events[12], ('scope', '../src/gcc/a.c', idx, 'fn_9'))
+        self.assertEqual(a_events[13], ('edit', '../src/gcc/a.c', idx,
+                                        idx + len('n_basic_blocks'),
+                                        'cfun->cfg->n_basic_blocks'))
+        self.assertEqual(a_events[-1][2]['edits'], 10)
+        self.assertEqual(events[-2][:2], ('changelog_written',
+                                          '../src/gcc/ChangeLog'))
+        self.assertIn('\t* a.c (fn_9): Remove usage of n_basic_blocks macro.\n',
+                      events[-2][2])
+        self.assertEqual(events[-1], ('run_finished', ))
+
+    def test_chunks(self):
+        expected = self.run_main()
+        # When split into chunks (and sent back via the spool), the events
+        # are combined in order:
+        events = self.run_main('--split-threshold', '100', '--chunk-size',
+                               '100', '--transport', 'spool')
+        a_events = [event for event in events
+                    if event[0] in ('match', 'scope', 'edit')
+                    and event[1] == '../src/gcc/a.c']
+        self.assertEqual(len(a_events), 30)
+        self.assertEqual(sorted(a_events),
+                         sorted(event for event in expected
+                                if event[0] in ('match', 'scope', 'edit')
+                                and event[1] == '../src/gcc/a.c'))
+
+PASS_DATA_SRC = ''.join(['namespace {\n'
+                         '\n'
+                         'const pass_data pass_data_foo%i =\n'
+                         '{\n'
+                         '  GIMPLE_PASS, /* type */\n'
+                         '};\n'
+                         '\n'
+                         'class pass_foo%i : public gimple_opt_pass\n'
+                         '{\n'
+                         '}; // class pass_foo%i\n'
+                         '\n'
+                         '} // anon namespace\n'
+                         '\n' % (i, i, i)
+                         for i in range(40)])
+
+def rename_pass_data(clog_filename, src):
+    """
+    A refactoring whose matches run past the "};" ending the pass_data
+    """
+    changelog = Changelog(clog_filename)
+    for m in src.finditer('pass_data (\\w+) =\n{[^}]*};\n\nclass (\\w+)'):
+        src = src.replace(m.start(1), m.end(1), m.group(2) + '_data')
+        changelog.append(m.group(2), 'Rename pass_data.')
+    return src.str(), changelog
+
+class ChunkTests(unittest.TestCase):
+    def test_window(self):
+        src = Source('foo\nbar\nfoo\nbar\n')
+        src.window = (4, 12)
+        self.assertEqual([m.start() for m in src.finditer('foo|bar')],
+                         [8, 4])
+        self.assertEqual(src.search('foo').start(), 8)
+        dst = src.replace(8, 11, 'FOOO')
+        self.assertEqual(dst.window, (4, 13))
+        self.assertEqual([m.start() for m in dst.finditer_multiline('^bar')],
+                         [4])
+
+    def test_window_end(self):
+        # The string isn't cut short at the end of the window, so "$" and
+        # lookaheads match as they would over the whole of it:
+        src = Source('ab\nabc\n')
+        src.window = (0, 5)
+        self.assertEqual([m.start() for m in src.finditer_multiline('^ab$')],
+                         [0])
+        self.assertEqual(src.search('ab(?!c)').start(), 0)
+        # ...and matches that run past it are refused:
+        self.assertRaises(WindowOverrun, src.finditer, 'b\nabc')
+        self.assertRaises(WindowOverrun, src.search, 'abc')
+
+    def test_split_at_top_level(self):
+        windows = split_at_top_level(CHUNKED_SRC, 100)
+        self.assertTrue(len(windows) > 1)
+        # The windows should cover everything, in order, breaking only
+        # after closing braces:
+        self.assertEqual(windows[0][0], 0)
+        self.assertEqual(windows[-1][1], len(CHUNKED_SRC))
+        for (_, end), (start, _) in zip(windows, windows[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(CHUNKED_SRC[start - 2:start], '}\n')
+
+    def test_stitched_result_matches_whole_file(self):
+        whole_text, whole_clog, whole_edits = \
+            refactor_text(CHUNKED_SRC, 'foo.c', rename_n_basic_blocks)
+        chunks = []
+        for window in split_at_top_level(CHUNKED_SRC, 100):
+            dsttext, clog, edits = refactor_text(CHUNKED_SRC, 'foo.c',
+                                                 rename_n_basic_blocks,
+                                                 window=window)
+            chunks.append((window, clog, edits))
+        changelog, edits = stitch_chunks(chunks)
+        self.assertEqual(edits, whole_edits)
+        self.assertEqual(apply_edits(CHUNKED_SRC, edits), whole_text)
+        self.assertEqual(changelog.as_text(None), whole_clog.as_text(None))
+        self.assertEqual(sorted(changelog.scope_to_text),
+                         sorted(whole_clog.scope_to_text))
+
+    def test_match_across_chunks(self):
+        tmpdir = make_tree({'src/gcc/ChangeLog': '',
+                            'src/gcc/passes.c': PASS_DATA_SRC})
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'src/gcc/passes.c')
+        cs = ChangeSet('test_refactor.py', rename_pass_data,
+                       applychanges=False, srcdir=os.path.join(tmpdir, 'src'))
+        whole = cs.do_one_path(path)
+        self.assertEqual(len(whole.edits), 40)
+        # Every chunk ends within a match, so it falls back to refactoring
+        # the file as a whole:
+        tasks = cs.get_tasks([path], 400, 400)
+        self.assertGreater(len(tasks), 10)
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            cs.add_results(tasks, [cs.do_one_task(task) for task in tasks])
+            self.assertIn('unable to refactor in chunks',
+                          sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(cs.diffs.diffs[path], whole.diff)
+
+    def test_changelog_extend(self):
+        clog = Changelog('foo.c')
+        clog.append('foo', 'Do something.')
+        other = Changelog('foo.c')
+        other.append('foo', 'Do something.')
+        other.append('bar', 'Do something else.')
+        clog.extend(other)
+        self.assertEqual(clog.scope_to_text,
+                         {'foo': 'Do something.',
+                          'bar': 'Do something else.'})
+
 class TestWrapping(unittest.TestCase):
     def assertWrappedCodeEquals(self, src, expected_code):
         as_tabs = ('\t' in src)
@@ -1,7 +1,7 @@
 import unittest
 
-from refactor import wrap, Source
-from refactor_cfun import expand_cfun_macros
+from refactor import wrap, Source, survey_text
+from refactor_cfun import expand_cfun_macros, get_survey_rules
 
 def make_expected_changelog(filename, scope, text):
     return wrap('\t* %s (%s): %s' % (filename, scope, text))
@@ -328,5 +328,30 @@ class MacroTests(unittest.TestCase):
         self.assertRefactoredCodeEquals(src, 'cfgrtl.c',
                                         expected_code)
 
+class SurveyTests(unittest.TestCase):
+    def get_counts(self, src, filename):
+        rules = get_survey_rules()
+        counts = survey_text(filename, src, rules)
+        return dict((rule.name, count)
+                    for rule, count in zip(rules, counts)
+                    if count)
+
+    def test_survey(self):
+        # The survey should count what the refactoring would change, and
+        # nothing else:
+        src = (
+            '  if (num_bb_notes != n_basic_blocks - NUM_FIXED_BLOCKS)\n'
+            '    internal_error\n'
+            '      ("number of bb notes in insn chain (%d) != n_basic_blocks (%d)",\n'
+            '       num_bb_notes, n_basic_blocks);\n'
+            '  /* Walk the ENTRY_BLOCK_PTR.  */\n'
+            '  e = ENTRY_BLOCK_PTR->succs;\n')
+        self.assertEqual(self.get_counts(src, 'cfgrtl.c'),
+                         {'n_basic_blocks': 2, 'ENTRY_BLOCK_PTR': 1})
+
+    def test_survey_excluded_file(self):
+        src = 'int i = n_basic_blocks;\n'
+        self.assertEqual(self.get_counts(src, 'basic-block.h'), {})
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,158 @@
+import os
+import shutil
+from StringIO import StringIO
+import sys
+import threading
+import unittest
+
+from refactoring_daemon import main, request, serve
+from test_refactor import init_git_repo, make_tree
+
+SCRIPT = '''import sys
+from refactor import main, Changelog
+
+def rename(clog_filename, src):
+    changelog = Changelog(clog_filename)
+    for m in src.finditer('n_basic_blocks'):
+        scope = src.get_change_scope_at(m.start())
+        src = src.replace(m.start(), m.end(), '%s')
+        changelog.append(scope, 'Rename n_basic_blocks.')
+    return src.str(), changelog
+
+if __name__ == '__main__':
+    main('refactor_test.py', rename, sys.argv)
+'''
+
+FOO_C = ('static void\n'
+         'foo (void)\n'
+         '{\n'
+         '  int n = n_basic_blocks;\n'
+         '}\n')
+
+# A script that gets the new name from a module alongside it:
+HELPER_SCRIPT = '''import sys
+from refactor import main, Changelog
+import rename_helper
+
+def rename(clog_filename, src):
+    changelog = Changelog(clog_filename)
+    for m in src.finditer('n_basic_blocks'):
+        scope = src.get_change_scope_at(m.start())
+        src = src.replace(m.start(), m.end(), rename_helper.NEW_NAME)
+        changelog.append(scope, 'Rename n_basic_blocks.')
+    return src.str(), changelog
+
+if __name__ == '__main__':
+    main('refactor_test.py', rename, sys.argv)
+'''
+
+class DaemonTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = make_tree({'src/gcc/ChangeLog': 'old entries\n',
+                                 'src/gcc/foo.c': FOO_C,
+                                 'scripts/refactor_test.py':
+                                     SCRIPT % 'NUM_BLOCKS'})
+        init_git_repo(self.tmpdir)
+        self.oldcwd = os.getcwd()
+        os.chdir(os.path.join(self.tmpdir, 'scripts'))
+        self.socket_path = os.path.join(self.tmpdir, 'daemon.sock')
+        self.thread = threading.Thread(target=serve, args=(self.socket_path, ))
+        self.thread.start()
+        while not os.path.exists(self.socket_path):
+            self.thread.join(0.01)
+
+    def tearDown(self):
+        request({'command': 'stop'}, self.socket_path)
+        self.thread.join()
+        os.chdir(self.oldcwd)
+        shutil.rmtree(self.tmpdir)
+
+    def run_script(self, dry_run=True, paths=[]):
+        return request({'command': 'run',
+                        'script': 'refactor_test.py',
+                        'dry_run': dry_run,
+                        'cwd': os.getcwd(),
+                        'paths': paths},
+                       self.socket_path)
+
+    def read(self, path):
+        with open(os.path.join(self.tmpdir, path)) as f:
+            return f.read()
+
+    def test_cache(self):
+        response = self.run_script()
+        self.assertIn('+  int n = NUM_BLOCKS;\n', response['patch'])
+        self.assertIn('+\t* foo.c (foo): Rename n_basic_blocks.\n',
+                      response['patch'])
+        self.assertEqual((response['files'], response['cached']), (1, 0))
+
+        response = self.run_script(paths=['../src/gcc/foo.c'])
+        self.assertIn('+  int n = NUM_BLOCKS;\n', response['patch'])
+        self.assertEqual((response['files'], response['cached']), (1, 1))
+        self.assertEqual(self.read('src/gcc/foo.c'), FOO_C)
+
+    def test_reload(self):
+        self.run_script()
+        with open('refactor_test.py', 'w') as f:
+            f.write(SCRIPT % 'NUM_BBS')
+        mtime = os.path.getmtime('refactor_test.py')
+        os.utime('refactor_test.py', (mtime + 10, mtime + 10))
+        response = self.run_script()
+        self.assertIn('+  int n = NUM_BBS;\n', response['patch'])
+        self.assertEqual(response['cached'], 0)
+
+    def test_reload_module(self):
+        self.addCleanup(sys.modules.pop, 'rename_helper', None)
+        with open('rename_helper.py', 'w') as f:
+            f.write("NEW_NAME = 'NUM_BLOCKS'\n")
+        with open('refactor_test.py', 'w') as f:
+            f.write(HELPER_SCRIPT)
+        response = self.run_script()
+        self.assertIn('+  int n = NUM_BLOCKS;\n', response['patch'])
+        self.assertEqual(self.run_script()['cached'], 1)
+
+        # Changing the module, but not the script, should reload both:
+        with open('rename_helper.py', 'w') as f:
+            f.write("NEW_NAME = 'NUM_BBS'\n")
+        mtime = os.path.getmtime('rename_helper.py')
+        os.utime('rename_helper.py', (mtime + 10, mtime + 10))
+        response = self.run_script()
+        self.assertIn('+  int n = NUM_BBS;\n', response['patch'])
+        self.assertEqual(response['cached'], 0)
+
+    def test_apply(self):
+        self.run_script()
+        self.run_script(dry_run=False)
+        self.assertIn('NUM_BLOCKS', self.read('src/gcc/foo.c'))
+        self.assertTrue(self.read('src/gcc/ChangeLog')
+                        .endswith('\nold entries\n'))
+        # Nothing more to do:
+        response = self.run_script()
+        self.assertEqual(response['patch'], '')
+
+    def test_unsupported_options(self):
+        # (Rather than being ignored, e.g. running a --survey as an
+        # ordinary run, which would modify the files):
+        for args in (['--survey', 'csv'], ['--estimate', '10'],
+                     ['--srcdir', '../other']):
+            stderr = sys.stderr
+            sys.stderr = StringIO()
+            try:
+                self.assertRaises(SystemExit, main,
+                                  ['refactoring_daemon.py', '--socket',
+                                   self.socket_path, 'run', 'refactor_test.py']
+                                  + args)
+                self.assertIn('%s is not supported via the daemon' % args[0],
+                              sys.stderr.getvalue())
+            finally:
+                sys.stderr = stderr
+        self.assertEqual(self.read('src/gcc/foo.c'), FOO_C)
+
+    def test_error(self):
+        self.assertRaises(RuntimeError, request,
+                          {'command': 'run', 'script': 'no-such-script.py',
+                           'dry_run': True, 'cwd': os.getcwd(), 'paths': []},
+                          self.socket_path)
+
+if __name__ == '__main__':
+    unittest.main()